@@ -1,25 +1,103 @@
+import asyncio
+import os
+import socket
 from contextlib import asynccontextmanager
-from concurrent.futures.process import ProcessPoolExecutor
 
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import text
 
-from .src.api.routers import proto
+from .src.api.roles import APP_ROLE, SERVES_READS, SERVES_INGEST, RUNS_PIPELINE, SHARED_JOBS
+from .src.api.routers import read, admin
+from .src.components.tracing import render_metrics
+from .src.components.profiling import watch_loop, LOOP_STALL_DEBUG
 from .src.db.models import Base
 from .src.db.database import engine
 
+if SERVES_INGEST or RUNS_PIPELINE:
+    # read replicas never import the broker or the executor pools
+    from .src.api.routers import proto
+    from .src.api.broker import sweep_jobs, job_metrics, INGEST_CONCURRENCY
+    from .src.api.executors import Pools
+    from .src.api.job_store import get_job_store
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.state.executor = ProcessPoolExecutor()
+    app.state.pools = None
+    app.state.consumers = []
+    if SERVES_INGEST or RUNS_PIPELINE:
+        # api-ingest only extracts and queues videos, the nlp workers are in the worker processes
+        app.state.pools = Pools(cpu=RUNS_PIPELINE)
+        await app.state.pools.start()
+    watchdog = asyncio.create_task(watch_loop()) if LOOP_STALL_DEBUG else None
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all) # Run seperately in another script if instatiate multiple uvicorn workers
+    sweeper = asyncio.create_task(sweep_jobs(app.state.pools.io, proto.archive_jobs)) if app.state.pools else None
+    if APP_ROLE == 'worker':
+        app.state.consumers = [
+            asyncio.create_task(proto.consume_ingest_queue(app.state.pools, f'{socket.gethostname()}:{os.getpid()}:{i}'))
+            for i in range(INGEST_CONCURRENCY)
+        ]
     yield
+    for task in [sweeper, watchdog, *app.state.consumers]:
+        if task:
+            task.cancel()
     await engine.dispose()
-    app.state.executor.shutdown()
+    if app.state.pools:
+        app.state.pools.shutdown()
 
 app = FastAPI(lifespan=lifespan, docs_url="/nlp/api/docs", openapi_url="/nlp/openapi.json")
 
-app.include_router(proto.router)
+if SERVES_READS:
+    app.include_router(read.router)
+if SERVES_INGEST:
+    app.include_router(proto.router)
+app.include_router(admin.router)
+
+@app.get('/health', include_in_schema=False)
+async def health():
+    """
+    Liveness: the process is up and its event loop is serving
+    """
+    return {'role': APP_ROLE, 'status': 'ok'}
+
+@app.get('/ready', include_in_schema=False)
+async def ready():
+    """
+    Readiness of the role (503 when a check fails):
+    - database: every role
+    - job_store: api-ingest and worker, the ingest queue and job states are shared through it
+    - consumers: worker, every ingest queue consumer is running
+    """
+    checks = {}
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
+        checks['database'] = True
+    except Exception:
+        checks['database'] = False
+    if SHARED_JOBS:
+        try:
+            await app.state.pools.io.run(get_job_store().queue_depth)
+            checks['job_store'] = True
+        except Exception:
+            checks['job_store'] = False
+    if APP_ROLE == 'worker':
+        checks['consumers'] = bool(app.state.consumers) and not any(t.done() for t in app.state.consumers)
+    ok = all(checks.values())
+    return JSONResponse({'role': APP_ROLE, 'ready': ok, 'checks': checks}, 200 if ok else 503)
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics():
+    """
+    Prometheus metrics: stage timing, queue wait and cpu, llm tokens, bytes, cache hit/miss, parse outcomes and job store size
+    """
+    gauges = {}
+    if app.state.pools:
+        gauges.update({f'broker_{k}': v for k, v in (await job_metrics(app.state.pools.io)).items()})
+        gauges.update(app.state.pools.gauges())
+    return PlainTextResponse(render_metrics(gauges), media_type='text/plain; version=0.0.4')
 
 app.add_middleware(
     CORSMiddleware,
@@ -1,9 +1,27 @@
 #TODO: Migrate to more powerful lib (Celery, RabbitMQ, Redis for caching messages, etc)
 
 import asyncio
+import logging
+import os
+import time
 from enum import Enum
+from functools import partial
+from uuid import uuid4
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PrivateAttr, computed_field
+
+from .job_store import get_job_store, offload
+from ..components.tracing import traced_call, summarize, observe_stage, metrics, export
+from .executors import Pool
+from .roles import SHARED_JOBS
+
+INGEST_CONCURRENCY = int(os.environ.get('INGEST_CONCURRENCY', 4))
+EVENT_QUEUE_SIZE = 256
+JOB_TTL = int(os.environ.get('JOB_TTL', 3600)) # seconds a finished job is kept in memory
+JOB_MAX_ENTRIES = int(os.environ.get('JOB_MAX_ENTRIES', 1000))
+JOB_SWEEP_INTERVAL = int(os.environ.get('JOB_SWEEP_INTERVAL', 60))
+
+logger = logging.getLogger('uvicorn.error')
 
 class Status(int, Enum):
     COMPLETED = 0
@@ -13,14 +31,404 @@ class Status(int, Enum):
 class Result(BaseModel):
     status: Status = Status.IN_PROGRESS
     data: dict | list | None = None
+    started_at: float | None = None
+    finished_at: float | None = None
+    stored: int | None = None # packed size when data was moved to the job store
+    _uid: str | None = PrivateAttr(default=None)
+    _stage: str | None = PrivateAttr(default=None)
+    _size: int = PrivateAttr(default=0) # packed size of data kept inline, set once the stage finished
+
+    def __setattr__(self, name, value):
+        if name == 'status':
+            super().__setattr__('finished_at', None if value == Status.IN_PROGRESS else time.time())
+            if value == Status.FAILED:
+                # partial results of a failed stage must not be used by the stages depending on it
+                super().__setattr__('data', None)
+                super().__setattr__('stored', None)
+        super().__setattr__(name, value)
+        if self._uid is not None and name == 'status':
+            if self.elapsed is not None:
+                metrics.observe('ingest_stage_seconds', self.elapsed, 'Wall time of a stage', stage=self._stage, status=self.status.name.lower())
+            publish(self._uid, self.event())
+
+    def bind(self, uid, stage):
+        self._uid = uid
+        self._stage = stage
+
+    def start(self):
+        """
+        mark the stage as running (again on retry), data left from a previous run is dropped
+        """
+        self.data = None
+        self.stored = None
+        self._size = 0
+        self.started_at = time.time()
+        self.status = Status.IN_PROGRESS
+
+    def load(self):
+        """
+        stage data, read back from the job store if it was offloaded (blocking, see load_stage)
+        """
+        if self.stored is not None:
+            return get_job_store().get(self._uid, self._stage)
+        return self.data
+
+    @property
+    def has_data(self) -> bool:
+        return self.data is not None or self.stored is not None
+
+    @property
+    def elapsed(self) -> float | None:
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return round(self.finished_at - self.started_at, 3)
+
+    def event(self, partial=False) -> dict:
+        """
+        compact stage transition, data is left out
+        """
+        return {
+            'stage': self._stage,
+            'status': self.status,
+            'partial': partial,
+            'started_at': self.started_at,
+            'elapsed': self.elapsed
+        }
 
 class Job(BaseModel):
     uid: str
     status: Status = Status.IN_PROGRESS
     states: dict[str, Result]
+    created_at: float = Field(default_factory=time.time)
+    finished_at: float | None = None
+    traces: dict[str, dict] = {} # stage -> summary of its last traced run
+    _spans: list = PrivateAttr(default_factory=list) # (stage, child spans) not exported yet
+
+    def model_post_init(self, __context):
+        for k, r in self.states.items():
+            r.bind(self.uid, k)
+
+    @classmethod
+    def from_brief(cls, brief) -> 'Job':
+        """
+        job rebuilt from the state mirrored in the job store (SHARED_JOBS), its stage data stays in the store
+        """
+        states = {}
+        for k, s in brief['states'].items():
+            finished_at = s['started_at'] + s['elapsed'] if s['elapsed'] is not None else None
+            # stored only marks the data as offloaded, its size is not mirrored
+            states[k] = Result(status=s['status'], started_at=s['started_at'], finished_at=finished_at, stored=0 if s['has_data'] else None)
+        return cls(
+            uid=brief['uid'],
+            status=brief['status'],
+            states=states,
+            created_at=brief['created_at'],
+            finished_at=brief['finished_at'],
+            traces=brief['traces']
+        )
+
+    def __setattr__(self, name, value):
+        if name == 'status':
+            super().__setattr__('finished_at', None if value == Status.IN_PROGRESS else time.time())
+        super().__setattr__(name, value)
+        if name == 'status':
+            publish(self.uid, {'stage': None, 'status': self.status, 'partial': False, 'elapsed': round(time.time() - self.created_at, 3)})
+
+    def brief(self, include=()) -> dict:
+        """
+        status and timing of the job and every stage, data only for stages in include
+        """
+        states = {}
+        for k, r in self.states.items():
+            states[k] = {**r.event(), 'has_data': r.has_data}
+            del states[k]['stage'], states[k]['partial']
+            if k in include:
+                states[k]['data'] = r.load()
+        return {
+            'uid': self.uid,
+            'status': self.status,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'states': states,
+            'traces': self.traces
+        }
+
+class BatchJob(BaseModel):
+    uid: str
+    source: str
+    status: Status = Status.IN_PROGRESS
+    total: int = 0
+    skipped: list[str] = []
+    queued: list[str] = []
+    completed: list[str] = []
+    failed: list[str] = []
+    finished_at: float | None = None
+
+    @computed_field
+    @property
+    def progress(self) -> dict[str, int]:
+        return {
+            'total': self.total,
+            'skipped': len(self.skipped),
+            'queued': len(self.queued),
+            'completed': len(self.completed),
+            'failed': len(self.failed),
+        }
 
 jobs: dict[str, Job] = {}
+batches: dict[str, BatchJob] = {}
+
+# video id -> resolved once its ingest job is registered in jobs (or turned out to be already ingested)
+flights: dict[str, asyncio.Future] = {}
+
+job_counters = {'evicted': 0, 'archived': 0, 'archive_failed': 0}
+
+def evict_jobs(now=None, ttl=JOB_TTL, max_entries=JOB_MAX_ENTRIES) -> list[Job]:
+    """
+    remove finished jobs older than ttl, then the oldest finished ones while over max_entries
+    jobs in progress are never evicted, return the evicted jobs, their job store entries are left to the caller
+    """
+    now = now or time.time()
+    finished = sorted([j for j in jobs.values() if j.finished_at is not None], key=lambda j: j.finished_at)
+    expired = [j for j in finished if now - j.finished_at > ttl]
+    over = len(jobs) - len(expired) - max_entries
+    if over > 0:
+        expired += finished[len(expired):len(expired) + over]
+    for j in expired:
+        del jobs[j.uid]
+    for uid in [uid for uid, b in batches.items() if b.finished_at is not None and now - b.finished_at > ttl]:
+        del batches[uid]
+    job_counters['evicted'] += len(expired)
+    return expired
+
+async def sweep_jobs(pool: Pool, archive=None, interval=JOB_SWEEP_INTERVAL):
+    """
+    background task evicting jobs every interval, summaries of evicted jobs are passed to archive (async, returns success)
+    their entries in the job store are deleted in pool
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            evicted = evict_jobs()
+            stored = [j.uid for j in evicted if SHARED_JOBS or any(r.stored is not None for r in j.states.values())]
+            if stored:
+                await pool.run(get_job_store().delete_many, stored)
+            if evicted and archive is not None:
+                if await archive([j.brief() for j in evicted]):
+                    job_counters['archived'] += len(evicted)
+                else:
+                    job_counters['archive_failed'] += len(evicted)
+            if evicted:
+                logger.info(f'Evicted {len(evicted)} finished jobs, {len(jobs)} left')
+        except Exception as e:
+            logger.error(f'Sweep jobs failed: {e}')
+
+async def job_metrics(pool: Pool) -> dict:
+    """
+    size of the in-memory job store, inline_bytes is the packed size of finished stage data kept in memory
+    (measured once by persist_stage, data of running stages is not counted)
+    with SHARED_JOBS the depth of the ingest queue too, read in pool
+    """
+    queue = await pool.run(get_job_store().queue_depth) if SHARED_JOBS else {}
+    states = [r for j in jobs.values() for r in j.states.values()]
+    return {
+        'jobs': len(jobs),
+        'jobs_in_progress': sum(1 for j in jobs.values() if j.status == Status.IN_PROGRESS),
+        'batches': len(batches),
+        'subscribers': sum(len(q) for q in subscribers.values()),
+        'inline_bytes': sum(r._size for r in states if r.data is not None),
+        'stored_bytes': sum(r.stored for r in states if r.stored is not None),
+        **{f'jobs_{k}': v for k, v in job_counters.items()},
+        **{f'ingest_{k}': v for k, v in queue.items()},
+    }
+
+# job uid -> queues of connected event stream clients
+subscribers: dict[str, set[asyncio.Queue]] = {}
+
+def publish(uid, event):
+    """
+    fan out a job event to every subscriber, must be called from the event loop thread
+    """
+    for q in subscribers.get(uid, ()):
+        try:
+            q.put_nowait({'uid': uid, 't': time.time(), **event})
+        except asyncio.QueueFull:
+            logger.warning(f'Event queue of job {uid} is full, event dropped')
+
+def subscribe(uid) -> asyncio.Queue:
+    q = asyncio.Queue(EVENT_QUEUE_SIZE)
+    subscribers.setdefault(uid, set()).add(q)
+    return q
+
+def unsubscribe(uid, q):
+    subs = subscribers.get(uid)
+    if subs is not None:
+        subs.discard(q)
+        if not subs:
+            subscribers.pop(uid, None)
+
+def set_partial(uid, stage, data):
+    """
+    progressive stage result, safe to call from worker threads through loop.call_soon_threadsafe
+    """
+    job = jobs.get(uid)
+    # a late partial (queued before the stage finished) must not overwrite its final state
+    if job is not None and stage in job.states and job.states[stage].status == Status.IN_PROGRESS:
+        job.states[stage].data = data
+        publish(uid, job.states[stage].event(partial=True))
+
+async def run_stage(pool: Pool, uid, stage, fn, *args, **kwargs):
+    """
+    run a pipeline stage in pool (see executors.Pools) with tracing,
+    its summary is kept on the job and its spans are exported when the job finishes
+    """
+    submitted = time.time()
+    try:
+        res, trace = await pool.run(partial(traced_call, fn, *args, **kwargs))
+    except Exception as e:
+        record_trace(uid, stage, getattr(e, 'trace', None), submitted)
+        raise
+    record_trace(uid, stage, trace, submitted)
+    return res
+
+def record_trace(uid, stage, trace, submitted):
+    if trace is None:
+        return
+    summary = summarize(trace, submitted)
+    observe_stage(stage, trace, summary)
+    job = jobs.get(uid)
+    if job is not None:
+        job.traces[stage] = summary
+        job._spans.append((stage, trace['spans']))
+
+async def run_with_partial(pool: Pool, uid, stage, fn, *args):
+    """
+    run fn(*args, on_partial=...) in a thread pool, partial results are set on the job stage from the event loop
+    (callbacks can't cross a process boundary, the stage is network bound anyway)
+    """
+    loop = asyncio.get_running_loop()
+    on_partial = lambda data: loop.call_soon_threadsafe(set_partial, uid, stage, data)
+    return await run_stage(pool, uid, stage, fn, *args, on_partial=on_partial)
+
+def new_span_id():
+    return os.urandom(8).hex()
+
+async def finish_trace(uid, started):
+    """
+    export the run of a job that started at started: a root span, one span per stage run and their child spans
+    """
+    job = jobs.get(uid)
+    if job is None:
+        return
+    metrics.observe('ingest_job_seconds', time.time() - started, 'Wall time of a pipeline run', status=job.status.name.lower())
+    root = {'name': 'ingest', 'span_id': new_span_id(), 'start': started, 'end': time.time(), 'attrs': {'uid': uid, 'status': job.status.name}}
+    spans = [root]
+    stage_ids = {}
+    for k, r in job.states.items():
+        if r.started_at is not None and r.started_at >= started and r.finished_at is not None:
+            stage_ids[k] = new_span_id()
+            attrs = {'stage': k, 'status': r.status.name, **job.traces.get(k, {})}
+            spans.append({'name': f'stage.{k}', 'span_id': stage_ids[k], 'parent_id': root['span_id'], 'start': r.started_at, 'end': r.finished_at, 'attrs': attrs})
+    for stage, children in job._spans:
+        for c in children:
+            spans.append({**c, 'attrs': {'stage': stage, **c['attrs']}, 'span_id': new_span_id(), 'parent_id': stage_ids.get(stage, root['span_id'])})
+    job._spans = []
+    await asyncio.get_running_loop().run_in_executor(None, export, uuid4().hex, spans)
+
+async def load_stage(pool: Pool, uid, stage):
+    """
+    data of a stage, read back from the job store in pool when it was offloaded
+    """
+    r = jobs[uid].states[stage]
+    if r.stored is None:
+        return r.data
+    return await pool.run(r.load)
+
+async def persist_stage(pool: Pool, uid, stage):
+    """
+    called once a stage has finished: its data is moved to the job store when too large to keep inline
+    (always with SHARED_JOBS) and the job state is mirrored, the store is written in pool
+    """
+    job = jobs.get(uid)
+    if job is None:
+        return
+    r = job.states[stage]
+    if r.data is not None and r.stored is None:
+        try:
+            size, stored = await pool.run(offload, uid, stage, r.data)
+        except Exception as e:
+            # e.g. the store is locked or full, like unserializable data it stays in memory
+            logger.warning(f'Offload stage data {uid}/{stage} failed, kept in memory: {e}')
+            size, stored = 0, False
+        if stored:
+            r.stored = size
+            r.data = None
+        else:
+            r._size = size
+    if SHARED_JOBS:
+        await mirror(pool, uid)
+
+async def mirror(pool: Pool, uid):
+    """
+    SHARED_JOBS: write the state of a job run by this worker to the job store, read by api-ingest
+    """
+    job = jobs.get(uid)
+    if job is None:
+        return
+    try:
+        await pool.run(get_job_store().put_state, uid, job.brief())
+    except Exception as e:
+        logger.warning(f'Mirror state of job {uid} failed: {e}')
+
+def enqueue_job(job: Job, payload=None):
+    """
+    api-ingest: share a new job (state and stage data) through the job store and queue it for the workers, blocking
+    """
+    for k, r in job.states.items():
+        # SHARED_JOBS keeps no stage data inline
+        size, stored = offload(job.uid, k, r.data)
+        if stored:
+            r.stored = size
+            r.data = None
+    store = get_job_store()
+    store.put_state(job.uid, job.brief())
+    store.enqueue(job.uid, payload or {})
+
+def requeue_job(uid) -> dict | None:
+    """
+    api-ingest: queue a shared job again to retry its failed stages, None if there is no such job
+    """
+    store = get_job_store()
+    brief = store.get_state(uid)
+    if brief is None:
+        return None
+    brief['status'] = Status.IN_PROGRESS
+    brief['finished_at'] = None
+    store.put_state(uid, brief)
+    store.enqueue(uid, {'retry': True})
+    return brief
+
+def shared_in_progress(uids) -> set[str]:
+    """
+    api-ingest: uids of shared jobs in progress, blocking
+    """
+    store = get_job_store()
+    res = set()
+    for uid in uids:
+        brief = store.get_state(uid)
+        if brief is not None and brief['status'] == Status.IN_PROGRESS:
+            res.add(uid)
+    return res
 
-async def run_in_process(executor, fn, *args):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(executor, fn, *args)
\ No newline at end of file
+def shared_brief(uid, include=()) -> dict | None:
+    """
+    Job.brief of a job run by a worker, read from the job store, 'all' in include stands for every stage
+    """
+    store = get_job_store()
+    brief = store.get_state(uid)
+    if brief is None:
+        return None
+    for k in (brief['states'].keys() if 'all' in include else include):
+        if k in brief['states']:
+            brief['states'][k]['data'] = store.get(uid, k) if brief['states'][k]['has_data'] else None
+    return brief
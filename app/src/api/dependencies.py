@@ -4,17 +4,36 @@ from typing import Annotated
 from random import sample
 import traceback
 import os
+import shutil
+import hmac
+from collections import Counter
 
-from fastapi import Body, HTTPException
+from fastapi import Body, Header, HTTPException, Request
 
 from ..db.database import SessionLocal
 from ..components.extractor import *
-from ..components.textrankv3 import Doc
+from ..components.dictionary import lookup_entries, get_first_phon
+from ..components.lexicon import get_lexicon, pick_entry
+from ..components.chunking import split_chunks, map_chunks, interleave, count_tokens
+from ..components.response_parser import TopicLevel, VocabItem, QuestionItem, salvage_list
 from ..components.utils import lemmatize
+from ..components.tracing import span
 from ..db.schemas import Level, RequestVideo
 
 logger = logging.getLogger('uvicorn.error')
 
+VOCAB_LIMIT = 20
+QUESTION_LIMIT = 6
+
+LLM_COMPRESS = os.environ.get('LLM_COMPRESS', '0') == '1'
+LLM_COMPRESS_TOKENS = int(os.environ.get('LLM_COMPRESS_TOKENS', 1500))
+VOCAB_CANDIDATES = 60
+
+LLM_MODE = os.environ.get('LLM_MODE', 'stage') # stage: one request per stage | fused: one request for all stages
+LLM_STREAM = os.environ.get('LLM_STREAM', '0') == '1' # stream summary and questions, publishing partial results
+
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN') # admin endpoints are disabled when not set
+
 async def get_db_session():
     db = SessionLocal()
     try:
@@ -24,6 +43,12 @@ async def get_db_session():
     finally:
         await db.close()
 
+async def require_admin(x_admin_token: Annotated[str | None, Header()] = None):
+    if not ADMIN_TOKEN:
+        raise HTTPException(404, 'Not Found')
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(403, 'Forbidden')
+
 def dump_temp_json(vid, fname, obj):
     if not os.path.exists(f'./app/temp/{vid}'):
         os.makedirs(f'./app/temp/{vid}')
@@ -32,24 +57,26 @@ def dump_temp_json(vid, fname, obj):
     
 def load_temp_file(vid, fname):
     if os.path.exists(f'./app/temp/{vid}/{fname}.json'):
-        with open(f'./app/temp/{vid}/{fname}.json', 'r') as f:
-            data = json.load(f)
+        with span('stage.cache', cache='stage_result', cache_hits=1, file=fname):
+            with open(f'./app/temp/{vid}/{fname}.json', 'r') as f:
+                data = json.load(f)
         return data
     else:
-        return None
+        with span('stage.cache', cache='stage_result', cache_misses=1, file=fname):
+            return None
     
 def clear_temp_file(vid):
     """
-    called when task finished
+    called when task finished or processed again on purpose
     """
     if os.path.exists(f'./app/temp/{vid}'):
-        os.rmdir(f'./app/temp/{vid}')
+        shutil.rmtree(f'./app/temp/{vid}', ignore_errors=True)
 
 def extract_topic_level(vid, text):
     try:
         processed = load_temp_file(vid, 'topic_level')
         if not processed:
-            res = gpt_topic_level(text)
+            res = merge_topic_level(map_chunks(gpt_topic_level, split_chunks(text), allow_partial=True))
             processed = {
                 'topic': res['topic'],
                 'level': Level[format_cefr_key(res['level'])].value
@@ -60,50 +87,197 @@ def extract_topic_level(vid, text):
         dump_temp_json(vid, 'topic_level', processed)
         return processed
     
-def extract_summa(vid, text):
+def extract_summa(vid, text, on_partial=None):
     try:
         processed = load_temp_file(vid, 'summa')
         if not processed:
-            processed = gpt_summa(text)
+            processed = reduce_summa(text, on_partial)
     except Exception as e:
         raise e
     else:
         dump_temp_json(vid, 'summa', processed)
         return processed
     
-def extract_vocab(vid, text):
+def extract_vocab(vid, text, candidates=None):
     try:
         processed = load_temp_file(vid, 'vocab')
         if not processed:
-            processed = {'vocab': process_list_vocabs(gpt_vocab(text)['vocab_list'])}
+            results = map_chunks(lambda t: gpt_vocab(t, candidates=candidates), split_chunks(text), allow_partial=True)
+            processed = {'vocab': process_list_vocabs(merge_vocab([r['vocab_list'] for r in results]))}
     except Exception as e:
         raise e
     else:
         dump_temp_json(vid, 'vocab', processed)
         return processed
     
-def extract_questions(vid, text):
+def extract_questions(vid, text, on_partial=None):
     try:
         processed = load_temp_file(vid, 'questions')
         if not processed:
-            processed = gpt_questions(text)
+            # partial results are only meaningful when the whole list comes from one request
+            chunks = split_chunks(text)
+            fn = (lambda t: gpt_questions(t, on_partial=on_partial)) if len(chunks) == 1 else gpt_questions
+            results = map_chunks(fn, chunks, allow_partial=True)
+            processed = results[0] if len(results) == 1 else {'questions': interleave([r['questions'] for r in results])[:QUESTION_LIMIT]}
     except Exception as e:
         raise e
     else:
         dump_temp_json(vid, 'questions', processed)
         return processed
     
-def extract_lessions(vid, text, gpt_qs):
-    try:
-        doc = Doc(4, 15)
+def parse_fused_section(section, res):
+    if section == 'topic_level':
+        topic_level = TopicLevel.model_validate(res)
+        return {'topic': topic_level.topic, 'level': Level[format_cefr_key(topic_level.level)].value}
+    if section == 'summa':
+        if not isinstance(res.get('summary'), str) or not res['summary']:
+            raise KeyError('summary')
+        return {'summarize': res['summary']}
+    if section == 'vocab':
+        valid, _ = salvage_list(VocabItem, res.get('vocab_list'))
+        vocab = process_list_vocabs(valid)
+        if not vocab:
+            raise KeyError('vocab_list')
+        return {'vocab': vocab}
+    if section == 'questions':
+        questions, _ = salvage_list(QuestionItem, res.get('questions'))
+        if len(questions) < QUESTION_LIMIT:
+            raise KeyError('questions')
+        return {'questions': questions[:QUESTION_LIMIT]}
+    raise KeyError(section)
+
+def extract_fused(vid, text, candidates=None):
+    """
+    all llm stages from one fused request, sections missing or malformed in the response are retried with their own stage prompt
+    text is the compressed transcript when LLM_COMPRESS is set, vocabulary is then picked from candidates
+    return processed data and error message of each stage (keyed like the temp files)
+    """
+    stages = {
+        'topic_level': extract_topic_level,
+        'summa': extract_summa,
+        'vocab': lambda vid, text: extract_vocab(vid, text, candidates),
+        'questions': extract_questions
+    }
+    processed = {k: load_temp_file(vid, k) for k in stages}
+    missing = [k for k, v in processed.items() if not v]
+    # Long transcripts go through the chunked stage prompts instead
+    if len(missing) > 1 and len(split_chunks(text)) == 1:
+        try:
+            res = gpt_fused(text, candidates=candidates)
+        except Exception as e:
+            logger.error(f'Fused request failed: {e}')
+            res = {}
+        for k in missing:
+            try:
+                processed[k] = parse_fused_section(k, res)
+            except Exception as e:
+                logger.warning(f'Fused section {k} invalid, retrying with stage prompt: {e}')
+            else:
+                dump_temp_json(vid, k, processed[k])
+
+    errors = {}
+    for k, v in processed.items():
+        if not v:
+            try:
+                processed[k] = stages[k](vid, text)
+            except Exception as e:
+                errors[k] = str(e)
+    return processed, errors
+
+def merge_topic_level(results):
+    """
+    majority vote over chunks, ties on level go to the harder one (Level order)
+    levels that are not cefr are left out of the vote, unless no chunk returned a valid one
+    """
+    topic = Counter([r['topic'] for r in results]).most_common(1)[0][0]
+    levels = Counter([format_cefr_key(str(r['level'])) for r in results])
+    valid = [l for l in levels if l in Level.__members__]
+    if not valid:
+        return {'topic': topic, 'level': levels.most_common(1)[0][0]}
+    level = max(valid, key=lambda l: (levels[l], Level[l].value))
+    return {'topic': topic, 'level': level}
+
+def reduce_summa(text, on_partial=None):
+    """
+    summary of summaries until the text fits in one chunk, only the final summary is streamed
+    """
+    chunks = split_chunks(text)
+    if len(chunks) == 1:
+        return gpt_summa(text, on_partial=on_partial)
+    summaries = ' '.join([r['summarize'] for r in map_chunks(gpt_summa, chunks)])
+    if count_tokens(summaries) >= count_tokens(text):
+        return gpt_summa(summaries, on_partial=on_partial)
+    return reduce_summa(summaries, on_partial)
+
+def merge_vocab(vocab_lists):
+    """
+    dedupe by lemma, keep chunks evenly represented
+    """
+    seen = set()
+    res = []
+    for v in interleave(vocab_lists):
+        try:
+            key = lemmatize(v['vocabulary'].lower())
+        except Exception as e:
+            continue
+        if key not in seen:
+            seen.add(key)
+            res.append(v)
+    return res if len(vocab_lists) == 1 else res[:VOCAB_LIMIT]
+
+def new_doc():
+    """
+    textrank doc, textrankv3 pulls spacy, nltk, numpy and networkx so it is only imported where a doc is fitted
+    (cpu pool workers, where warm_worker has loaded it already)
+    """
+    from ..components.textrankv3 import Doc
+    return Doc(4, 15)
+
+def compress_text(text, budget=LLM_COMPRESS_TOKENS):
+    """
+    extractive pre-compression: fit textrank once, keep top ranked sentences for the summary/topic prompts
+    and top keywords as vocab candidates, synthetic questions are kept for lessions so the doc is not fitted again
+    """
+    with span('textrank.fit', tokens=count_tokens(text)) as attrs:
+        doc = new_doc()
         doc.fit(text)
-        syn_questions = doc.gen_questions()
-        t3 = [q for _, q in syn_questions.items()][:6]
+        attrs.update(fit_time=doc.run_time, **{f'{k}_time': v for k, v in doc.phase_times.items()})
+    compressed = doc.compress(budget, count_tokens)
+    candidates = list(doc.vocab.keys())[:VOCAB_CANDIDATES]
+    full = count_tokens(text)
+    tokens = {
+        'topic_level': count_tokens(compressed),
+        'summarize': count_tokens(compressed),
+        'vocabulary': count_tokens(compressed) + count_tokens(', '.join(candidates)),
+    }
+    return {
+        'text': compressed,
+        'candidates': candidates,
+        'syn_questions': [q for _, q in doc.gen_questions().items()][:6],
+        'keywords': doc.get_keywords(),
+        'tokens': {'full': full, **tokens},
+        'saved': {k: full - v for k, v in tokens.items()},
+        'fit_time': doc.run_time,
+    }
+
+def extract_lessions(vid, text, gpt_qs, fitted=None):
+    try:
+        if fitted is None:
+            with span('textrank.fit', tokens=count_tokens(text)) as attrs:
+                doc = new_doc()
+                doc.fit(text)
+                attrs.update(fit_time=doc.run_time, **{f'{k}_time': v for k, v in doc.phase_times.items()})
+            fitted = {
+                'syn_questions': [q for _, q in doc.gen_questions().items()][:6],
+                'keywords': doc.get_keywords()
+            }
+        t3 = fitted['syn_questions']
         reading = create_lession((gpt_qs[:3], [], t3))
         listening = create_lession((gpt_qs[3:], [], t3))
         processed = {
             'reading': reading,
-            'listening': listening
+            'listening': listening,
+            'keywords': enrich_keywords(fitted['keywords'])
         }
     except Exception as e:
         raise e
@@ -152,7 +326,7 @@ def extract_video_and_sub(url: RequestVideo):
         print(traceback.format_exc())
         raise HTTPException(525, f'Preprocessing text failed due to call to gpt api: {e}, please try again later')
     try:
-        doc = Doc(4, 15)
+        doc = new_doc()
         doc.fit(text)
         syn_questions = doc.gen_questions()
         t3 = [q for _, q in syn_questions.items()][:6]
@@ -184,35 +358,65 @@ def extract_video_and_sub(url: RequestVideo):
         raise HTTPException(525, f'Preprocessing text failed | please try again later')
     return result
 
+async def extract_video_and_sub_task(req: Request, url: RequestVideo):
+    """
+    extract_video_and_sub in the cpu pool, it calls youtube and the gpt api then fits textrank
+    """
+    if req.app.state.pools.cpu is None:
+        raise HTTPException(503, 'No nlp workers in this process, use /video/create')
+    return await req.app.state.pools.cpu.run(extract_video_and_sub, url)
+
+def enrich_keywords(keywords):
+    """
+    add ipa and cefr level from the offline lexicon to textrank keywords
+    """
+    lex = get_lexicon().lookup_many([k['lemma'] for k in keywords])
+    for k in keywords:
+        entry = pick_entry(lex.get(k['lemma'].lower()), k['pos'])
+        k['ipa'] = entry.ipa if entry else ''
+        k['level'] = Level[entry.level].value if entry and entry.level in Level.__members__ else None
+    return keywords
+
 def process_list_vocabs(vocabs):
     res = []
+    # Offline lexicon first, no network needed
+    words = [v['vocabulary'] for v in vocabs if 'vocabulary' in v]
+    lex = get_lexicon().lookup_many(words + [lemmatize(w) for w in words])
     for v in vocabs:
         head_w = v['vocabulary']
         try:
+            entry = pick_entry(lex.get(head_w.lower()) or lex.get(lemmatize(head_w).lower()), v['pos'])
+            level = format_cefr_key(v['level'])
+            if level not in Level.__members__ and entry and entry.level:
+                level = entry.level
             f = {
                 'vocab': {
                     'word': head_w,
-                    'ipa': v['ipa']
+                    'ipa': v['ipa'] or (entry.ipa if entry else '')
                 },
                 'sense': {
                     'sense': v['meaning'],
                     'pos': v['pos'],
-                    'level': Level[format_cefr_key(v['level'])].value,
+                    'level': Level[level].value,
                 }
             }
         except KeyError as e:
             print(traceback.format_exc())
             logging.error(f'{e} | Please check temp file for gpt mismatch format')
         else:
-            # In case gpt failed to generate ipa, crawl oxford dictionary web to acquire ipa
-            if f['vocab']['ipa'] == '':
-                infos = extract_info(head_w)
-                # If not found, lemmatize and retry
-                if infos is None:
-                    infos = extract_info(lemmatize(head_w))
-                    if infos is not None:
-                        f['vocab']['ipa'] = list(infos[0]['phons'].values())[0]['phon']
             res.append(f)
+
+    # In case gpt failed to generate ipa, look up oxford dictionary (cached, misses are crawled concurrently)
+    missing = [f['vocab']['word'] for f in res if f['vocab']['ipa'] == '']
+    if missing:
+        # entries are looked up by lemma
+        infos = lookup_entries(missing)
+        for f in res:
+            w = f['vocab']['word']
+            if f['vocab']['ipa'] == '':
+                phon = get_first_phon(infos.get(w))
+                if phon:
+                    f['vocab']['ipa'] = phon
     return res
 
 def create_lession(questions):
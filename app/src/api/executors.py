@@ -0,0 +1,157 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from ..components.profiling import run_profiled
+
+logger = logging.getLogger('uvicorn.error')
+
+# cpu: process pool for nlp (textrank fit, spacy), sized to the cores
+CPU_WORKERS = int(os.environ.get('CPU_WORKERS', os.cpu_count() or 1))
+CPU_MAX_TASKS_PER_CHILD = int(os.environ.get('CPU_MAX_TASKS_PER_CHILD', 0)) # recycle workers to bound memory growth, 0 to keep them
+CPU_PREFORK = os.environ.get('CPU_PREFORK', '1') == '1' # start and warm the cpu workers with the app, not on the first request
+PREFORK_TIMEOUT = 120
+# llm: threads for network bound stages (completion api, dictionary), mostly waiting so they can outnumber the cores
+LLM_WORKERS = int(os.environ.get('LLM_WORKERS', 32))
+# io: threads for blocking calls made by request handlers (yt-dlp, files, job store) and light stages
+IO_WORKERS = int(os.environ.get('IO_WORKERS', 16))
+
+def warm_worker():
+    """
+    cpu pool initializer: load the spacy model, punkt and wordnet once per worker process instead of in its first task
+    failures are only logged, an initializer that raises breaks the whole pool
+    """
+    from nltk import sent_tokenize
+    from ..components.textrankv3 import load_nlp
+    from ..components.utils import lemmatize
+
+    started = time.perf_counter()
+    loaded = []
+    for name, load in (('spacy', load_nlp), ('punkt', lambda: sent_tokenize('Warm up. Twice.')), ('wordnet', lambda: lemmatize('warm'))):
+        try:
+            load()
+            loaded.append(name)
+        except Exception as e:
+            logger.warning(f'Worker {os.getpid()} preload {name} failed: {' '.join(str(e).split())[:200]}')
+    logger.info(f'Worker {os.getpid()} preloaded {loaded} in {time.perf_counter() - started:.2f}s')
+
+def packed_call(fn, *args):
+    """
+    run fn in a worker and return its result as zlib compressed json, smaller and faster to send back than a pickle
+    of nested dicts, results of cpu stages are json already as they are kept in the job store
+    """
+    return zlib.compress(json.dumps(fn(*args), separators=(',', ':')).encode())
+
+def worker_ready(hold=0.05):
+    time.sleep(hold)
+    return os.getpid()
+
+def unpack(data):
+    return json.loads(zlib.decompress(data))
+
+class Pool():
+    """
+    executor with queue depth and utilization accounting
+    busy_seconds integrates the number of busy workers over time, its rate divided by workers is the utilization
+    """
+    def __init__(self, name, executor, workers, packed=False):
+        self.name = name
+        self.executor = executor
+        self.workers = workers
+        self.packed = packed # results cross a process boundary, see packed_call
+        self.inflight = 0 # submitted and not finished, the ones over workers are waiting in the queue
+        self.completed = 0
+        self.busy_seconds = 0.0
+        self._last = time.monotonic()
+
+    def _tick(self):
+        now = time.monotonic()
+        self.busy_seconds += min(self.inflight, self.workers) * (now - self._last)
+        self._last = now
+
+    async def run(self, fn, *args):
+        """
+        run fn(*args) in the pool, under the profiler of the open profiling window if any
+        """
+        self._tick()
+        self.inflight += 1
+        try:
+            if self.packed:
+                return unpack(await run_profiled(self.executor, partial(packed_call, fn, *args)))
+            return await run_profiled(self.executor, partial(fn, *args))
+        finally:
+            self._tick()
+            self.inflight -= 1
+            self.completed += 1
+
+    async def prefork(self, timeout=PREFORK_TIMEOUT):
+        """
+        start every worker now (running the initializer) so the first task does not pay for it
+        """
+        started = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        pids = set()
+        # a worker done with its initializer would take every probe, so probes hold the worker for a moment
+        # and are sent again until all workers answered
+        while len(pids) < self.workers and time.perf_counter() - started < timeout:
+            pids.update(await asyncio.gather(*[loop.run_in_executor(self.executor, worker_ready) for _ in range(self.workers)]))
+        logger.info(f'Executor pool {self.name}: {len(pids)}/{self.workers} workers ready in {time.perf_counter() - started:.2f}s')
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.inflight - self.workers)
+
+    def stats(self) -> dict:
+        self._tick()
+        return {
+            'workers': self.workers,
+            'inflight': self.inflight,
+            'queued': self.queued,
+            'utilization': min(self.inflight, self.workers) / self.workers,
+            'busy_seconds': round(self.busy_seconds, 3),
+            'completed': self.completed,
+        }
+
+class Pools():
+    """
+    one pool per kind of task so slow network calls don't hold the workers cpu bound work needs
+    - cpu: textrank fit (compress, lessions), the deprecated /video, workers preload the nlp models and return packed results
+    - llm: completion and dictionary calls of the llm stages
+    - io: yt-dlp, temp files and job store reads of request handlers, reshaping subtitles
+
+    without cpu (api-ingest role, see roles) there is no process pool and cpu is None
+    """
+    def __init__(self, cpu=True):
+        self.cpu = None
+        if cpu:
+            # workers replaced after max_tasks_per_child run the initializer too
+            executor = ProcessPoolExecutor(CPU_WORKERS, initializer=warm_worker, max_tasks_per_child=CPU_MAX_TASKS_PER_CHILD or None)
+            self.cpu = Pool('cpu', executor, CPU_WORKERS, packed=True)
+        self.llm = Pool('llm', ThreadPoolExecutor(LLM_WORKERS, thread_name_prefix='llm'), LLM_WORKERS)
+        self.io = Pool('io', ThreadPoolExecutor(IO_WORKERS, thread_name_prefix='io'), IO_WORKERS)
+        logger.info(f'Executor pools: cpu={CPU_WORKERS if cpu else 0} processes, llm={LLM_WORKERS} threads, io={IO_WORKERS} threads')
+
+    async def start(self):
+        if CPU_PREFORK and self.cpu is not None:
+            await self.cpu.prefork()
+
+    def all(self) -> list[Pool]:
+        return [p for p in (self.cpu, self.llm, self.io) if p is not None]
+
+    def stats(self) -> dict:
+        return {p.name: p.stats() for p in self.all()}
+
+    def gauges(self) -> dict:
+        """
+        flat gauges for /metrics, e.g. executor_cpu_queued
+        """
+        return {f'executor_{name}_{k}': v for name, s in self.stats().items() for k, v in s.items()}
+
+    def shutdown(self):
+        for p in self.all():
+            p.executor.shutdown()
@@ -0,0 +1,132 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from ..db.crud import pack, unpack
+from .roles import SHARED_JOBS
+
+logger = logging.getLogger('uvicorn.error')
+
+JOB_STORE_PATH = os.environ.get('JOB_STORE_PATH', 'app/data/jobs.db')
+JOB_DATA_INLINE = int(os.environ.get('JOB_DATA_INLINE', 16 * 1024)) # packed bytes kept in memory, larger stage data goes to the store
+INGEST_CLAIM_TIMEOUT = int(os.environ.get('INGEST_CLAIM_TIMEOUT', 3600)) # a claimed video not acked by then is claimed again (worker died)
+
+class JobStore():
+    """
+    stage data too large to stay in the broker's jobs dict, packed (zlib json) and keyed by job uid and stage
+    with SHARED_JOBS (see roles) it also holds the ingest queue and the state of jobs, shared by api-ingest and workers
+    """
+    def __init__(self, path=JOB_STORE_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # shared by the io pool threads, never called from the event loop
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # job states are written on every stage transition, no fsync per commit (still consistent with WAL)
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stage_data (uid TEXT NOT NULL, stage TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (uid, stage)) WITHOUT ROWID')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS job_state (uid TEXT PRIMARY KEY, brief BLOB NOT NULL, updated_at REAL NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS ingest_queue (uid TEXT PRIMARY KEY, payload TEXT NOT NULL, enqueued_at REAL NOT NULL, claimed_by TEXT, claimed_at REAL)')
+        self.conn.commit()
+
+    def put(self, uid, stage, packed: bytes):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO stage_data (uid, stage, data) VALUES (?, ?, ?)', (uid, stage, packed))
+            self.conn.commit()
+
+    def get(self, uid, stage):
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM stage_data WHERE uid = ? AND stage = ?', (uid, stage)).fetchone()
+        return unpack(row[0]) if row else None
+
+    def delete(self, uid):
+        self.delete_many([uid])
+
+    def delete_many(self, uids):
+        rows = [(uid,) for uid in uids]
+        with self.lock:
+            self.conn.executemany('DELETE FROM stage_data WHERE uid = ?', rows)
+            self.conn.executemany('DELETE FROM job_state WHERE uid = ?', rows)
+            self.conn.commit()
+
+    def put_state(self, uid, brief: dict):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO job_state (uid, brief, updated_at) VALUES (?, ?, ?)', (uid, pack(brief), time.time()))
+            self.conn.commit()
+
+    def get_state(self, uid) -> dict | None:
+        with self.lock:
+            row = self.conn.execute('SELECT brief FROM job_state WHERE uid = ?', (uid,)).fetchone()
+        return unpack(row[0]) if row else None
+
+    def enqueue(self, uid, payload: dict):
+        """
+        queue a video for the workers, queuing it again resets its claim
+        """
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO ingest_queue (uid, payload, enqueued_at, claimed_by, claimed_at) VALUES (?, ?, ?, NULL, NULL)',
+                (uid, json.dumps(payload), time.time())
+            )
+            self.conn.commit()
+
+    def claim(self, worker, timeout=INGEST_CLAIM_TIMEOUT) -> tuple[str, dict] | None:
+        """
+        oldest queued video not claimed (or whose claim timed out), None if the queue is empty
+        the write lock is taken up front so two workers can't claim the same video
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute(
+                    'SELECT uid, payload FROM ingest_queue WHERE claimed_by IS NULL OR claimed_at < ? ORDER BY enqueued_at LIMIT 1',
+                    (now - timeout,)
+                ).fetchone()
+                if row:
+                    self.conn.execute('UPDATE ingest_queue SET claimed_by = ?, claimed_at = ? WHERE uid = ?', (worker, now, row[0]))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+        return (row[0], json.loads(row[1])) if row else None
+
+    def ack(self, uid):
+        with self.lock:
+            self.conn.execute('DELETE FROM ingest_queue WHERE uid = ?', (uid,))
+            self.conn.commit()
+
+    def queue_depth(self) -> dict:
+        with self.lock:
+            queued, claimed = self.conn.execute('SELECT COUNT(*) - COUNT(claimed_by), COUNT(claimed_by) FROM ingest_queue').fetchone()
+        return {'queued': queued, 'claimed': claimed}
+
+_store: JobStore | None = None
+
+def get_job_store() -> JobStore:
+    global _store
+    if _store is None:
+        _store = JobStore()
+    return _store
+
+def offload(uid, stage, data) -> tuple[int, bool]:
+    """
+    store data if it is too large to keep inline, return (packed size, whether it was stored)
+    the size is 0 when there is no data or it is not serializable, it stays in memory then
+    """
+    if data is None:
+        return 0, False
+    try:
+        packed = pack(data)
+    except (TypeError, ValueError) as e:
+        logger.warning(f'Stage data {uid}/{stage} is not serializable, kept in memory: {e}')
+        return 0, False
+    # shared jobs keep nothing inline, api-ingest reads stage data of jobs run by workers from the store
+    if len(packed) <= JOB_DATA_INLINE and not SHARED_JOBS:
+        return len(packed), False
+    get_job_store().put(uid, stage, packed)
+    return len(packed), True
@@ -0,0 +1,26 @@
+"""
+Process roles, set with APP_ROLE, so read traffic and ingest scale separately
+
+- all: every endpoint and the ingest pipeline in one process (default)
+- api-read: read endpoints only (/video, /video/level, /video/topic, /reading, /listening, /subtitle),
+  no broker, no executor pools, no nlp library
+- api-ingest: ingest, status and batch endpoints, videos are extracted then queued for the workers, no cpu pool
+- worker: claims queued videos and runs their pipeline (cpu, llm and io pools), serves health, readiness, metrics
+  and admin endpoints only
+
+api-ingest and worker processes share the job store (JOB_STORE_PATH) and the database (DB_PATH), the queue and
+the state of running jobs are kept in the job store, see broker.enqueue_job and proto.consume_ingest_queue
+"""
+import os
+
+ROLES = ('all', 'api-read', 'api-ingest', 'worker')
+
+APP_ROLE = os.environ.get('APP_ROLE', 'all')
+if APP_ROLE not in ROLES:
+    raise ValueError(f'APP_ROLE must be one of {', '.join(ROLES)}, got {APP_ROLE}')
+
+SERVES_READS = APP_ROLE in ('all', 'api-read')
+SERVES_INGEST = APP_ROLE in ('all', 'api-ingest')
+RUNS_PIPELINE = APP_ROLE in ('all', 'worker')
+# jobs go through the ingest queue, their state and stage data through the job store
+SHARED_JOBS = APP_ROLE in ('api-ingest', 'worker')
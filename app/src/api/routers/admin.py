@@ -0,0 +1,45 @@
+from fastapi import APIRouter, Query, Depends, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from ..dependencies import require_admin
+from ...components.profiling import profile_window, PROFILE_SAMPLE_INTERVAL, PROFILE_BLOCKING_THRESHOLD
+
+router = APIRouter(
+    prefix='/nlp/api/admin',
+    tags=['admin'],
+    dependencies=[Depends(require_admin)],
+    responses={404: {'description': 'Not Found'}}
+)
+
+PROFILE_MAX_SECONDS = 300
+
+@router.post('/profile')
+async def profile(
+    mode: str = Query('sample', pattern='^(sample|cprofile)$', description='sample: stack sampling | cprofile: deterministic'),
+    seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+    interval: float = Query(PROFILE_SAMPLE_INTERVAL, ge=0.001, le=1, description='seconds between two samples'),
+    threshold: float = Query(PROFILE_BLOCKING_THRESHOLD, ge=0.01, description='seconds without a loop tick reported as blocking'),
+    format: str = Query('json', pattern='^(json|collapsed)$'),
+):
+    """
+    Profile this worker and the process pool tasks started during the next seconds, answered when the window closes
+    (plus up to 10s for pool tasks still running). Requires the x-admin-token header matching ADMIN_TOKEN.
+
+    Output (json):
+    - samples, stacks: number of samples and distinct stacks (sample mode)
+    - top: functions by cumulative time (cprofile mode)
+    - worker_tasks, workers: pool tasks profiled, by worker pid
+    - loop_lag: p50/p99/max lateness of the event loop
+    - blocking: stacks of the loop thread when it did not tick for threshold seconds, with how long it was blocked
+
+    With format=collapsed (sample mode), the stacks as text for flamegraph.pl or speedscope
+    """
+    if format == 'collapsed' and mode != 'sample':
+        raise HTTPException(400, 'Collapsed stacks need sample mode')
+    try:
+        window, report = await profile_window(mode, seconds, interval, threshold)
+    except RuntimeError as e:
+        raise HTTPException(409, str(e))
+    if format == 'collapsed':
+        return PlainTextResponse(window.collapsed())
+    return report
@@ -1,18 +1,27 @@
 from typing import Annotated
+from uuid import uuid4
+import asyncio
 import json
+import time
 
-from fastapi import APIRouter, Query, Depends, HTTPException, Request, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Query, Depends, HTTPException, Request, BackgroundTasks, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
 
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from ...db import schemas, crud, models
+from ...db.database import SessionLocal
 from ...components.extractor import extract_url, gpt
+from ...components.utils import get_id_from_playlist, get_channel_info, get_video_id
 from ..dependencies import *
 from ..broker import *
+from ..job_store import get_job_store
+from ..roles import SHARED_JOBS
 
 logger = logging.getLogger('uvicorn.error')
 
+SHARED_POLL_INTERVAL = float(os.environ.get('SHARED_POLL_INTERVAL', 1.0)) # seconds between reads of a job run by a worker, or of an empty queue
+
 router = APIRouter(
     prefix='/nlp/api',
     tags=['prototype'],
@@ -26,56 +35,135 @@ async def test_depend(q: str):
 async def test(et: Annotated[dict, Depends(test_depend)]):
     return et
 
-async def start_video_insert_task(executor, vid, params, retry=False):
+async def run_llm_stage(pools, vid, stage, fn, *args):
+    if LLM_STREAM:
+        return await run_with_partial(pools.llm, vid, stage, fn, *args)
+    return await run_stage(pools.llm, vid, stage, fn, *args)
+
+async def start_video_insert_task(pools, vid, params, retry=False):
+    started = time.time()
+    try:
+        await run_video_stages(pools, vid, params, retry)
+    except Exception as e:
+        # a job left in progress would never be evicted and would block new requests for the video
+        # (cancellation is let through, a worker resumes the stages of a claimed job that did not finish)
+        logging.error(f'Failed video [{vid}]: {traceback.format_exc()}')
+        for s in jobs[vid].states.values():
+            if s.status == Status.IN_PROGRESS:
+                s.status = Status.FAILED
+    for k, s in jobs[vid].states.items():
+        if s.status == Status.FAILED:
+            jobs[vid].status = Status.FAILED
+            logging.warning(f'Task {k}: Failed')
+    if jobs[vid].status != Status.FAILED:
+        jobs[vid].status = Status.COMPLETED
+        logging.info('All tasks completed')
+    if SHARED_JOBS:
+        await mirror(pools.io, vid)
+    await finish_trace(vid, started)
+
+async def run_video_stages(pools, vid, params, retry=False):
     if jobs[vid].states['subtitles'].status == Status.IN_PROGRESS or (jobs[vid].states['subtitles'].status == Status.FAILED and retry):
+        jobs[vid].states['subtitles'].start()
         try:
-            jobs[vid].states['subtitles'].data = await run_in_process(executor, extract_subs, params['subs'])
+            jobs[vid].states['subtitles'].data = await run_stage(pools.io, vid, 'subtitles', extract_subs, params['subs'])
         except Exception as e:
             jobs[vid].states['subtitles'].status = Status.FAILED
             logging.error(f'Failed task subtitles: {e}')
         else:
             jobs[vid].states['subtitles'].status = Status.COMPLETED
+        await persist_stage(pools.io, vid, 'subtitles')
+
+    if jobs[vid].states['compress'].status == Status.IN_PROGRESS or (jobs[vid].states['compress'].status == Status.FAILED and retry):
+        jobs[vid].states['compress'].start()
+        if LLM_COMPRESS:
+            try:
+                compressed = await run_stage(pools.cpu, vid, 'compress', compress_text, params['text'])
+            except Exception as e:
+                jobs[vid].states['compress'].status = Status.FAILED
+                logging.error(f'Failed task compress: {e}')
+            else:
+                jobs[vid].states['compress'].data = compressed
+                jobs[vid].states['compress'].status = Status.COMPLETED
+                logging.info(f'Task compress: prompt tokens saved per stage {compressed['saved']}')
+        else:
+            jobs[vid].states['compress'].status = Status.COMPLETED
+        await persist_stage(pools.io, vid, 'compress')
 
-    if jobs[vid].states['topic_level'].status == Status.IN_PROGRESS or (jobs[vid].states['topic_level'].status == Status.FAILED and retry):
+    # Fall back to the full transcript when compression is disabled or failed
+    compressed = await load_stage(pools.io, vid, 'compress') or {}
+    short_text = compressed.get('text') or params['text']
+
+    # Stage prompts are retried below only in stage mode, fused mode retries failed sections by itself
+    stage_retry = retry and LLM_MODE != 'fused'
+    fused_stages = {'topic_level': 'topic_level', 'summarize': 'summa', 'vocabulary': 'vocab', 'questions': 'questions'}
+    pending = [k for k in fused_stages if jobs[vid].states[k].status == Status.IN_PROGRESS or (jobs[vid].states[k].status == Status.FAILED and retry)]
+    if LLM_MODE == 'fused' and pending:
+        for k in pending:
+            jobs[vid].states[k].start()
         try:
-            jobs[vid].states['topic_level'].data = await run_in_process(executor, extract_topic_level, vid,  params['text'])
+            processed, errors = await run_stage(pools.llm, vid, 'fused', extract_fused, vid, short_text, compressed.get('candidates'))
+        except Exception as e:
+            processed, errors = {}, {v: str(e) for v in fused_stages.values()}
+        for k in pending:
+            if processed.get(fused_stages[k]):
+                jobs[vid].states[k].data = processed[fused_stages[k]]
+                jobs[vid].states[k].status = Status.COMPLETED
+            else:
+                jobs[vid].states[k].status = Status.FAILED
+                logging.error(f'Failed task {k}: {errors.get(fused_stages[k])}')
+            await persist_stage(pools.io, vid, k)
+
+    if jobs[vid].states['topic_level'].status == Status.IN_PROGRESS or (jobs[vid].states['topic_level'].status == Status.FAILED and stage_retry):
+        jobs[vid].states['topic_level'].start()
+        try:
+            jobs[vid].states['topic_level'].data = await run_stage(pools.llm, vid, 'topic_level', extract_topic_level, vid, short_text)
         except Exception as e:
             jobs[vid].states['topic_level'].status = Status.FAILED
             logging.error(f'Failed task topic_level: {e}')
         else:
             jobs[vid].states['topic_level'].status = Status.COMPLETED
+        await persist_stage(pools.io, vid, 'topic_level')
 
-    if jobs[vid].states['summarize'].status == Status.IN_PROGRESS or (jobs[vid].states['summarize'].status == Status.FAILED and retry):
+    if jobs[vid].states['summarize'].status == Status.IN_PROGRESS or (jobs[vid].states['summarize'].status == Status.FAILED and stage_retry):
+        jobs[vid].states['summarize'].start()
         try:
-            jobs[vid].states['summarize'].data = await run_in_process(executor, extract_summa, vid,  params['text'])
+            jobs[vid].states['summarize'].data = await run_llm_stage(pools, vid, 'summarize', extract_summa, vid, short_text)
         except Exception as e:
             jobs[vid].states['summarize'].status = Status.FAILED
             logging.error(f'Failed task summarize: {e}')
         else:
             jobs[vid].states['summarize'].status = Status.COMPLETED
+        await persist_stage(pools.io, vid, 'summarize')
 
-    if jobs[vid].states['vocabulary'].status == Status.IN_PROGRESS or (jobs[vid].states['vocabulary'].status == Status.FAILED and retry):
+    if jobs[vid].states['vocabulary'].status == Status.IN_PROGRESS or (jobs[vid].states['vocabulary'].status == Status.FAILED and stage_retry):
+        jobs[vid].states['vocabulary'].start()
         try:
-            jobs[vid].states['vocabulary'].data = await run_in_process(executor, extract_vocab, vid,  params['text'])
+            jobs[vid].states['vocabulary'].data = await run_stage(pools.llm, vid, 'vocabulary', extract_vocab, vid, short_text, compressed.get('candidates'))
         except Exception as e:
             jobs[vid].states['vocabulary'].status = Status.FAILED
             logging.error(f'Failed task vocabulary: {e}')
         else:
             jobs[vid].states['vocabulary'].status = Status.COMPLETED
+        await persist_stage(pools.io, vid, 'vocabulary')
 
-    if jobs[vid].states['questions'].status == Status.IN_PROGRESS or (jobs[vid].states['questions'].status == Status.FAILED and retry):
+    if jobs[vid].states['questions'].status == Status.IN_PROGRESS or (jobs[vid].states['questions'].status == Status.FAILED and stage_retry):
+        jobs[vid].states['questions'].start()
         try:
-            jobs[vid].states['questions'].data = await run_in_process(executor, extract_questions, vid,  params['text'])
+            jobs[vid].states['questions'].data = await run_llm_stage(pools, vid, 'questions', extract_questions, vid,  params['text'])
         except Exception as e:
             jobs[vid].states['questions'].status = Status.FAILED
             logging.error(f'Failed task questions: {e}')
         else:
             jobs[vid].states['questions'].status = Status.COMPLETED
+        await persist_stage(pools.io, vid, 'questions')
 
     if jobs[vid].states['lessions'].status == Status.IN_PROGRESS or (jobs[vid].states['lessions'].status == Status.FAILED and retry):
-        if jobs[vid].states['questions'].data:
+        jobs[vid].states['lessions'].start()
+        if jobs[vid].states['questions'].status == Status.COMPLETED:
             try:
-                jobs[vid].states['lessions'].data = await run_in_process(executor, extract_lessions, vid, params['text'], jobs[vid].states['questions'].data['questions'])
+                questions = await load_stage(pools.io, vid, 'questions')
+                jobs[vid].states['lessions'].data = await run_stage(pools.cpu, vid, 'lessions', extract_lessions, vid, params['text'], questions['questions'], compressed or None)
             except Exception as e:
                 jobs[vid].states['lessions'].status = Status.FAILED
                 logging.error(f'Failed task lessions: {e}')
@@ -84,19 +172,26 @@ async def start_video_insert_task(executor, vid, params, retry=False):
         else:
             jobs[vid].states['lessions'].status = Status.FAILED
             logging.error(f'Failed task lessions: task questions failed')
+        await persist_stage(pools.io, vid, 'lessions')
 
     if jobs[vid].states['insert_video'].status == Status.IN_PROGRESS or (jobs[vid].states['insert_video'].status == Status.FAILED and retry):
+        jobs[vid].states['insert_video'].start()
         if jobs[vid].states['info'].status == Status.COMPLETED and jobs[vid].states['topic_level'].status == Status.COMPLETED and jobs[vid].states['summarize'].status == Status.COMPLETED:
             try:
+                info = await load_stage(pools.io, vid, 'info')
+                topic_level = await load_stage(pools.io, vid, 'topic_level')
+                summa = await load_stage(pools.io, vid, 'summarize')
+                if params.get('force'):
+                    await crud.delete_video(params['db'], info['url_id'])
                 v = schemas.VideoCreate(
-                    url_id=jobs[vid].states['info'].data['url_id'],
-                    video_title=jobs[vid].states['info'].data['video_title'],
-                    length=jobs[vid].states['info'].data['length'],
-                    thumbnail=jobs[vid].states['info'].data['thumbnail'],
-                    channel=jobs[vid].states['info'].data['channel'],
-                    topic=jobs[vid].states['topic_level'].data['topic'],
-                    level=jobs[vid].states['topic_level'].data['level'],
-                    summa=jobs[vid].states['summarize'].data['summarize']
+                    url_id=info['url_id'],
+                    video_title=info['video_title'],
+                    length=info['length'],
+                    thumbnail=info['thumbnail'],
+                    channel=info['channel'],
+                    topic=topic_level['topic'],
+                    level=topic_level['level'],
+                    summa=summa['summarize']
                 )
                 v_model: models.Videos | None = await crud.create_video(params['db'], v)
             except Exception as e:
@@ -122,13 +217,17 @@ async def start_video_insert_task(executor, vid, params, retry=False):
         else:
             jobs[vid].states['insert_video'].status = Status.FAILED
             logging.error(f'Failed task insert_video: prerequisite tasks failed')
+        await persist_stage(pools.io, vid, 'insert_video')
             
     if jobs[vid].states['insert_subs'].status == Status.IN_PROGRESS or (jobs[vid].states['insert_subs'].status == Status.FAILED and retry):
+        jobs[vid].states['insert_subs'].start()
         if jobs[vid].states['subtitles'].status == Status.COMPLETED and jobs[vid].states['insert_video'].status == Status.COMPLETED:
             try:
+                subtitles = await load_stage(pools.io, vid, 'subtitles')
+                video = await load_stage(pools.io, vid, 'insert_video')
                 s = schemas.SubtitlesCreate(
-                    auto=jobs[vid].states['subtitles'].data['auto'],
-                    video_id=jobs[vid].states['insert_video'].data['id']
+                    auto=subtitles['auto'],
+                    video_id=video['id']
                 )
                 sub_model: models.Subtitles | None = await crud.create_subtitle(params['db'], s)
             except Exception as e:
@@ -141,11 +240,12 @@ async def start_video_insert_task(executor, vid, params, retry=False):
                 else:
                     try:
                         sub_id = sub_model.id
+                        subtitle = schemas.Subtitles(auto=sub_model.auto, video_id=sub_model.video_id, id=sub_id).model_dump()
                         jobs[vid].states['insert_subs'].data = {
-                            'subtitle': schemas.Subtitles(auto=sub_model.auto, video_id=sub_model.video_id, id=sub_id)
+                            'subtitle': subtitle
                         }
 
-                        l = [schemas.SubtitleLinesCreate(sub_id=sub_id, **s) for s in jobs[vid].states['subtitles'].data['lines']]
+                        l = [schemas.SubtitleLinesCreate(sub_id=sub_id, **s) for s in subtitles['lines']]
                         line_model: list[models.Lines] | None = await crud.create_sub_lines(params['db'], l)
                     except Exception as e:
                         jobs[vid].states['insert_subs'].status = Status.FAILED
@@ -155,20 +255,28 @@ async def start_video_insert_task(executor, vid, params, retry=False):
                             jobs[vid].states['insert_subs'].status = Status.FAILED
                             logging.error(f'Failed task insert_subs: database failed')
                         else:
+                            # assigned whole, the lines go to the job store with the rest once the stage finished
+                            jobs[vid].states['insert_subs'].data = {
+                                'subtitle': subtitle,
+                                'lines': [schemas.SubtitleLines(
+                                    sub_id=s.sub_id, start=s.start, end=s.end, text=s.text, id=s.id
+                                ).model_dump() for s in line_model]
+                            }
                             jobs[vid].states['insert_subs'].status = Status.COMPLETED
-                            jobs[vid].states['insert_subs'].data['lines'] = [schemas.SubtitleLines(
-                                sub_id=s.sub_id, start=s.start, end=s.end, text=s.text, id=s.id
-                            ) for s in line_model]
         else:
             jobs[vid].states['insert_subs'].status = Status.FAILED
             logging.error(f'Failed task insert_subs: prerequisite tasks failed')
+        await persist_stage(pools.io, vid, 'insert_subs')
 
     if jobs[vid].states['insert_vocabs'].status == Status.IN_PROGRESS or (jobs[vid].states['insert_vocabs'].status == Status.FAILED and retry):
+        jobs[vid].states['insert_vocabs'].start()
         if jobs[vid].states['vocabulary'].status == Status.COMPLETED and jobs[vid].states['insert_video'].status == Status.COMPLETED:
             res = []
             try:
                 failed = False
-                for v in jobs[vid].states['vocabulary'].data['vocab']:
+                vocabulary = await load_stage(pools.io, vid, 'vocabulary')
+                video = await load_stage(pools.io, vid, 'insert_video')
+                for v in vocabulary['vocab']:
                     vocab_model: models.Vocabs | None = await crud.create_vocab(params['db'], schemas.VocabCreate(**v['vocab']))
                     
                     if not vocab_model:
@@ -180,7 +288,7 @@ async def start_video_insert_task(executor, vid, params, retry=False):
                     ipa = vocab_model.ipa
 
                     sense_model: models.Senses | None = await crud.create_sense(params['db'], schemas.SenseCreate(
-                        video_id=jobs[vid].states['insert_video'].data['id'],
+                        video_id=video['id'],
                         vocab_id=vocab_id,
                         **v['sense']
                     ))
@@ -214,15 +322,19 @@ async def start_video_insert_task(executor, vid, params, retry=False):
         else:
             jobs[vid].states['insert_vocabs'].status = Status.FAILED
             logging.error(f'Failed task insert_vocabs: prerequisite tasks failed')
+        await persist_stage(pools.io, vid, 'insert_vocabs')
 
     if jobs[vid].states['insert_lessions'].status == Status.IN_PROGRESS or (jobs[vid].states['insert_lessions'].status == Status.FAILED and retry):
+        jobs[vid].states['insert_lessions'].start()
         if jobs[vid].states['lessions'].status == Status.COMPLETED and jobs[vid].states['insert_video'].status == Status.COMPLETED:
             res = {
                 'reading': None,
                 'listening': None
             }
             try:
-                rl = schemas.LessionCreate(video_id=jobs[vid].states['insert_video'].data['id'], type=0)
+                video = await load_stage(pools.io, vid, 'insert_video')
+                lessions = await load_stage(pools.io, vid, 'lessions')
+                rl = schemas.LessionCreate(video_id=video['id'], type=0)
                 rl_model: models.Lessions | None = await crud.create_lession(params['db'], rl)
                 
                 if not rl_model:
@@ -230,7 +342,7 @@ async def start_video_insert_task(executor, vid, params, retry=False):
                 
                 rl_id = rl_model.id
                 rl_qs = []
-                for q in jobs[vid].states['lessions'].data['reading']:
+                for q in lessions['reading']:
                     question = schemas.QuestionCreate(question=q['question'], type=q['type'], lession_id=rl_id)
                     question_model: models.Questions | None = await crud.create_question(params['db'], question)
                     if not rl_model:
@@ -255,7 +367,7 @@ async def start_video_insert_task(executor, vid, params, retry=False):
                     })
                 res['reading'] = rl_qs
 
-                ll = schemas.LessionCreate(video_id=jobs[vid].states['insert_video'].data['id'], type=1)
+                ll = schemas.LessionCreate(video_id=video['id'], type=1)
                 ll_model: models.Lessions | None = await crud.create_lession(params['db'], ll)
                 
                 if not ll_model:
@@ -263,7 +375,7 @@ async def start_video_insert_task(executor, vid, params, retry=False):
                 
                 ll_id = ll_model.id
                 ll_qs = []
-                for q in jobs[vid].states['lessions'].data['listening']:
+                for q in lessions['listening']:
                     question = schemas.QuestionCreate(question=q['question'], type=q['type'], lession_id=ll_id)
                     question_model: models.Questions | None = await crud.create_question(params['db'], question)
                     if not question_model:
@@ -297,13 +409,71 @@ async def start_video_insert_task(executor, vid, params, retry=False):
         else:
             jobs[vid].states['insert_lessions'].status = Status.FAILED
             logging.error(f'Failed task insert_lession: prerequisite tasks failed')
-    for k, s in jobs[vid].states.items():
-        if s.status == Status.FAILED:
-            jobs[vid].status = Status.FAILED
-            logging.warning(f'Task {k}: Failed')
-    if jobs[vid].status != Status.FAILED:
-        jobs[vid].status = Status.COMPLETED
-        logging.info('All tasks completed')
+        await persist_stage(pools.io, vid, 'insert_lessions')
+
+def new_video_job(vid_info) -> Job:
+    info = {
+        'url_id': vid_info['video_id'],
+        'video_title': vid_info['video_title'],
+        'length': vid_info['length'],
+        'thumbnail': vid_info['thumbnail'],
+        'channel': vid_info['channel'],
+    }
+    return Job(
+        uid=vid_info['video_id'],
+        states= {
+            'info': Result(
+                status=Status.COMPLETED,
+                data=info
+            ),
+            'subtitles': Result(),
+            'compress': Result(),
+            'topic_level': Result(),
+            'summarize': Result(),
+            'vocabulary': Result(),
+            'questions': Result(),
+            'lessions': Result(),
+            'insert_video': Result(),
+            'insert_subs': Result(),
+            'insert_vocabs': Result(),
+            'insert_lessions': Result()
+        }
+    )
+
+def build_params(db, subs, text=None):
+    return {
+        'db': db,
+        'subs': subs,
+        'text': text if text is not None else ' '.join([s['text'] for s in subs])
+    }
+
+async def save_transcript(db, vid, params):
+    """
+    persist raw subtitle lines and prompt text so retries don't need to extract from youtube again
+    """
+    transcript = schemas.TranscriptCreate(url_id=vid, text=params['text'], lines=params['subs'])
+    if not await crud.create_transcript(db, transcript):
+        logging.warning(f'Failed to save transcript of video [{vid}]')
+
+async def load_params(db, pools, vid):
+    transcript = await crud.get_transcript(db, vid)
+    if transcript:
+        return build_params(db, transcript.lines, transcript.text)
+    _, subs = await pools.io.run(extract_url, f'https://www.youtube.com/watch?v={vid}')
+    params = build_params(db, subs)
+    await save_transcript(db, vid, params)
+    return params
+
+async def get_brief(pools, uid, include=()) -> dict | None:
+    """
+    brief of a job run by this process or, with SHARED_JOBS, by a worker, None if there is no such job
+    """
+    if uid in jobs:
+        # offloaded stage data is read back from the job store
+        return await pools.io.run(jobs[uid].brief, include) if include else jobs[uid].brief()
+    if SHARED_JOBS:
+        return await pools.io.run(shared_brief, uid, include)
+    return None
 
 @router.post('/video/create')
 async def start_task(
@@ -315,16 +485,19 @@ async def start_task(
     """
     Input:
     :param url: Youtube video URL
+    :param force: Process again even if the video is already in db (its previous entries are replaced)
 
-    Output:
+    Output (202):
     - uid: Used for status checking
     - states: List of state of each step:
         - status: 0 -> COMPLETED | 1 -> IN_PROGRESS | 2 -> FAILED
-        - data
+        - started_at, elapsed: timing of the step
+        - data: only for info, use **/video/status** with include for other steps
     
     Create necessary entries to insert to db:
     - **info**: Extract basic video info
     - **subtitles**: Extract and parse subtitles
+    - **compress**: Keep top ranked sentences and keywords to shorten prompts (only when LLM_COMPRESS=1)
     - **topic_level**: Call to GPT API to extract topic and cefr level
     - **summarize**: Call to GPT API to extract summarization
     - **vocabulary**: Call to GPT API to extract vocabulary
@@ -334,51 +507,302 @@ async def start_task(
     - **insert_subs**: Insert subtitle entry to db
     - **insert_vocabs**: Insert vocabulary entry to db
     - **insert lessions**: Insert lession entry to db
+
+    A request for a video already being processed returns its task, a video already in db is returned
+    right away (200) as {uid, status, video} unless force is set
     """
-    vid_info, subs = extract_url(url.url)
-    vid = vid_info['video_id']
-    info = {
-        'url_id': vid_info['video_id'],
-        'video_title': vid_info['video_title'],
-        'length': vid_info['length'],
-        'thumbnail': vid_info['thumbnail'],
-        'channel': vid_info['channel'],
-    }
-    new_task = Job(
-        uid=vid,
-        states= {
-            'info': Result(
-                status=Status.COMPLETED,
-                data=info
-            ),
-            'subtitles': Result(),
-            'topic_level': Result(),
-            'summarize': Result(),
-            'vocabulary': Result(),
-            'questions': Result(),
-            'lessions': Result(),
-            'insert_video': Result(),
-            'insert_subs': Result(),
-            'insert_vocabs': Result(),
-            'insert_lessions': Result()
-        }
-    )
+    pools = req.app.state.pools
+    vid = get_video_id(url.url)
+    brief = await get_brief(pools, vid)
+    if url.force and (vid in flights or (brief and brief['status'] == Status.IN_PROGRESS)):
+        raise HTTPException(409, 'Video is being processed')
+    code, res, params = await register_video_job(db, pools, vid, url.url, url.force)
+    if params is not None and not SHARED_JOBS:
+        background_task.add_task(start_video_insert_task, pools, vid, params)
+    return JSONResponse(res, code)
 
-    params = {
-        'db': db,
-        'subs': subs,
-        'text': ' '.join([s['text'] for s in subs])
-    }
+async def register_video_job(db, pools, vid, url, force=False) -> tuple[int, dict, dict | None]:
+    """
+    single flight registration of a video ingest, shared by /video/create and batches
+    return (status code, response, params), params is None unless a new job was registered:
+    - 202, brief of the job in progress: a concurrent request for the same video attaches to its job
+    - 200, {uid, status, video}: the video is already in db (unless force)
+    - 202, brief of the new job: registered in jobs (to be run by the caller) or queued for the workers with SHARED_JOBS
+    """
+    while vid in flights:
+        await asyncio.shield(flights[vid])
+    brief = await get_brief(pools, vid, ('info',))
+    if brief and brief['status'] == Status.IN_PROGRESS:
+        return 202, brief, None
+
+    flight = asyncio.get_running_loop().create_future()
+    flights[vid] = flight
+    try:
+        if not force:
+            v_model = await crud.get_video_by_url_id(db, vid)
+            if v_model:
+                return 200, {
+                    'uid': vid,
+                    'status': Status.COMPLETED,
+                    'video': schemas.Video(**v_model.model_dump()).model_dump()
+                }, None
+        else:
+            await pools.io.run(clear_temp_file, vid)
+
+        vid_info, subs = await pools.io.run(extract_url, url)
+        new_task = new_video_job(vid_info)
+        res = new_task.brief(('info',))
+        params = build_params(db, subs)
+        params['force'] = force
+        await save_transcript(db, vid, params)
+        if SHARED_JOBS:
+            # run by a worker, see consume_ingest_queue
+            await pools.io.run(enqueue_job, new_task, {'force': force})
+        else:
+            jobs[vid] = new_task
+    finally:
+        flights.pop(vid, None)
+        flight.set_result(None)
+    return 202, res, params
+
+async def archive_jobs(summaries) -> bool:
+    """
+    keep summaries of jobs evicted from memory, used by the broker sweeper
+    """
+    archives = [schemas.JobArchiveCreate(
+        uid=j['uid'],
+        status=j['status'],
+        created_at=j['created_at'],
+        finished_at=j['finished_at'],
+        states=json.loads(json.dumps(j['states']))
+    ) for j in summaries]
+    async with SessionLocal() as db:
+        return await crud.create_job_archives(db, archives) is not None
 
-    jobs[vid] = new_task
-    background_task.add_task(start_video_insert_task, req.app.state.executor, vid, params)
-    return JSONResponse(new_task.model_dump(), 202)
+async def run_claimed_job(pools, vid, payload):
+    brief = await pools.io.run(get_job_store().get_state, vid)
+    if brief is None:
+        logger.warning(f'Queued video [{vid}] has no job state, dropped')
+        return
+    jobs[vid] = Job.from_brief(brief)
+    async with SessionLocal() as db:
+        try:
+            params = await load_params(db, pools, vid)
+        except Exception as e:
+            logger.error(f'Failed to load transcript of video [{vid}]: {e}')
+            jobs[vid].status = Status.FAILED
+            await mirror(pools.io, vid)
+            return
+        params['force'] = payload.get('force', False)
+        jobs[vid].status = Status.IN_PROGRESS
+        await mirror(pools.io, vid)
+        await start_video_insert_task(pools, vid, params, payload.get('retry', False))
+
+async def consume_ingest_queue(pools, worker):
+    """
+    worker role: claim videos queued by api-ingest from the job store and run their pipeline, one at a time
+    the job state is mirrored to the store whenever a stage finishes (see broker.persist_stage), so api-ingest can serve its status
+    """
+    store = get_job_store()
+    while True:
+        try:
+            claimed = await pools.io.run(store.claim, worker)
+            if claimed is None:
+                await asyncio.sleep(SHARED_POLL_INTERVAL)
+                continue
+            vid, payload = claimed
+            logger.info(f'Worker {worker} claimed video [{vid}]')
+            try:
+                await run_claimed_job(pools, vid, payload)
+            except Exception as e:
+                logger.error(f'Worker {worker} failed video [{vid}]: {e}')
+                if vid in jobs:
+                    jobs[vid].status = Status.FAILED
+                    await mirror(pools.io, vid)
+            # not acked when cancelled (shutdown), the video is claimed again after INGEST_CLAIM_TIMEOUT
+            # and its job resumes from the stages that did not complete
+            await pools.io.run(store.ack, vid)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'Ingest consumer {worker} failed: {e}')
+            await asyncio.sleep(SHARED_POLL_INTERVAL)
 
 @router.get('/video/status')
 async def task_status(
-    uid: str = Query(description='task uid provided when starting the task')
+    db: Annotated[AsyncSession, Depends(get_db_session)],
+    req: Request,
+    uid: str = Query(description='task uid provided when starting the task'),
+    include: str | None = Query(None, description='comma separated stages to include data of, e.g. info,summarize, or all')
 ):
-    return jobs[uid]
+    """
+    Output:
+    - uid, status, created_at
+    - states: status, started_at, elapsed and has_data of each step, data only for stages in include
+
+    Finished tasks are evicted from memory after JOB_TTL, their archived summary (without data) is returned then
+    """
+    stages = [k.strip() for k in include.split(',')] if include else ()
+    if uid in jobs and 'all' in stages:
+        stages = jobs[uid].states.keys()
+    brief = await get_brief(req.app.state.pools, uid, stages)
+    if brief is None:
+        archive = await crud.get_job_archive(db, uid)
+        if not archive:
+            raise HTTPException(404, 'No task')
+        return {**archive.model_dump(exclude={'id'}), 'archived': True}
+    return brief
+
+EVENT_KEEP_ALIVE = 15
+
+def sse(event, name=None):
+    head = f'event: {name}\n' if name else ''
+    return f'{head}data: {json.dumps(event)}\n\n'
+
+async def job_events(pools, uid, partial_data=False):
+    """
+    yield (name, event) for the job: a compact snapshot, then stage transitions until the job is completed or failed
+    (None, None) is yielded when nothing happened for EVENT_KEEP_ALIVE seconds
+    """
+    q = subscribe(uid)
+    try:
+        yield 'snapshot', jobs[uid].brief()
+        if jobs[uid].status != Status.IN_PROGRESS:
+            return
+        while True:
+            try:
+                event = await asyncio.wait_for(q.get(), EVENT_KEEP_ALIVE)
+            except asyncio.TimeoutError:
+                yield None, None
+                continue
+            if event['partial'] and partial_data:
+                event['data'] = await load_stage(pools.io, uid, event['stage'])
+            yield 'state', event
+            if event['stage'] is None and event['status'] != Status.IN_PROGRESS:
+                break
+    finally:
+        unsubscribe(uid, q)
+
+async def shared_job_events(pools, uid):
+    """
+    job_events of a job run by a worker, its state in the job store is read every SHARED_POLL_INTERVAL
+    only stage transitions are sent, partial results are not
+    """
+    prev = await pools.io.run(shared_brief, uid)
+    yield 'snapshot', prev
+    idle = 0.0
+    while prev['status'] == Status.IN_PROGRESS:
+        await asyncio.sleep(SHARED_POLL_INTERVAL)
+        cur = await pools.io.run(shared_brief, uid)
+        if cur is None:
+            break
+        changed = False
+        for k, s in cur['states'].items():
+            p = prev['states'].get(k, {})
+            if (p.get('status'), p.get('started_at')) != (s['status'], s['started_at']):
+                changed = True
+                yield 'state', {'uid': uid, 't': time.time(), 'stage': k, 'status': s['status'], 'partial': False, 'started_at': s['started_at'], 'elapsed': s['elapsed']}
+        if cur['status'] != Status.IN_PROGRESS:
+            yield 'state', {'uid': uid, 't': time.time(), 'stage': None, 'status': cur['status'], 'partial': False, 'elapsed': round(time.time() - cur['created_at'], 3)}
+        idle = 0.0 if changed else idle + SHARED_POLL_INTERVAL
+        if idle >= EVENT_KEEP_ALIVE:
+            idle = 0.0
+            yield None, None
+        prev = cur
+
+async def status_events(pools, uid, partial_data):
+    """
+    events of a job run by this process or by a worker, None if there is no such job
+    """
+    if uid in jobs:
+        return job_events(pools, uid, partial_data)
+    if SHARED_JOBS and await pools.io.run(get_job_store().get_state, uid) is not None:
+        return shared_job_events(pools, uid)
+    return None
+
+@router.get('/video/status/stream')
+async def task_status_stream(
+    req: Request,
+    uid: str = Query(description='task uid provided when starting the task'),
+    partial_data: bool = Query(False, description='attach data to partial result events')
+):
+    """
+    Server-sent events of a task, instead of polling **/video/status**:
+    - **snapshot**: status and timing of the task and every stage, sent on connect
+    - **state**: a stage (or the task when stage is null) changed status, or got a partial result (partial is true)
+
+    Events carry no stage data, fetch it with **/video/status/data** when needed.
+    The stream ends when the task is completed or failed
+    """
+    job_stream = await status_events(req.app.state.pools, uid, partial_data)
+    if job_stream is None:
+        raise HTTPException(404, 'No task')
+
+    async def events():
+        async for name, event in job_stream:
+            if name is None:
+                if await req.is_disconnected():
+                    break
+                yield ': keep-alive\n\n'
+            else:
+                yield sse(event, name)
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@router.websocket('/video/status/ws')
+async def task_status_ws(
+    ws: WebSocket,
+    uid: str = Query(description='task uid provided when starting the task'),
+    partial_data: bool = Query(False, description='attach data to partial result events')
+):
+    """
+    Same events as **/video/status/stream** as json messages ({"event": name, ...}), the socket is closed when the task ends
+    """
+    job_stream = await status_events(ws.app.state.pools, uid, partial_data)
+    if job_stream is None:
+        await ws.close(code=4404, reason='No task')
+        return
+    await ws.accept()
+    try:
+        async for name, event in job_stream:
+            await ws.send_json({'event': name or 'ping', **(event or {})})
+    except WebSocketDisconnect:
+        return
+    await ws.close()
+
+@router.get('/video/status/data')
+async def task_stage_data(
+    req: Request,
+    uid: str = Query(description='task uid provided when starting the task'),
+    stage: str = Query(description='stage name, e.g. summarize')
+):
+    """
+    Data of one stage, partial while the stage is in progress
+    """
+    if uid not in jobs:
+        brief = await req.app.state.pools.io.run(shared_brief, uid, (stage,)) if SHARED_JOBS else None
+        if brief is None:
+            raise HTTPException(404, 'No task')
+        if stage not in brief['states']:
+            raise HTTPException(404, 'No stage')
+        s = brief['states'][stage]
+        finished_at = s['started_at'] + s['elapsed'] if s['elapsed'] is not None else None
+        return {'uid': uid, 'stage': stage, 'status': s['status'], 'started_at': s['started_at'], 'finished_at': finished_at, 'data': s['data']}
+    if stage not in jobs[uid].states:
+        raise HTTPException(404, 'No stage')
+    result = jobs[uid].states[stage]
+    data = await req.app.state.pools.io.run(result.load)
+    return {'uid': uid, 'stage': stage, **result.model_dump(exclude={'data', 'stored'}), 'data': data}
+
+@router.get('/jobs/metrics')
+async def jobs_metrics(req: Request):
+    """
+    Size of the in-memory job store: number of jobs and batches, stage data bytes kept in memory and offloaded,
+    jobs evicted and archived since start
+
+    executors: workers, tasks in flight and queued, utilization and busy seconds of the cpu, llm and io pools
+    """
+    return {**await job_metrics(req.app.state.pools.io), 'executors': req.app.state.pools.stats()}
 
 @router.get('/video/retry')
 async def retry_task(
@@ -387,24 +811,159 @@ async def retry_task(
     req: Request,
     uid: str = Query(description='task uid provided when starting the task'),
 ):
-    # Should not done this, fix later if have time
+    if uid not in jobs:
+        brief = await req.app.state.pools.io.run(requeue_job, uid) if SHARED_JOBS else None
+        if brief is None:
+            raise HTTPException(404, 'No task')
+        return JSONResponse(brief, 202)
 
-    # Need to re-extract for subtitles -> text to build prompt
-    url = f'https://www.youtube.com/watch?v={uid}' 
-    _, subs = extract_url(url)
-    params = {
-        'db': db,
-        'subs': subs,
-        'text': ' '.join([s['text'] for s in subs])
-    }
-    background_task.add_task(start_video_insert_task, req.app.state.executor, uid, params, True)
-    return JSONResponse(jobs[uid].model_dump(), 202)
+    params = await load_params(db, req.app.state.pools, uid)
+    jobs[uid].status = Status.IN_PROGRESS
+    background_task.add_task(start_video_insert_task, req.app.state.pools, uid, params, True)
+    return JSONResponse(await get_brief(req.app.state.pools, uid, ('info',)), 202)
     
 
+async def run_batch_video(pools, batch: BatchJob, vid) -> Status | None:
+    """
+    ingest one video of a batch, return its final status or None when it was skipped
+    (picked up by /video/create or ingested since the batch was created)
+    """
+    async with SessionLocal() as db:
+        try:
+            _, _, params = await register_video_job(db, pools, vid, f'https://www.youtube.com/watch?v={vid}')
+        except Exception as e:
+            logging.error(f'Batch {batch.uid}: failed to extract video [{vid}]: {e}')
+            return Status.FAILED
+        if params is None:
+            return None
+        if not SHARED_JOBS:
+            await start_video_insert_task(pools, vid, params)
+    return await wait_shared_job(pools, vid) if SHARED_JOBS else jobs[vid].status
+
+async def ingest_batch_video(pools, batch: BatchJob, vid, semaphore):
+    async with semaphore:
+        try:
+            status = await run_batch_video(pools, batch, vid)
+        except Exception as e:
+            logging.error(f'Batch {batch.uid}: failed video [{vid}]: {traceback.format_exc()}')
+            status = Status.FAILED
+        batch.queued.remove(vid)
+        if status is None:
+            batch.skipped.append(vid)
+        elif status == Status.COMPLETED:
+            batch.completed.append(vid)
+        else:
+            batch.failed.append(vid)
+
+async def wait_shared_job(pools, uid) -> Status:
+    """
+    wait for a queued job to be run by a worker, return its final status
+    """
+    while True:
+        brief = await pools.io.run(shared_brief, uid)
+        if brief is None:
+            return Status.FAILED
+        if brief['status'] != Status.IN_PROGRESS:
+            return brief['status']
+        await asyncio.sleep(SHARED_POLL_INTERVAL)
+
+async def start_batch_task(pools, batch: BatchJob, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    # ingest_batch_video records its own failures, an error left over must not keep the batch in progress
+    results = await asyncio.gather(*[ingest_batch_video(pools, batch, vid, semaphore) for vid in list(batch.queued)], return_exceptions=True)
+    for e in results:
+        if isinstance(e, Exception):
+            logging.error(f'Batch {batch.uid}: {e}')
+    # videos whose ingest was aborted before being recorded
+    batch.failed.extend(batch.queued)
+    batch.queued.clear()
+    batch.status = Status.FAILED if batch.failed else Status.COMPLETED
+    batch.finished_at = time.time()
+    logging.info(f'Batch {batch.uid}: {batch.progress}')
+
+async def create_batch(db, pools, source, playlist_url) -> BatchJob:
+    ids = await pools.io.run(get_id_from_playlist, playlist_url)
+    if ids is None:
+        raise HTTPException(404, 'No playlist')
+    ids = list(dict.fromkeys(ids))
+
+    existing = await crud.get_existing_url_ids(db, ids) if ids else set()
+    if existing is None:
+        raise HTTPException(520, 'Query failed')
+
+    in_progress = {vid for vid in ids if vid in jobs and jobs[vid].status == Status.IN_PROGRESS}
+    if SHARED_JOBS:
+        # api-ingest keeps no jobs in memory, they are run by the workers
+        in_progress |= await pools.io.run(shared_in_progress, ids)
+
+    batch = BatchJob(uid=uuid4().hex, source=source, total=len(ids))
+    for vid in ids:
+        if vid in existing or vid in in_progress:
+            batch.skipped.append(vid)
+        else:
+            batch.queued.append(vid)
+    batches[batch.uid] = batch
+    return batch
+
+@router.post('/playlist/ingest')
+async def start_playlist_task(
+    db: Annotated[AsyncSession, Depends(get_db_session)],
+    req: Request,
+    background_task: BackgroundTasks,
+    playlist: schemas.RequestPlaylist
+):
+    """
+    Input:
+    :param url: Youtube playlist URL
+    :param concurrency: Max videos processed at once, default to INGEST_CONCURRENCY
+
+    Output:
+    - uid: Used for batch status checking
+    - progress: Number of videos skipped (already in db or in progress), queued, completed and failed
+
+    Enumerate playlist video ids with flat extraction and run **/video/create** pipeline on every new video
+    """
+    pools = req.app.state.pools
+    batch = await create_batch(db, pools, playlist.url, playlist.url)
+    background_task.add_task(start_batch_task, pools, batch, playlist.concurrency or INGEST_CONCURRENCY)
+    return JSONResponse(batch.model_dump(), 202)
+
+@router.post('/channel/ingest')
+async def start_channel_task(
+    db: Annotated[AsyncSession, Depends(get_db_session)],
+    req: Request,
+    background_task: BackgroundTasks,
+    channel: schemas.RequestChannel
+):
+    """
+    Input:
+    :param url: Youtube channel URL
+    :param concurrency: Max videos processed at once, default to INGEST_CONCURRENCY
+
+    Output: same as **/playlist/ingest**
+
+    Enumerate all videos uploaded by the channel and run **/video/create** pipeline on every new video
+    """
+    pools = req.app.state.pools
+    channel_info = await pools.io.run(get_channel_info, channel.url)
+    if not channel_info:
+        raise HTTPException(404, 'No channel')
+    batch = await create_batch(db, pools, channel.url, channel_info['playlist_url'])
+    background_task.add_task(start_batch_task, pools, batch, channel.concurrency or INGEST_CONCURRENCY)
+    return JSONResponse(batch.model_dump(), 202)
+
+@router.get('/batch/status')
+async def batch_status(
+    uid: str = Query(description='batch uid provided when starting the batch')
+):
+    if uid not in batches:
+        raise HTTPException(404, 'No batch')
+    return batches[uid]
+
 @router.post('/video', deprecated=True)
 async def create_vid(
     db: Annotated[AsyncSession, Depends(get_db_session)],
-    d: Annotated[dict, Depends(extract_video_and_sub)]
+    d: Annotated[dict, Depends(extract_video_and_sub_task)]
 ) -> schemas.ResponseVideo:
     v_model = await crud.create_video(db, schemas.VideoCreate(**d['video']))
     if not v_model:
@@ -482,188 +1041,3 @@ async def create_vid(
         level=schemas.Level(video_level),
         vocabulary=res_vocabs
     )
-
-async def extract_res_vid(video: models.Videos):
-    clip_id = video.id
-    clip = video.url_id
-    topic = video.topic
-    summary = video.summa
-    level = schemas.Level(video.level)
-    
-    sub = await video.awaitable_attrs.sub
-    sub_id = sub.id
-    
-    lessions = await video.awaitable_attrs.lessions
-    rs = []
-    ls = []
-    if (lessions) or (len(lessions) != 0):
-        for l in lessions:
-            _t = l.type
-            lid = l.id
-            if _t == 0:
-                rs.append(lid)
-            if _t == 1:
-                ls.append(lid)
-    
-    reading = 0 if len(rs) == 0 else rs[0]
-    listening = 0 if len(ls) == 0 else ls[0]
-    
-    senses = await video.awaitable_attrs.vocab
-    vocab = []
-    for s in senses:
-        hws = await s.awaitable_attrs.head_word
-        vocab.append(schemas.ResponseVocab(word=hws.word, pos=s.pos, sense=s.sense, level=schemas.Level(s.level), ipa=hws.ipa))
-
-    res = schemas.ResponseVideo(
-        clip_id=clip_id,
-        clip=clip,
-        subtitle=sub_id,
-        reading=reading,
-        listening=listening,
-        topic=topic,
-        summary=summary,
-        level=level,
-        vocabulary=vocab
-    )
-
-    return res
-
-@router.get('/video')
-async def get_vid_by_id(
-    id: int = Query(ge=1),
-    db: AsyncSession = Depends(get_db_session)
-) -> schemas.ResponseVideo:
-    video = await crud.get_video(db, id)
-    if not video:
-        raise HTTPException(404, 'No video')
-    
-    res = await extract_res_vid(video)
-    return res
-
-@router.get('/video/level')
-async def get_vid_by_level(
-    level: schemas.Level = Query(),
-    db: AsyncSession = Depends(get_db_session)
-) -> list[schemas.ResponseVideo]:
-    videos = await crud.get_videos_by_lv(db, level.value)
-    if not videos:
-        raise HTTPException(404, 'No video')
-
-    res = [await extract_res_vid(v) for v in videos]
-
-    return res
-
-@router.get('/video/topic')
-async def get_vid_by_topic(
-    topic: str = Query(),
-    db: AsyncSession = Depends(get_db_session)
-) -> list[schemas.ResponseVideo]:
-    videos = await crud.get_videos_by_topic(db, topic)
-    if not videos:
-        raise HTTPException(404, 'No video')
-    
-    res = [await extract_res_vid(v) for v in videos]
-    return res
-
-@router.get('/reading')
-async def get_read(
-    id: int = Query(ge=1),
-    db: AsyncSession = Depends(get_db_session)
-) -> schemas.ResponseReading:
-    lession = await crud.get_lession_by_id(db, id)
-    if not lession:
-        raise HTTPException(404, 'No lession')
-    
-    reading = lession.id
-
-    _type = lession.type
-    if _type != 0:
-        raise HTTPException(404, 'No lession')
-    
-    qs = await lession.awaitable_attrs.questions
-    questions = []
-    if (qs) or (len(qs) != 0):
-        for q in qs:
-            _t = q.type
-            question = q.question
-            choices = []
-            ans = ''
-            explain = ''
-            cs = await q.awaitable_attrs.choices
-            for c in cs:
-                choice = c.choice
-                correct = c.correct
-                expl = c.expl
-                choices.append(choice)
-                if correct:
-                    ans = choice
-                    explain = expl
-            questions.append(
-                schemas.ResponseQuestion(question=question, q_type=schemas.QuestionType(_t), choices=choices, correct=ans, explain=explain)
-            )
-            
-    return schemas.ResponseReading(
-        reading=reading,
-        questions=questions
-    )
-
-@router.get('/listening')
-async def get_lis(
-    id: int = Query(gt=0),
-    db: AsyncSession = Depends(get_db_session)
-) -> schemas.ResponseListening:
-    lession = await crud.get_lession_by_id(db, id)
-    if not lession:
-        raise HTTPException(404, 'No lession')
-    
-    listening = lession.id
-
-    _type = lession.type
-    if _type != 1:
-        raise HTTPException(404, 'No lession')
-    
-    qs = await lession.awaitable_attrs.questions
-    questions = []
-    if (qs) or (len(qs) != 0):
-        for q in qs:
-            _t = q.type
-            question = q.question
-            choices = []
-            ans = ''
-            explain = ''
-            cs = await q.awaitable_attrs.choices
-            for c in cs:
-                choice = c.choice
-                correct = c.correct
-                expl = c.expl
-                choices.append(choice)
-                if correct:
-                    ans = choice
-                    explain = expl
-            questions.append(
-                schemas.ResponseQuestion(question=question, q_type=schemas.QuestionType(_t), choices=choices, correct=ans, explain=explain)
-            )
-            
-    return schemas.ResponseListening(
-        listening=listening,
-        questions=questions
-    )
-
-@router.get('/subtitle')
-async def get_subtitle_by_id(
-    id: int = Query(gt=0),
-    db: AsyncSession = Depends(get_db_session)
-) -> schemas.ResponseSubtitles:
-    subtitle = await crud.get_subtitle_by_id(db, id)
-    if not subtitle:
-        raise HTTPException(404, 'No subtitle')
-    
-    id = subtitle.id
-    video = subtitle.video_id
-    lines = await subtitle.awaitable_attrs.lines
-
-    return schemas.ResponseSubtitles(
-        id=id,
-        video=video,
-        lines=[schemas.ResponseSutitleLines(id=l.id, start=l.start, end=l.end, text=l.text) for l in lines]
-    )
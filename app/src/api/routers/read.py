@@ -0,0 +1,203 @@
+"""
+Read endpoints: videos, lessions and subtitles already in db
+
+Kept apart from the ingest router so read replicas (APP_ROLE=api-read) serve them without the broker, executor
+pools or any nlp library
+"""
+from fastapi import APIRouter, Query, Depends, HTTPException
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ...db import schemas, crud, models
+from ..dependencies import get_db_session
+
+router = APIRouter(
+    prefix='/nlp/api',
+    tags=['prototype'],
+    responses={404: {'description': 'Not Found'}}
+)
+
+async def extract_res_vid(video: models.Videos):
+    clip_id = video.id
+    clip = video.url_id
+    topic = video.topic
+    summary = video.summa
+    level = schemas.Level(video.level)
+    
+    sub = await video.awaitable_attrs.sub
+    sub_id = sub.id
+    
+    lessions = await video.awaitable_attrs.lessions
+    rs = []
+    ls = []
+    if (lessions) or (len(lessions) != 0):
+        for l in lessions:
+            _t = l.type
+            lid = l.id
+            if _t == 0:
+                rs.append(lid)
+            if _t == 1:
+                ls.append(lid)
+    
+    reading = 0 if len(rs) == 0 else rs[0]
+    listening = 0 if len(ls) == 0 else ls[0]
+    
+    senses = await video.awaitable_attrs.vocab
+    vocab = []
+    for s in senses:
+        hws = await s.awaitable_attrs.head_word
+        vocab.append(schemas.ResponseVocab(word=hws.word, pos=s.pos, sense=s.sense, level=schemas.Level(s.level), ipa=hws.ipa))
+
+    res = schemas.ResponseVideo(
+        clip_id=clip_id,
+        clip=clip,
+        subtitle=sub_id,
+        reading=reading,
+        listening=listening,
+        topic=topic,
+        summary=summary,
+        level=level,
+        vocabulary=vocab
+    )
+
+    return res
+
+@router.get('/video')
+async def get_vid_by_id(
+    id: int = Query(ge=1),
+    db: AsyncSession = Depends(get_db_session)
+) -> schemas.ResponseVideo:
+    video = await crud.get_video(db, id)
+    if not video:
+        raise HTTPException(404, 'No video')
+    
+    res = await extract_res_vid(video)
+    return res
+
+@router.get('/video/level')
+async def get_vid_by_level(
+    level: schemas.Level = Query(),
+    db: AsyncSession = Depends(get_db_session)
+) -> list[schemas.ResponseVideo]:
+    videos = await crud.get_videos_by_lv(db, level.value)
+    if not videos:
+        raise HTTPException(404, 'No video')
+
+    res = [await extract_res_vid(v) for v in videos]
+
+    return res
+
+@router.get('/video/topic')
+async def get_vid_by_topic(
+    topic: str = Query(),
+    db: AsyncSession = Depends(get_db_session)
+) -> list[schemas.ResponseVideo]:
+    videos = await crud.get_videos_by_topic(db, topic)
+    if not videos:
+        raise HTTPException(404, 'No video')
+    
+    res = [await extract_res_vid(v) for v in videos]
+    return res
+
+@router.get('/reading')
+async def get_read(
+    id: int = Query(ge=1),
+    db: AsyncSession = Depends(get_db_session)
+) -> schemas.ResponseReading:
+    lession = await crud.get_lession_by_id(db, id)
+    if not lession:
+        raise HTTPException(404, 'No lession')
+    
+    reading = lession.id
+
+    _type = lession.type
+    if _type != 0:
+        raise HTTPException(404, 'No lession')
+    
+    qs = await lession.awaitable_attrs.questions
+    questions = []
+    if (qs) or (len(qs) != 0):
+        for q in qs:
+            _t = q.type
+            question = q.question
+            choices = []
+            ans = ''
+            explain = ''
+            cs = await q.awaitable_attrs.choices
+            for c in cs:
+                choice = c.choice
+                correct = c.correct
+                expl = c.expl
+                choices.append(choice)
+                if correct:
+                    ans = choice
+                    explain = expl
+            questions.append(
+                schemas.ResponseQuestion(question=question, q_type=schemas.QuestionType(_t), choices=choices, correct=ans, explain=explain)
+            )
+            
+    return schemas.ResponseReading(
+        reading=reading,
+        questions=questions
+    )
+
+@router.get('/listening')
+async def get_lis(
+    id: int = Query(gt=0),
+    db: AsyncSession = Depends(get_db_session)
+) -> schemas.ResponseListening:
+    lession = await crud.get_lession_by_id(db, id)
+    if not lession:
+        raise HTTPException(404, 'No lession')
+    
+    listening = lession.id
+
+    _type = lession.type
+    if _type != 1:
+        raise HTTPException(404, 'No lession')
+    
+    qs = await lession.awaitable_attrs.questions
+    questions = []
+    if (qs) or (len(qs) != 0):
+        for q in qs:
+            _t = q.type
+            question = q.question
+            choices = []
+            ans = ''
+            explain = ''
+            cs = await q.awaitable_attrs.choices
+            for c in cs:
+                choice = c.choice
+                correct = c.correct
+                expl = c.expl
+                choices.append(choice)
+                if correct:
+                    ans = choice
+                    explain = expl
+            questions.append(
+                schemas.ResponseQuestion(question=question, q_type=schemas.QuestionType(_t), choices=choices, correct=ans, explain=explain)
+            )
+            
+    return schemas.ResponseListening(
+        listening=listening,
+        questions=questions
+    )
+
+@router.get('/subtitle')
+async def get_subtitle_by_id(
+    id: int = Query(gt=0),
+    db: AsyncSession = Depends(get_db_session)
+) -> schemas.ResponseSubtitles:
+    subtitle = await crud.get_subtitle_by_id(db, id)
+    if not subtitle:
+        raise HTTPException(404, 'No subtitle')
+    
+    id = subtitle.id
+    video = subtitle.video_id
+    lines = await subtitle.awaitable_attrs.lines
+
+    return schemas.ResponseSubtitles(
+        id=id,
+        video=video,
+        lines=[schemas.ResponseSutitleLines(id=l.id, start=l.start, end=l.end, text=l.text) for l in lines]
+    )
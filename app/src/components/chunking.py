@@ -0,0 +1,85 @@
+import contextvars
+import logging
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('uvicorn.error')
+
+LLM_CHUNK_TOKENS = int(os.environ.get('LLM_CHUNK_TOKENS', 3000))
+LLM_CHUNK_PARALLEL = int(os.environ.get('LLM_CHUNK_PARALLEL', 4))
+
+def count_tokens(text):
+    """
+    rough estimate (~4 characters per token for english), good enough to budget prompts without a tokenizer
+    """
+    return math.ceil(len(text) / 4)
+
+def split_long_sentence(sent, max_tokens):
+    # auto captions often have no punctuation, so a "sentence" can be the whole transcript
+    words = sent.split(' ')
+    res = []
+    buf = []
+    for w in words:
+        if buf and count_tokens(' '.join(buf + [w])) > max_tokens:
+            res.append(' '.join(buf))
+            buf = []
+        buf.append(w)
+    if buf:
+        res.append(' '.join(buf))
+    return res
+
+def split_chunks(text, max_tokens=LLM_CHUNK_TOKENS):
+    """
+    split text on sentence boundaries into windows of at most max_tokens
+    """
+    if count_tokens(text) <= max_tokens:
+        return [text]
+    from nltk import sent_tokenize
+    chunks = []
+    buf = ''
+    for sent in sent_tokenize(text):
+        pieces = split_long_sentence(sent, max_tokens) if count_tokens(sent) > max_tokens else [sent]
+        for p in pieces:
+            if buf and count_tokens(f'{buf} {p}') > max_tokens:
+                chunks.append(buf)
+                buf = p
+            else:
+                buf = f'{buf} {p}' if buf else p
+    if buf:
+        chunks.append(buf)
+    return chunks
+
+def map_chunks(fn, chunks, parallel=LLM_CHUNK_PARALLEL, allow_partial=False):
+    """
+    run fn on every chunk concurrently, results are in chunk order
+    with allow_partial, failed chunks are dropped as long as one chunk succeeded
+    """
+    if len(chunks) == 1:
+        return [fn(chunks[0])]
+    with ThreadPoolExecutor(max_workers=min(parallel, len(chunks))) as pool:
+        # each chunk runs in a copy of the caller's context so its spans are recorded on the caller's stage
+        futures = [pool.submit(contextvars.copy_context().run, fn, c) for c in chunks]
+        res = []
+        errors = []
+        for f in futures:
+            try:
+                res.append(f.result())
+            except Exception as e:
+                errors.append(e)
+    if errors:
+        if not allow_partial or not res:
+            raise errors[0]
+        logger.warning(f'{len(errors)}/{len(chunks)} chunks failed: {errors[0]}')
+    return res
+
+def interleave(lists):
+    """
+    round robin over lists so every chunk is represented at the head of the result
+    """
+    res = []
+    for i in range(max([len(l) for l in lists], default=0)):
+        for l in lists:
+            if i < len(l):
+                res.append(l[i])
+    return res
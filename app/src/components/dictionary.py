@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import httpx
+
+from .extractor import parse_html, extract_all
+from .tracing import span
+from .utils import lemmatize
+
+logger = logging.getLogger('uvicorn.error')
+
+OXFORD_URL = os.environ.get('OXFORD_URL', 'https://www.oxfordlearnersdictionaries.com/definition/english/')
+
+DICT_CACHE_PATH = os.environ.get('DICT_CACHE_PATH', 'app/data/dictionary.db')
+DICT_NEGATIVE_TTL = int(os.environ.get('DICT_NEGATIVE_TTL', 7 * 24 * 3600))
+DICT_FETCH_CONCURRENCY = int(os.environ.get('DICT_FETCH_CONCURRENCY', 4))
+DICT_FETCH_RATE = float(os.environ.get('DICT_FETCH_RATE', 5)) # requests per second
+
+class DictionaryCache():
+    """
+    persistent cache of parsed dictionary entries (extract_all records) keyed by lemma
+    words that are not in the dictionary are stored with null data (negative cache) and expire after DICT_NEGATIVE_TTL
+    """
+    def __init__(self, path=DICT_CACHE_PATH, negative_ttl=DICT_NEGATIVE_TTL):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.negative_ttl = negative_ttl
+        # shared by the llm pool threads
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries (lemma TEXT PRIMARY KEY, data TEXT, fetched_at REAL NOT NULL)')
+        self.conn.commit()
+
+    def get_many(self, lemmas) -> dict[str, list | None]:
+        lemmas = list(lemmas)
+        if not lemmas:
+            return {}
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT lemma, data, fetched_at FROM entries WHERE lemma IN ({','.join('?' * len(lemmas))})', lemmas
+            ).fetchall()
+        now = time.time()
+        res = {}
+        for lemma, data, fetched_at in rows:
+            if data is None:
+                if now - fetched_at < self.negative_ttl:
+                    res[lemma] = None
+            else:
+                res[lemma] = json.loads(data)
+        return res
+
+    def put_many(self, entries: dict[str, list | None]):
+        now = time.time()
+        rows = [(lemma, None if info is None else json.dumps(info), now) for lemma, info in entries.items()]
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO entries (lemma, data, fetched_at) VALUES (?, ?, ?)', rows)
+            self.conn.commit()
+
+_cache: DictionaryCache | None = None
+
+def get_cache() -> DictionaryCache:
+    """
+    one connection per process, shared by its threads
+    """
+    global _cache
+    if _cache is None:
+        _cache = DictionaryCache()
+    return _cache
+
+class RateLimiter():
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+async def send_get_async(client: httpx.AsyncClient, url, limiter: RateLimiter):
+    await limiter.wait()
+    return await client.get(url)
+
+async def fetch_entry(client, vocab, semaphore, limiter) -> list | None:
+    """
+    async version of extractor.extract_info, return None if the word is not in the dictionary (404)
+    other error statuses raise, so a throttled or failing request is never cached as a miss
+    """
+    url = f'{OXFORD_URL}{vocab}'
+    async with semaphore:
+        res = await send_get_async(client, url, limiter)
+        if res.status_code == 404:
+            return None
+        res.raise_for_status()
+        info = []
+        if str(res.url) != url:
+            i = 1
+            while True:
+                res = await send_get_async(client, f'{url}_{i}', limiter)
+                # 404 past the last homonym page, anything else would cache a truncated list
+                if res.status_code == 404:
+                    break
+                res.raise_for_status()
+                info.append(extract_all(parse_html(res.text)))
+                i += 1
+        else:
+            info.append(extract_all(parse_html(res.text)))
+    return info if info else None
+
+async def fetch_entries(vocabs, concurrency=DICT_FETCH_CONCURRENCY, rate=DICT_FETCH_RATE) -> dict[str, list | None]:
+    """
+    fetch dictionary entries concurrently, words failed due to network errors are left out so they are not negatively cached
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(rate)
+    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64)'}
+    async with httpx.AsyncClient(headers=headers, follow_redirects=True, timeout=30) as client:
+        results = await asyncio.gather(*[fetch_entry(client, v, semaphore, limiter) for v in vocabs], return_exceptions=True)
+    res = {}
+    for v, r in zip(vocabs, results):
+        if isinstance(r, Exception):
+            logger.warning(f'Fetch dictionary entry [{v}] failed: {r}')
+        else:
+            res[v] = r
+    return res
+
+def lookup_entries(vocabs) -> dict[str, list | None]:
+    """
+    return parsed entries of every word found in cache or dictionary, fetch cache misses concurrently
+    entries are looked up and cached by lemma, so inflected forms share one entry, the result is keyed by the given words
+    """
+    lemmas = {v: lemmatize(v) for v in dict.fromkeys(vocabs)}
+    unique = list(dict.fromkeys(lemmas.values()))
+    cache = get_cache()
+    with span('dictionary.lookup', cache='dictionary') as attrs:
+        found = cache.get_many(unique)
+        misses = [l for l in unique if l not in found]
+        attrs['cache_hits'] = len(found)
+        attrs['cache_misses'] = len(misses)
+        if misses:
+            fetched = asyncio.run(fetch_entries(misses))
+            cache.put_many(fetched)
+            found.update(fetched)
+    return {v: found[l] for v, l in lemmas.items() if l in found}
+
+def get_first_phon(info) -> str | None:
+    for entry in info or []:
+        for p in entry['phons'].values():
+            return p['phon']
+    return None
@@ -0,0 +1,183 @@
+"""
+Offline lexicon index: ipa, pos and cefr level by lemma
+
+Build once from a pronunciation dictionary and a cefr word list:
+
+    python -m app.src.components.lexicon --pron cmudict.dict --cefr cefr.csv --out app/data/lexicon.db
+
+- pron: either CMUdict format (`word  W ER1 D`, converted from ARPAbet to IPA) or ipa-dict format (`word\t/wɝd/`)
+- cefr: csv with header containing headword (or word), pos and cefr (or level) columns
+"""
+import argparse
+import csv
+import logging
+import os
+import sqlite3
+from dataclasses import dataclass
+
+from .tracing import span
+
+logger = logging.getLogger('uvicorn.error')
+
+LEXICON_PATH = os.environ.get('LEXICON_PATH', 'app/data/lexicon.db')
+
+# sqlite default SQLITE_MAX_VARIABLE_NUMBER is 999 on older builds
+LOOKUP_BATCH = 900
+
+ARPABET = {
+    'AA': 'ɑ', 'AE': 'æ', 'AH': 'ʌ', 'AO': 'ɔ', 'AW': 'aʊ', 'AY': 'aɪ', 'EH': 'ɛ', 'ER': 'ɝ', 'EY': 'eɪ',
+    'IH': 'ɪ', 'IY': 'i', 'OW': 'oʊ', 'OY': 'ɔɪ', 'UH': 'ʊ', 'UW': 'u',
+    'B': 'b', 'CH': 'tʃ', 'D': 'd', 'DH': 'ð', 'F': 'f', 'G': 'ɡ', 'HH': 'h', 'JH': 'dʒ', 'K': 'k', 'L': 'l',
+    'M': 'm', 'N': 'n', 'NG': 'ŋ', 'P': 'p', 'R': 'r', 'S': 's', 'SH': 'ʃ', 'T': 't', 'TH': 'θ', 'V': 'v',
+    'W': 'w', 'Y': 'j', 'Z': 'z', 'ZH': 'ʒ',
+}
+UNSTRESSED = {'AH': 'ə', 'ER': 'ɚ'}
+STRESS = {'1': 'ˈ', '2': 'ˌ'}
+
+@dataclass(frozen=True)
+class LexEntry:
+    lemma: str
+    pos: str
+    ipa: str
+    level: str
+
+def arpabet_to_ipa(phones):
+    """
+    approximate conversion, stress marks go before the onset of the stressed syllable
+    (all leading consonants for the first syllable, otherwise the single consonant before the vowel)
+    """
+    segs = []
+    for p in phones:
+        base, stress = (p[:-1], p[-1]) if p[-1].isdigit() else (p, '')
+        ipa = UNSTRESSED[base] if stress == '0' and base in UNSTRESSED else ARPABET.get(base, '')
+        segs.append([ipa, stress])
+
+    vowels = [i for i, (_, stress) in enumerate(segs) if stress]
+    for n, i in enumerate(vowels):
+        mark = STRESS.get(segs[i][1])
+        if mark:
+            onset = 0 if n == 0 else max(i - 1, vowels[n - 1] + 1)
+            segs[onset][0] = mark + segs[onset][0]
+    return f'/{''.join(ipa for ipa, _ in segs)}/'
+
+def read_pron(path) -> dict[str, str]:
+    prons = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(';;;') or line.startswith('#'):
+                continue
+            if '\t' in line and '/' in line:
+                word, ipa = line.split('\t', 1)
+                ipa = ipa.split(',')[0].strip()
+            else:
+                word, *phones = line.split()
+                if word.endswith(')'):
+                    continue # alternative pronunciations, e.g. READ(2)
+                ipa = arpabet_to_ipa(phones)
+            prons.setdefault(word.lower(), ipa)
+    return prons
+
+def read_cefr(path) -> list[tuple[str, str, str]]:
+    rows = []
+    with open(path, encoding='utf-8', newline='') as f:
+        reader = csv.DictReader(f)
+        cols = {c.lower().strip(): c for c in reader.fieldnames}
+        word_col = cols.get('headword') or cols['word']
+        level_col = cols.get('cefr') or cols['level']
+        pos_col = cols.get('pos')
+        for r in reader:
+            level = r[level_col].strip().lower()
+            pos = r[pos_col].strip().lower() if pos_col else ''
+            for w in r[word_col].split('/'):
+                if w.strip():
+                    rows.append((w.strip().lower(), pos, level))
+    return rows
+
+def build_lexicon(pron_path, cefr_path, out_path=LEXICON_PATH):
+    prons = read_pron(pron_path)
+    cefr = read_cefr(cefr_path)
+
+    entries = {}
+    for lemma, pos, level in cefr:
+        entries.setdefault((lemma, pos), (prons.get(lemma, ''), level))
+    with_level = {lemma for lemma, _ in entries}
+    for lemma, ipa in prons.items():
+        if lemma not in with_level:
+            entries[(lemma, '')] = (ipa, '')
+
+    if os.path.dirname(out_path):
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = f'{out_path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('CREATE TABLE lexicon (lemma TEXT NOT NULL, pos TEXT NOT NULL, ipa TEXT NOT NULL, level TEXT NOT NULL, PRIMARY KEY (lemma, pos)) WITHOUT ROWID')
+    conn.executemany(
+        'INSERT INTO lexicon VALUES (?, ?, ?, ?)',
+        sorted((lemma, pos, ipa, level) for (lemma, pos), (ipa, level) in entries.items())
+    )
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+    os.replace(tmp_path, out_path)
+    return len(entries)
+
+class Lexicon():
+    def __init__(self, path=LEXICON_PATH):
+        self.conn = None
+        if os.path.exists(path):
+            self.conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            logger.warning(f'Lexicon index {path} not found, offline lookup disabled')
+
+    def lookup_many(self, lemmas) -> dict[str, list[LexEntry]]:
+        """
+        batched primary key lookup, O(log n) per lemma
+        """
+        res = {}
+        if self.conn is None:
+            return res
+        lemmas = list(dict.fromkeys(l.lower() for l in lemmas if l))
+        with span('lexicon.lookup', cache='lexicon') as attrs:
+            for i in range(0, len(lemmas), LOOKUP_BATCH):
+                chunk = lemmas[i:i + LOOKUP_BATCH]
+                rows = self.conn.execute(
+                    f'SELECT lemma, pos, ipa, level FROM lexicon WHERE lemma IN ({','.join('?' * len(chunk))})', chunk
+                ).fetchall()
+                for r in rows:
+                    res.setdefault(r[0], []).append(LexEntry(*r))
+            attrs['cache_hits'] = len(res)
+            attrs['cache_misses'] = len(lemmas) - len(res)
+        return res
+
+_lexicon: Lexicon | None = None
+
+def get_lexicon() -> Lexicon:
+    global _lexicon
+    if _lexicon is None:
+        _lexicon = Lexicon()
+    return _lexicon
+
+def pick_entry(entries: list[LexEntry] | None, pos='') -> LexEntry | None:
+    """
+    prefer the entry whose pos matches (gpt `adjective`, spacy `ADJ` and list `adjective` all share a prefix)
+    """
+    if not entries:
+        return None
+    pos = (pos or '').lower()[:3]
+    for e in entries:
+        if pos and e.pos[:3] == pos:
+            return e
+    for e in entries:
+        if e.level:
+            return e
+    return entries[0]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build offline lexicon index')
+    parser.add_argument('--pron', required=True, help='CMUdict or ipa-dict pronunciation file')
+    parser.add_argument('--cefr', required=True, help='csv cefr word list')
+    parser.add_argument('--out', default=LEXICON_PATH)
+    args = parser.parse_args()
+    print(f'{build_lexicon(args.pron, args.cefr, args.out)} entries written to {args.out}')
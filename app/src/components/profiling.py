@@ -0,0 +1,325 @@
+"""
+On-demand profiling of the api process and its process pool workers, for a time window
+
+- sample: a thread records the stack of every other thread each PROFILE_SAMPLE_INTERVAL (py-spy style, low overhead)
+- cprofile: deterministic profile of this process (only the event loop thread before python 3.12), and of every
+  pool task started during the window
+
+Pool tasks started while a window is open run under the same profiler in their worker (see run_profiled), their
+result is merged when the task ends. Sampled stacks are returned collapsed (`frame;frame;frame count` per line),
+ready for flamegraph.pl or speedscope.
+
+Event loop health is recorded over the same window:
+- lag: a sleep of LOOP_PROBE_INTERVAL that wakes up late means the loop was busy
+- blocking: a watchdog thread takes the stack of the loop thread when it has not ticked for threshold seconds,
+  i.e. the callback running at that point is blocking the loop
+
+With LOOP_STALL_DEBUG=1 the same watchdog runs for the life of the app (watch_loop) and logs every stall over
+LOOP_STALL_THRESHOLD with the stack that caused it
+"""
+import asyncio
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from .tracing import metrics
+
+logger = logging.getLogger('uvicorn.error')
+
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+PROFILE_BLOCKING_THRESHOLD = float(os.environ.get('PROFILE_BLOCKING_THRESHOLD', 0.1))
+PROFILE_TOP = 50 # functions listed in a cprofile report
+LOOP_PROBE_INTERVAL = 0.01
+
+LOOP_STALL_DEBUG = os.environ.get('LOOP_STALL_DEBUG', '0') == '1' # log every event loop stall with the stack that caused it
+LOOP_STALL_THRESHOLD = float(os.environ.get('LOOP_STALL_THRESHOLD', 0.05))
+LOOP_STALL_FRAMES = 12 # innermost frames logged per stall
+
+def frame_name(frame):
+    code = frame.f_code
+    path = code.co_filename.replace('\\', '/').split('/')
+    return f'{code.co_name} ({'/'.join(path[-2:])}:{code.co_firstlineno})'
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def distribution(values):
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))] if values else None
+    return {'count': len(values), 'p50': pick(0.5), 'p99': pick(0.99), 'max': values[-1] if values else None}
+
+class Sampler():
+    """
+    stack sampler running on its own thread, stacks are rooted at the name of the thread they were taken from
+    """
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL, threads=None, deadline=None):
+        self.interval = interval
+        self.threads = threads # idents to sample, None for all
+        self.deadline = deadline
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='profiler-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            if self.deadline is not None and time.time() > self.deadline:
+                break
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident, str(ident))
+                if name.startswith('profiler-') or (self.threads is not None and ident not in self.threads):
+                    continue
+                self.stacks[f'{name};{collapse(frame)}'] += 1
+            self.samples += 1
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+class StatsDump():
+    """
+    raw stats of a profile run in another process, pstats.Stats accepts anything with create_stats() and stats
+    """
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def profiled_call(options, fn):
+    """
+    run fn in a pool worker under the profiler of the open window, return (result, profile)
+    on failure the profile is attached to the exception
+    must stay a module level function to be sent to a process pool
+    """
+    mode, interval, deadline = options
+    if mode == 'sample':
+        profiler = Sampler(interval, threads={threading.get_ident()}, deadline=deadline).start()
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def collect():
+        if mode == 'sample':
+            return {'pid': os.getpid(), 'stacks': dict(profiler.stop())}
+        profiler.disable()
+        profiler.create_stats()
+        return {'pid': os.getpid(), 'stats': profiler.stats}
+
+    try:
+        res = fn()
+    except Exception as e:
+        e.profile = collect()
+        raise
+    return res, collect()
+
+class LoopMonitor():
+    """
+    with history, only the last history lags and blocking stacks are kept (long running monitor)
+    with log, every blocking stack is logged with how long the loop was blocked
+    """
+    def __init__(self, threshold=PROFILE_BLOCKING_THRESHOLD, interval=LOOP_PROBE_INTERVAL, history=None, log=False):
+        self.threshold = threshold
+        self.interval = interval
+        self.log = log
+        self.lags = deque(maxlen=history) if history else []
+        self.blocking = deque(maxlen=history) if history else []
+        self.loop_ident = None
+        self.last_tick = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.watch, name='profiler-watchdog', daemon=True)
+
+    async def probe(self):
+        self.loop_ident = threading.get_ident()
+        self._thread.start()
+        try:
+            while True:
+                t0 = time.monotonic()
+                self.last_tick = t0
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, time.monotonic() - t0 - self.interval)
+                self.lags.append(lag)
+                if self.blocking and self.blocking[-1]['seconds'] is None:
+                    self.blocking[-1]['seconds'] = lag
+                    if self.log:
+                        self.report_blocking(self.blocking[-1])
+        finally:
+            self._stop.set()
+
+    def report_blocking(self, b):
+        metrics.inc('event_loop_stalls_total', help=f'Event loop stalls over {self.threshold}s')
+        metrics.observe('event_loop_stall_seconds', b['seconds'], 'Duration of event loop stalls')
+        frames = b['stack'].split(';')[::-1][:LOOP_STALL_FRAMES]
+        logger.warning(f'Event loop blocked for {b['seconds'] * 1000:.0f}ms in:\n    {'\n    '.join(frames)}')
+
+    def watch(self):
+        reported = None
+        while not self._stop.wait(self.threshold / 4):
+            tick = self.last_tick
+            if tick == reported or time.monotonic() - tick - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_ident)
+            if frame is not None:
+                # seconds is filled by the probe once the loop runs again
+                self.blocking.append({'at': time.time(), 'seconds': None, 'stack': collapse(frame)})
+                reported = tick
+
+class ProfileWindow():
+    def __init__(self, mode, seconds, interval, grace):
+        self.mode = mode
+        self.seconds = seconds
+        self.interval = interval
+        self.grace = grace
+        self.started = time.time()
+        self.deadline = self.started + seconds
+        self.stacks = Counter()
+        self.samples = 0
+        self.stats = None
+        self.workers = Counter() # pool tasks profiled per worker pid
+        self.pending = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def task_started(self):
+        self.pending += 1
+        self.idle.clear()
+
+    def add_worker_profile(self, profile):
+        self.pending -= 1
+        if self.pending == 0:
+            self.idle.set()
+        if profile is None:
+            return
+        self.workers[profile['pid']] += 1
+        for stack, n in profile.get('stacks', {}).items():
+            self.stacks[f'worker-{profile['pid']};{stack}'] += n
+        if 'stats' in profile:
+            self.add_stats(StatsDump(profile['stats']))
+
+    def add_stats(self, profile):
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+
+    def top(self, n=PROFILE_TOP):
+        if self.stats is None:
+            return []
+        rows = []
+        for (filename, line, name), (_, ncalls, tottime, cumtime, _) in self.stats.stats.items():
+            rows.append({'function': f'{name} ({filename}:{line})', 'ncalls': ncalls, 'tottime': tottime, 'cumtime': cumtime})
+        return sorted(rows, key=lambda r: r['cumtime'], reverse=True)[:n]
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {n}\n' for stack, n in self.stacks.most_common())
+
+    def report(self, monitor: LoopMonitor) -> dict:
+        return {
+            'mode': self.mode,
+            'started': self.started,
+            'seconds': self.seconds,
+            'samples': self.samples,
+            'stacks': len(self.stacks),
+            'top': self.top(),
+            'worker_tasks': sum(self.workers.values()),
+            'workers': {str(pid): n for pid, n in self.workers.items()},
+            'unfinished_worker_tasks': self.pending,
+            'loop_lag': distribution(monitor.lags),
+            'blocking': monitor.blocking,
+        }
+
+_window: ProfileWindow | None = None
+
+def worker_options(executor):
+    """
+    (window, options) to profile a task sent to executor with, (None, None) when no window is open
+    threads of this process are already covered by the profiler of the window (cProfile is process wide since
+    python 3.12 and only one can be active), only process pool tasks are profiled on their own
+    """
+    window = _window
+    if window is None or not isinstance(executor, ProcessPoolExecutor):
+        return None, None
+    return window, (window.mode, window.interval, window.deadline)
+
+async def run_profiled(executor, fn):
+    """
+    loop.run_in_executor(executor, fn), under the profiler of the open window if any
+    """
+    loop = asyncio.get_running_loop()
+    window, options = worker_options(executor)
+    if window is None:
+        return await loop.run_in_executor(executor, fn)
+    window.task_started()
+    try:
+        res, profile = await loop.run_in_executor(executor, partial(profiled_call, options, fn))
+    except Exception as e:
+        window.add_worker_profile(getattr(e, 'profile', None))
+        raise
+    window.add_worker_profile(profile)
+    return res
+
+async def profile_window(mode, seconds, interval=PROFILE_SAMPLE_INTERVAL, threshold=PROFILE_BLOCKING_THRESHOLD, grace=10.0) -> tuple[ProfileWindow, dict]:
+    """
+    profile the process and its pool workers for seconds, then wait up to grace seconds for pool tasks still running
+    return (window, report)
+    """
+    global _window
+    if _window is not None:
+        raise RuntimeError('A profiling window is already open')
+    window = _window = ProfileWindow(mode, seconds, interval, grace)
+    logger.info(f'Profiling window opened: {mode} for {seconds}s')
+
+    monitor = LoopMonitor(threshold)
+    probe = asyncio.create_task(monitor.probe())
+    if mode == 'sample':
+        sampler = Sampler(interval).start()
+    else:
+        # enabled on the event loop thread, every coroutine and callback the loop runs is profiled
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        if mode == 'sample':
+            window.stacks.update(sampler.stop())
+            window.samples = sampler.samples
+        else:
+            profiler.disable()
+            window.add_stats(profiler)
+        _window = None
+        probe.cancel()
+        await asyncio.gather(probe, return_exceptions=True)
+
+    try:
+        await asyncio.wait_for(window.idle.wait(), grace)
+    except TimeoutError:
+        logger.warning(f'Profiling window: {window.pending} pool tasks still running, left out')
+    return window, window.report(monitor)
+
+async def watch_loop(threshold=LOOP_STALL_THRESHOLD):
+    """
+    debug mode (LOOP_STALL_DEBUG): log every event loop stall over threshold with the stack of the loop thread,
+    asyncio debug mode also logs the callback that ran too long, runs until cancelled
+    """
+    loop = asyncio.get_running_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = threshold
+    logger.warning(f'Event loop stall debug mode on, threshold {threshold * 1000:.0f}ms')
+    await LoopMonitor(threshold, history=100, log=True).probe()
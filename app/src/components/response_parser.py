@@ -0,0 +1,230 @@
+"""
+Parsing layer for llm responses: extract the first json object, repair common defects, validate per stage and salvage partial lists
+
+Outcomes are counted per stage in parse_stats:
+- ok: response was valid json as is
+- repaired: json had to be extracted (prose, markdown fences) or fixed (python literals, trailing commas, quotes)
+- salvaged: output was truncated or some list items were invalid, valid part was kept
+- failed: nothing usable, the request has to be sent again
+"""
+import json
+import logging
+import re
+from ast import literal_eval
+from collections import Counter
+
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
+
+logger = logging.getLogger('uvicorn.error')
+
+parse_stats: Counter = Counter()
+
+class ParseError(Exception):
+    pass
+
+class TopicLevel(BaseModel):
+    topic: str = Field(min_length=1)
+    level: str = Field(min_length=1)
+
+class VocabItem(BaseModel):
+    vocabulary: str = Field(min_length=1)
+    meaning: str
+    pos: str
+    ipa: str = ''
+    level: str
+
+    @field_validator('ipa', mode='before')
+    @classmethod
+    def null_ipa(cls, v):
+        return '' if v is None else v
+
+class QuestionItem(BaseModel):
+    question: str = Field(min_length=1)
+    choices: list[str] = Field(min_length=2)
+    correct: int
+    explanation: str = ''
+
+    @field_validator('explanation', mode='before')
+    @classmethod
+    def null_explanation(cls, v):
+        return '' if v is None else v
+
+    @model_validator(mode='after')
+    def check_correct(self):
+        if not 0 <= self.correct < len(self.choices):
+            raise ValueError(f'correct index {self.correct} out of range')
+        return self
+
+LIST_STAGES = {
+    'vocab': ('vocab_list', VocabItem),
+    'questions': ('questions', QuestionItem),
+}
+
+def scan(text, start):
+    """
+    walk a json-like text from its opening bracket, return (end index or None if truncated, safe cut points)
+    a cut point is a prefix that ends right after a complete value, with the brackets still open at that point
+    """
+    stack = []
+    cuts = []
+    quote = None
+    esc = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if quote:
+            if esc:
+                esc = False
+            elif ch == '\\':
+                esc = True
+            elif ch == quote:
+                quote = None
+            continue
+        if ch in '"\'':
+            quote = ch
+        elif ch in '{[':
+            stack.append(ch)
+        elif ch in '}]':
+            if stack:
+                stack.pop()
+            if not stack:
+                return i + 1, cuts
+            cuts.append((i + 1, list(stack)))
+        elif ch == ',':
+            cuts.append((i, list(stack)))
+    return None, cuts
+
+def close_truncated(text, cuts, start=0):
+    """
+    close the brackets left open at the last cut point that gives valid json, cuts are offsets into text (see scan)
+    and the json starts at start
+    """
+    for end, stack in reversed(cuts):
+        prefix = text[start:end].rstrip().rstrip(',')
+        candidate = prefix + ''.join('}' if b == '{' else ']' for b in reversed(stack))
+        try:
+            return loads_lenient(candidate)
+        except ValueError:
+            continue
+    raise ValueError('truncated json could not be closed')
+
+def loads_lenient(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        # single quotes, True/False/None
+        return literal_eval(text)
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        pass
+    fixed = text.replace('“', '"').replace('”', '"').replace('‘', "'").replace('’', "'")
+    fixed = re.sub(r',\s*([}\]])', r'\1', fixed)
+    fixed = re.sub(r'\bTrue\b', 'true', re.sub(r'\bFalse\b', 'false', re.sub(r'\bNone\b', 'null', fixed)))
+    try:
+        return json.loads(fixed)
+    except ValueError:
+        pass
+    try:
+        return literal_eval(re.sub(r'\btrue\b', 'True', re.sub(r'\bfalse\b', 'False', re.sub(r'\bnull\b', 'None', fixed))))
+    except (ValueError, SyntaxError, MemoryError, RecursionError):
+        raise ValueError('not valid json')
+
+def extract_json(raw):
+    """
+    return (parsed object, outcome) from the first json object or array found in raw
+    """
+    raw = raw.strip()
+    try:
+        return json.loads(raw), 'ok'
+    except ValueError:
+        pass
+    match = re.search(r'[{\[]', raw)
+    if not match:
+        raise ParseError('no json object in response')
+    end, cuts = scan(raw, match.start())
+    try:
+        if end is not None:
+            return loads_lenient(raw[match.start():end]), 'repaired'
+        return close_truncated(raw, cuts, match.start()), 'salvaged'
+    except ValueError as e:
+        raise ParseError(str(e))
+
+def salvage_list(model, items):
+    """
+    keep items valid against model, return (valid item dicts, number dropped)
+    """
+    if not isinstance(items, list):
+        return [], 1
+    valid = []
+    for item in items:
+        try:
+            valid.append(model.model_validate(item).model_dump())
+        except ValidationError:
+            continue
+    return valid, len(items) - len(valid)
+
+def parse_response(stage, raw):
+    """
+    parse and validate the response of a stage prompt, return data in the prompt's output format
+    """
+    try:
+        data, outcome = extract_json(raw)
+        if stage == 'topic_level':
+            if isinstance(data, list) and data:
+                data = data[0]
+            try:
+                res = TopicLevel.model_validate(data).model_dump()
+            except ValidationError as e:
+                raise ParseError(str(e))
+        elif stage in LIST_STAGES:
+            key, model = LIST_STAGES[stage]
+            items = data if isinstance(data, list) else data.get(key) if isinstance(data, dict) else None
+            if isinstance(data, list):
+                outcome = 'repaired' if outcome == 'ok' else outcome
+            valid, dropped = salvage_list(model, items)
+            if not valid:
+                raise ParseError(f'no valid item in {key}')
+            if dropped:
+                outcome = 'salvaged'
+            res = {key: valid}
+        else:
+            res = data
+    except ParseError as e:
+        parse_stats[(stage, 'failed')] += 1
+        logger.warning(f'Parse {stage} response failed: {e}')
+        raise
+    parse_stats[(stage, outcome)] += 1
+    if outcome != 'ok':
+        logger.info(f'Parse {stage} response: {outcome}')
+    return res
+
+def parse_partial(stage, raw):
+    """
+    valid items of a list stage response that is still being generated, not counted in parse_stats
+    """
+    key, model = LIST_STAGES[stage]
+    match = re.search(r'[{\[]', raw)
+    if not match:
+        return []
+    end, cuts = scan(raw, match.start())
+    # only cut between list items, an item still being written could pass validation without its last fields
+    depth = 2 if match.group() == '{' else 1
+    cuts = [(i, stack) for i, stack in cuts if len(stack) <= depth]
+    try:
+        data = loads_lenient(raw[match.start():end]) if end is not None else close_truncated(raw, cuts, match.start())
+    except ValueError:
+        return []
+    items = data if isinstance(data, list) else data.get(key) if isinstance(data, dict) else None
+    valid, _ = salvage_list(model, items)
+    return valid
+
+def salvage_rate(stage=None):
+    """
+    share of responses that would have been thrown away by a strict parser but were used
+    """
+    counts = Counter()
+    for (s, outcome), n in parse_stats.items():
+        if stage is None or s == stage:
+            counts[outcome] += n
+    total = sum(counts.values())
+    return (counts['repaired'] + counts['salvaged']) / total if total else 0.0
@@ -1,10 +1,11 @@
 import string
 import time
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, Tuple
 
 from dataclasses import dataclass
 from nltk import sent_tokenize
 import numpy as np
+import scipy.sparse as sps
 import spacy
 import networkx as nx
 
@@ -35,6 +36,60 @@ verb_phrases = [('AUX', 'VERB', 'ADP'),
                 ('VERB', 'ADP'),
                 ]
 
+_nlp = None
+
+def load_nlp():
+    """
+    spacy pipeline shared by every Doc of the process, loaded once (cpu pool workers load it in their initializer)
+    """
+    global _nlp
+    if _nlp is None:
+        _nlp = spacy.load('en_core_web_sm')
+    return _nlp
+
+def pagerank(nodes, edges, alpha=0.85, max_iter=100, tol=1e-6) -> dict:
+    """
+    same scores as nx.pagerank of the undirected graph Doc builds from nodes and edges ((u, v, {'weight': w})),
+    a sparse power iteration on the edge list, without building the networkx graph
+    """
+    index = {}
+    for n in nodes:
+        index.setdefault(n, len(index))
+    for u, v, _ in edges:
+        index.setdefault(u, len(index))
+        index.setdefault(v, len(index))
+    n = len(index)
+    if n == 0:
+        return {}
+    # nx.Graph keeps one edge per pair of nodes, the weight added last wins
+    weights = {}
+    for u, v, attrs in edges:
+        i, j = index[u], index[v]
+        weights[(min(i, j), max(i, j))] = attrs['weight']
+    rows, cols, vals = [], [], []
+    for (i, j), w in weights.items():
+        rows.append(i)
+        cols.append(j)
+        vals.append(w)
+        if i != j:
+            rows.append(j)
+            cols.append(i)
+            vals.append(w)
+    a = sps.csr_array((vals, (rows, cols)), shape=(n, n), dtype=float)
+    out = a.sum(axis=1)
+    dangling = out == 0
+    out[dangling] = 1.0
+    # x @ (D^-1 A) with D the weighted degrees, without building the normalized matrix
+    inv_out = 1.0 / out
+    p = np.full(n, 1.0 / n)
+    x = p.copy()
+    for _ in range(max_iter):
+        last = x
+        x = alpha * ((x * inv_out) @ a + x[dangling].sum() * p) + (1 - alpha) * p
+        if np.abs(x - last).sum() < n * tol:
+            return dict(zip(index, x.tolist()))
+    raise nx.PowerIterationFailedConvergence(max_iter)
+
 @dataclass(frozen=True)
 class Lemma:
     lemma: str
@@ -83,14 +138,15 @@ class Sentence():
     tokens: List[Token]
     id: int
 
-    def __init__(self, text, pos, spacy_model):
+    def __init__(self, text, pos, spacy_model, parsed=None):
         self.text = text
         self.id = pos
         self.spacy_model = spacy_model
-        self.__build()
+        self.__build(parsed)
 
-    def __build(self):
-        doc = self.spacy_model(self.text)
+    def __build(self, parsed=None):
+        # parsed: spacy doc of text when it was already run through the pipeline (nlp.pipe in analyze_many)
+        doc = parsed if parsed is not None else self.spacy_model(self.text)
         tokens = self.__extract_token(doc)
         chunks = self.__extract_chunks(doc)
         words = self.__process_chunk(chunks, tokens)
@@ -221,21 +277,22 @@ class Dictionary():
             
     
 class Doc():
-    def __init__(self, window_size=3, epochs=10, threshold=1e-5, d=0.85, lim_phrases=10):
+    def __init__(self, window_size=3, epochs=10, threshold=1e-5, d=0.85, lim_phrases=10, vectorized=False):
         self.window_size = window_size
         self.epochs = epochs
         self.threshold = threshold
         self.d = d
         self.lim_phrases = lim_phrases
-        self.nlp = spacy.load('en_core_web_sm')
+        self.vectorized = vectorized # rank with pagerank() instead of building a networkx graph
+        self.nlp = load_nlp()
         self.run_time = 0.0
+        self.phase_times = {}
         self.sents = []
         self.__w = []
         self.vocab = []
         self.g = nx.Graph()
 
-    def __split(self, text):
-        sents = sent_tokenize(text)
+    def __parse(self, sents):
         pos = 0
         res_sents = []
         for sent in sents:
@@ -321,18 +378,46 @@ class Doc():
 
     def fit(self, text):
         t0 = time.time()
+        # seconds spent in each phase, for benchmarks and tracing
+        phases = [t0]
+
+        sents = sent_tokenize(text)
+        phases.append(time.time())
+        self.sents = self.__parse(sents)
+        phases.append(time.time())
+        phases += self.__rank_sents()
 
-        self.sents = self.__split(text)
+        self.phase_times = {k: phases[i + 1] - phases[i] for i, k in enumerate(['split', 'parse', 'graph', 'rank', 'score'])}
+        self.run_time = time.time() - t0
+
+    def fit_parsed(self, sents):
+        """
+        fit on Sentences already parsed (see analyze_many), only the graph, rank and score phases are run
+        """
+        t0 = time.time()
+        self.sents = sents
+        phases = [t0] + self.__rank_sents()
+        self.phase_times = {k: phases[i + 1] - phases[i] for i, k in enumerate(['graph', 'rank', 'score'])}
+        self.run_time = time.time() - t0
+
+    def __rank_sents(self):
+        """
+        graph, rank and score phases, return the time each one ended
+        """
+        phases = []
         self.__get_w()
         nodes = self.__get_nodes()
         edges = self.__get_edges()
-        self.__create_graph(nodes, edges)
-        self.__rank = nx.pagerank(self.g)
+        if not self.vectorized:
+            self.__create_graph(nodes, edges)
+        phases.append(time.time())
+        self.__rank = pagerank(nodes, edges) if self.vectorized else nx.pagerank(self.g)
+        phases.append(time.time())
         kws = self.__get_scores()
         self.vocab = self.__process_res(kws)
         self.top_sents_ids = self.__calc_sent_dist()
-
-        self.run_time = time.time() - t0
+        phases.append(time.time())
+        return phases
 
     def __calc_base_vec(self, n):
         vec = np.array([kws['score'] for _, kws in self.vocab.items()])[:n]
@@ -342,7 +427,8 @@ class Doc():
         return vec
     
     def __calc_sent_dist(self):
-        n = self.lim_phrases
+        # short texts can have fewer phrases than lim_phrases
+        n = min(self.lim_phrases, len(self.vocab))
         unit_vec = self.__calc_base_vec(n)
 
         sent_mat = np.zeros((len(self.sents), n))
@@ -377,6 +463,19 @@ class Doc():
         else:
             return [self.sents[i] for i, _ in self.top_sents_ids]
 
+    def compress(self, budget, length=len):
+        """
+        highest ranked sentences that fit in budget (measured with length), in original order
+        """
+        picked = []
+        total = 0
+        for i, _ in self.top_sents_ids:
+            l = length(self.sents[i].text)
+            if total + l <= budget:
+                picked.append(i)
+                total += l
+        return ' '.join([self.sents[i].text for i in sorted(picked)])
+
     def summarize(self, lim_sents=4, preserved=True):
         sents = self.__extract_top_sents(lim_sents, preserved)
         return ' '.join([s.text for s in sents])
@@ -405,12 +504,79 @@ class Doc():
         return qs
             
     
-    def gen_questions(self):
-        return {i:self.__build_questions(i) for i, _ in self.top_sents_ids}
+    def gen_questions(self, n=None):
+        """
+        cloze questions of the n top ranked sentences (all by default), keyed by sentence id
+        """
+        return {i:self.__build_questions(i) for i, _ in self.top_sents_ids[:n]}
     
     def get_lemmas(self):
         return self.__rank.items()
 
+    def get_keywords(self, n=10):
+        """
+        top n keywords as dicts of text, root lemma, root pos and score
+        """
+        return [
+            {'text': text, 'lemma': v['words'][0].root.lemma, 'pos': v['words'][0].root.pos, 'score': v['score']}
+            for text, v in list(self.vocab.items())[:n]
+        ]
+
+def analyze_many(texts: Iterable[str], batch_size=256, n_process=1, n_keywords=10, n_sents=5, n_questions=6, **doc_options) -> Iterator[dict]:
+    """
+    textrank over many transcripts sharing one spacy pipeline: the sentences of every text go through a single
+    nlp.pipe stream (split over n_process processes when > 1) and each text is ranked with pagerank() as soon as
+    its last sentence is parsed
+
+    yields one result per text, in order: top keywords (as Doc.get_keywords), top ranked sentences and cloze
+    questions of the top sentences (as Doc.gen_questions), only the text being assembled and the sentences
+    buffered by nlp.pipe are kept in memory, so texts can be a lazy iterable over the whole library
+    doc_options are passed to Doc, e.g. window_size=4, epochs=15
+    """
+    nlp = load_nlp()
+    counts = {} # number of sentences of the texts read but not yielded yet, filled as nlp.pipe consumes the stream
+    read = 0
+
+    def stream():
+        nonlocal read
+        for idx, text in enumerate(texts):
+            sents = sent_tokenize(text)
+            counts[idx] = len(sents)
+            read += 1
+            for pos, sent in enumerate(sents):
+                yield sent, (idx, pos)
+
+    def result(sents):
+        if not sents:
+            return {'keywords': [], 'top_sents': [], 'questions': [], 'n_sents': 0, 'fit_time': 0.0}
+        doc = Doc(vectorized=True, **doc_options)
+        doc.fit_parsed(sents)
+        return {
+            'keywords': doc.get_keywords(n_keywords),
+            'top_sents': [doc.sents[i].text for i, _ in doc.top_sents_ids[:n_sents]],
+            'questions': list(doc.gen_questions(n_questions).values()),
+            'n_sents': len(sents),
+            'fit_time': doc.run_time,
+        }
+
+    current = 0
+    sents = []
+    for parsed, (idx, pos) in nlp.pipe(stream(), as_tuples=True, batch_size=batch_size, n_process=n_process):
+        # texts without sentences never reach the pipe
+        while current < idx:
+            counts.pop(current)
+            yield result([])
+            current += 1
+        sents.append(Sentence(parsed.text, pos, nlp, parsed))
+        if len(sents) == counts[idx]:
+            counts.pop(idx)
+            yield result(sents)
+            current += 1
+            sents = []
+    while current < read:
+        yield result([])
+        current += 1
+
 """
 TODO:
     - Keywords Extraction (Done) - Still need improved
@@ -0,0 +1,222 @@
+"""
+Tracing for the ingest pipeline
+
+- span(): time a unit of work (llm call, cache lookup, textrank fit) inside a stage, attributes are filled by the caller
+- traced_call(): run a stage function in a worker (process or thread) and return the spans recorded while it ran,
+  together with wall, cpu time and parse outcome counts, so they can be sent back to the main process
+- metrics: counters and sums kept in the main process, rendered in prometheus text format
+- export(): write finished spans as OpenTelemetry (OTLP json) spans to TRACE_FILE and/or TRACE_OTLP_ENDPOINT
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import requests
+
+from .response_parser import parse_stats, salvage_rate
+
+logger = logging.getLogger('uvicorn.error')
+
+TRACE_FILE = os.environ.get('TRACE_FILE') # json lines, one span per line
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT') # e.g. http://localhost:4318/v1/traces
+SERVICE_NAME = 'youtube-to-resource'
+
+# spans of the stage running in the current context, propagated to chunk threads by chunking.map_chunks
+_spans: ContextVar[list | None] = ContextVar('spans', default=None)
+
+@contextmanager
+def span(name, **attrs):
+    """
+    record a child span of the current stage, no-op outside traced_call
+    """
+    spans = _spans.get()
+    start = time.time()
+    try:
+        yield attrs
+    except Exception as e:
+        attrs['error'] = str(e)
+        raise
+    finally:
+        if spans is not None:
+            spans.append({'name': name, 'start': start, 'end': time.time(), 'attrs': attrs})
+
+def traced_call(fn, *args, **kwargs):
+    """
+    run fn and return (result, trace), on failure the trace is attached to the exception
+    must stay a module level function to be sent to a process pool
+    """
+    spans = []
+    token = _spans.set(spans)
+    # a process pool worker runs one task at a time on its main thread, a thread shares the process with others
+    clock = time.process_time if threading.current_thread() is threading.main_thread() else time.thread_time
+    stats = Counter(parse_stats)
+    started = time.time()
+    cpu = clock()
+    try:
+        res = fn(*args, **kwargs)
+    except Exception as e:
+        e.trace = make_trace(started, clock() - cpu, spans, stats)
+        raise
+    finally:
+        _spans.reset(token)
+    return res, make_trace(started, clock() - cpu, spans, stats)
+
+def make_trace(started, cpu, spans, stats):
+    delta = Counter(parse_stats)
+    delta.subtract(stats)
+    return {
+        'pid': os.getpid(),
+        'started': started,
+        'ended': time.time(),
+        'cpu': cpu,
+        'spans': spans,
+        'parse_stats': [[stage, outcome, n] for (stage, outcome), n in delta.items() if n > 0]
+    }
+
+def summarize(trace, submitted) -> dict:
+    """
+    per stage numbers kept on the job: wall time (from submit), queue wait, cpu time, llm tokens, bytes and cache hits
+    """
+    res = Counter()
+    for s in trace['spans']:
+        for k in ('prompt_tokens', 'completion_tokens', 'bytes_sent', 'bytes_received', 'cache_hits', 'cache_misses'):
+            res[k] += s['attrs'].get(k, 0)
+        if s['name'] == 'llm.completion':
+            res['llm_calls'] += 1
+    return {
+        'wall': round(trace['ended'] - submitted, 3),
+        'queue': round(max(trace['started'] - submitted, 0), 3),
+        'cpu': round(trace['cpu'], 3),
+        **res
+    }
+
+class Metrics():
+    """
+    minimal prometheus registry: counters and summaries (sum + count) with labels
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = defaultdict(float)
+        self.types = {}
+        self.helps = {}
+
+    def inc(self, name, value=1, help='', type='counter', **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] += value
+            self.types.setdefault(name, type)
+            self.helps.setdefault(name, help)
+
+    def observe(self, name, value, help='', **labels):
+        self.inc(f'{name}_sum', value, help, 'summary', **labels)
+        self.inc(f'{name}_count', 1, help, 'summary', **labels)
+
+    def render(self, gauges=None) -> str:
+        lines = []
+        with self.lock:
+            items = sorted(self.values.items())
+        seen = set()
+        for (name, labels), value in items:
+            family = name.removesuffix('_sum').removesuffix('_count') if self.types[name] == 'summary' else name
+            if family not in seen:
+                seen.add(family)
+                if self.helps[name]:
+                    lines.append(f'# HELP {family} {self.helps[name]}')
+                lines.append(f'# TYPE {family} {self.types[name]}')
+            lines.append(f'{name}{format_labels(labels)} {value:g}')
+        for name, value in (gauges or {}).items():
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+metrics = Metrics()
+
+def render_metrics(gauges=None) -> str:
+    """
+    registry plus llm response parse outcomes (see response_parser) and the given gauges
+    """
+    lines = ['# HELP llm_parse_total Llm responses by parse outcome', '# TYPE llm_parse_total counter']
+    for (stage, outcome), n in sorted(parse_stats.items()):
+        lines.append(f'llm_parse_total{format_labels([('outcome', outcome), ('stage', stage)])} {n}')
+    gauges = {**(gauges or {}), 'llm_salvage_ratio': salvage_rate()}
+    return metrics.render(gauges) + '\n'.join(lines) + '\n'
+
+def observe_stage(stage, trace, summary):
+    """
+    update metrics with the trace of a stage run in a worker, parse outcomes are merged into this process' parse_stats
+    """
+    metrics.observe('ingest_stage_queue_seconds', summary['queue'], 'Time a stage waited for a worker', stage=stage)
+    metrics.observe('ingest_stage_cpu_seconds', summary['cpu'], 'Cpu time of a stage in its worker', stage=stage)
+    for s in trace['spans']:
+        a = s['attrs']
+        if s['name'] == 'llm.completion':
+            metrics.observe('llm_request_seconds', s['end'] - s['start'], 'Latency of completion requests', stage=stage)
+            metrics.inc('llm_tokens_total', a.get('prompt_tokens', 0), 'Estimated llm tokens', stage=stage, kind='prompt')
+            metrics.inc('llm_tokens_total', a.get('completion_tokens', 0), 'Estimated llm tokens', stage=stage, kind='completion')
+        if a.get('bytes_sent') or a.get('bytes_received'):
+            metrics.inc('ingest_bytes_total', a.get('bytes_sent', 0), 'Bytes transferred by external calls', stage=stage, direction='sent')
+            metrics.inc('ingest_bytes_total', a.get('bytes_received', 0), 'Bytes transferred by external calls', stage=stage, direction='received')
+        if 'cache' in a:
+            metrics.inc('cache_requests_total', a.get('cache_hits', 0), 'Cache lookups', cache=a['cache'], result='hit')
+            metrics.inc('cache_requests_total', a.get('cache_misses', 0), 'Cache lookups', cache=a['cache'], result='miss')
+    # a stage run in a thread of this process already counted its outcomes here
+    if trace['pid'] != os.getpid():
+        for st, outcome, n in trace['parse_stats']:
+            parse_stats[(st, outcome)] += n
+
+def otlp_value(v):
+    if isinstance(v, bool):
+        return {'boolValue': v}
+    if isinstance(v, int):
+        return {'intValue': str(v)}
+    if isinstance(v, float):
+        return {'doubleValue': v}
+    return {'stringValue': str(v)}
+
+def otlp_span(s, trace_id):
+    return {
+        'traceId': trace_id,
+        'spanId': s['span_id'],
+        'parentSpanId': s.get('parent_id') or '',
+        'name': s['name'],
+        'kind': 1,
+        'startTimeUnixNano': str(int(s['start'] * 1e9)),
+        'endTimeUnixNano': str(int(s['end'] * 1e9)),
+        'attributes': [{'key': k, 'value': otlp_value(v)} for k, v in s['attrs'].items() if v is not None],
+        'status': {'code': 2 if s['attrs'].get('error') or s['attrs'].get('status') == 'FAILED' else 1}
+    }
+
+def export(trace_id, spans):
+    """
+    spans need span_id and parent_id (16 hex chars), blocking: run off the event loop
+    """
+    if not spans or not (TRACE_FILE or TRACE_OTLP_ENDPOINT):
+        return
+    otlp = [otlp_span(s, trace_id) for s in spans]
+    if TRACE_FILE:
+        try:
+            with open(TRACE_FILE, 'a') as f:
+                for s in otlp:
+                    f.write(json.dumps(s) + '\n')
+        except OSError as e:
+            logger.warning(f'Write trace {trace_id} failed: {e}')
+    if TRACE_OTLP_ENDPOINT:
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': SERVICE_NAME}}]},
+            'scopeSpans': [{'scope': {'name': 'ingest'}, 'spans': otlp}]
+        }]}
+        try:
+            requests.post(TRACE_OTLP_ENDPOINT, json=payload, timeout=5)
+        except Exception as e:
+            logger.warning(f'Send trace {trace_id} failed: {e}')
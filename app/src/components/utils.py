@@ -1,19 +1,33 @@
 from concurrent.futures import ThreadPoolExecutor
 import os
-import webvtt
+import threading
+import time
 import re
 import json
 import requests
 from io import StringIO
-from nltk.stem import WordNetLemmatizer
 
-from yt_dlp import YoutubeDL
+from .tracing import span
 
 def get_channel_video_url(channel_id):
     return f'https://www.youtube.com/channel/{channel_id}/videos'
 
+# yt_dlp, webvtt and nltk are imported on first use, they are only needed by ingest work (see benchmarks/import_time.py)
+
+_lemmatizer = None # nltk WordNetLemmatizer
+_lemmatizer_lock = threading.Lock()
+
 def lemmatize(word):
-    return WordNetLemmatizer().lemmatize(word)
+    global _lemmatizer
+    if _lemmatizer is None:
+        # nltk's lazy corpus loader is not thread safe, load wordnet once before sharing the lemmatizer
+        with _lemmatizer_lock:
+            if _lemmatizer is None:
+                from nltk.stem import WordNetLemmatizer
+                lemmatizer = WordNetLemmatizer()
+                lemmatizer.lemmatize('warm')
+                _lemmatizer = lemmatizer
+    return _lemmatizer.lemmatize(word)
 
 def get_channel_info(url):
     opts = {
@@ -22,6 +36,7 @@ def get_channel_info(url):
         'no_warnings': True,
         'quiet': True,
     }
+    from yt_dlp import YoutubeDL
     with YoutubeDL(opts) as ydl:
         try:
             channel_dict = ydl.extract_info(url)
@@ -47,6 +62,7 @@ def get_id_from_playlist(url):
         # 'no_warnings': True,
         # 'quiet': True,
     }
+    from yt_dlp import YoutubeDL
     with YoutubeDL(opts) as ydl:
         try:
             playlist_dict = ydl.extract_info(url)
@@ -147,6 +163,7 @@ def get_vid_info(url, download_video=False, vid_dir=None):
         # 'quiet': True,
         # 'no_warnings': True,
     }
+    from yt_dlp import YoutubeDL
     with YoutubeDL(opts) as ydl:
         try:
             info_dict = ydl.extract_info(url)
@@ -154,6 +171,85 @@ def get_vid_info(url, download_video=False, vid_dir=None):
             return None
     return info_dict
 
+VIDEO_INFO_TTL = int(os.environ.get('VIDEO_INFO_TTL', 3600))
+VIDEO_INFO_FIELDS = ['id', 'title', 'duration', 'thumbnail', 'channel_url', 'subtitles', 'automatic_captions']
+# stand-in serving yt-dlp info dicts as json at {YOUTUBE_INFO_URL}{video id}, for load tests (see benchmarks.stub_server)
+YOUTUBE_INFO_URL = os.environ.get('YOUTUBE_INFO_URL')
+
+_ydl_local = threading.local()
+_vid_info_cache: dict[str, tuple[float, dict]] = {}
+_vid_info_lock = threading.Lock()
+
+def get_video_id(url):
+    match = re.search(r'(?:v=|youtu\.be/|shorts/)([\w-]{11})', url)
+    return match.group(1) if match else url
+
+def get_meta_ydl():
+    """
+    one YoutubeDL instance per worker (process or thread), reused across calls
+    """
+    ydl = getattr(_ydl_local, 'ydl', None)
+    if ydl is None:
+        opts = {
+            'skip_download': True,
+            'quiet': True,
+            'no_warnings': True,
+            'noplaylist': True,
+            # dash/hls manifests are only needed to resolve formats
+            'extractor_args': {'youtube': {'skip': ['dash', 'hls']}},
+        }
+        from yt_dlp import YoutubeDL
+        ydl = YoutubeDL(opts)
+        _ydl_local.ydl = ydl
+    return ydl
+
+def get_vid_meta(url):
+    """
+    slim alternative to get_vid_info, only keep fields needed to build video info and fetch subtitles
+    Params:
+        - url: Youtube video url
+    info_fields:
+        - id
+        - title
+        - duration
+        - thumbnail
+        - channel_url
+        - subtitles (en only)
+        - automatic_captions (en only)
+    """
+    vid = get_video_id(url)
+    with _vid_info_lock:
+        cached = _vid_info_cache.get(vid)
+    if cached and cached[0] > time.monotonic():
+        with span('youtube.info', cache='video_info', cache_hits=1):
+            return cached[1]
+
+    with span('youtube.info', cache='video_info', cache_misses=1):
+        try:
+            if YOUTUBE_INFO_URL:
+                res = requests.get(f'{YOUTUBE_INFO_URL}{vid}')
+                res.raise_for_status()
+                info_dict = res.json()
+            else:
+                # process=False returns the raw extractor result, skipping format selection/sorting
+                info_dict = get_meta_ydl().extract_info(url, download=False, process=False)
+        except Exception as e:
+            return None
+
+    meta = {k: info_dict.get(k) for k in VIDEO_INFO_FIELDS}
+    if not meta['thumbnail'] and info_dict.get('thumbnails'):
+        meta['thumbnail'] = max(info_dict['thumbnails'], key=lambda t: (t.get('preference') or 0, t.get('width') or 0))['url']
+    for k in ['subtitles', 'automatic_captions']:
+        meta[k] = {lang: v for lang, v in (meta[k] or {}).items() if lang.startswith('en')}
+
+    # called from io pool threads, evicting iterates the dict
+    with _vid_info_lock:
+        now = time.monotonic()
+        for k in [k for k, (expire, _) in _vid_info_cache.items() if expire <= now]:
+            _vid_info_cache.pop(k)
+        _vid_info_cache[meta['id']] = (now + VIDEO_INFO_TTL, meta)
+    return meta
+
 def extract_vtt_info(info_dict):
     sub_info = []
     if len(info_dict['subtitles']) !=0:
@@ -212,6 +308,7 @@ def parse_vtt_from_text(payload):
     """
     extracts start time and text from vtt text and return a list of dicts
     """
+    import webvtt
     result = []
 
     buffer = StringIO(payload)
@@ -230,6 +327,7 @@ def parse_vtt(file_path):
     """
     extracts start time and text from vtt file and return a list of dicts
     """
+    import webvtt
     result = []
 
     for caption in webvtt.read(file_path):
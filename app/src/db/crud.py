@@ -1,6 +1,8 @@
 import logging
+import json
+import zlib
 
-from sqlalchemy import select
+from sqlalchemy import delete, select
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from . import models, schemas
@@ -61,6 +63,62 @@ async def get_videos_by_topic(db: AsyncSession, topic: str) -> (list[models.Vide
         logger.info(f'{prefix}: Found {len(videos)}')
         return videos
 
+async def get_existing_url_ids(db: AsyncSession, url_ids: list[str]) -> (set[str] | None):
+    prefix = f'Select existing videos among {len(url_ids)} url ids'
+    logger.info(f'{prefix}: Initiated')
+    try:
+        statement = select(models.Videos.url_id).where(models.Videos.url_id.in_(url_ids))
+        existing = set((await db.scalars(statement)).all())
+    except Exception as e:
+        logger.error(f'{prefix}: {e}')
+        return None
+    else:
+        logger.info(f'{prefix}: Found {len(existing)}')
+        return existing
+
+async def get_video_by_url_id(db: AsyncSession, url_id: str) -> (models.Videos | None):
+    prefix = f'Select video [{url_id}]'
+    logger.info(f'{prefix}: Initiated')
+    try:
+        video = (await db.scalars(select(models.Videos).filter_by(url_id=url_id))).one_or_none()
+    except Exception as e:
+        logger.error(f'{prefix}: {e}')
+        return None
+    else:
+        logger.info(f'{prefix}: {'Found' if video else 'Not found'}')
+        return video
+
+async def delete_video(db: AsyncSession, url_id: str) -> (bool | None):
+    """
+    delete a video with its subtitles, senses and lessions (vocabs are shared between videos and kept)
+    return False if there was no such video
+    """
+    prefix = f'Delete video [{url_id}]'
+    logger.info(f'{prefix}: Initiated')
+    try:
+        video_id = (await db.scalars(select(models.Videos.id).filter_by(url_id=url_id))).one_or_none()
+        if video_id is None:
+            logger.warn(f'{prefix}: Not found')
+            return False
+        lessions = select(models.Lessions.id).where(models.Lessions.video_id == video_id)
+        questions = select(models.Questions.id).where(models.Questions.lession_id.in_(lessions))
+        subtitles = select(models.Subtitles.id).where(models.Subtitles.video_id == video_id)
+        await db.execute(delete(models.Choices).where(models.Choices.question_id.in_(questions)))
+        await db.execute(delete(models.Questions).where(models.Questions.lession_id.in_(lessions)))
+        await db.execute(delete(models.Lessions).where(models.Lessions.video_id == video_id))
+        await db.execute(delete(models.Lines).where(models.Lines.sub_id.in_(subtitles)))
+        await db.execute(delete(models.Subtitles).where(models.Subtitles.video_id == video_id))
+        await db.execute(delete(models.Senses).where(models.Senses.video_id == video_id))
+        await db.execute(delete(models.Videos).where(models.Videos.id == video_id))
+        await db.commit()
+    except Exception as e:
+        await db.rollback()
+        logger.error(f'{prefix}: {e}')
+        return None
+    else:
+        logger.info(f'{prefix}: success')
+        return True
+
 async def create_video(db: AsyncSession, video: schemas.VideoCreate) -> (models.Videos | None):
     prefix = f'Insert {video.video_title}-[{video.url_id}]'
     logger.info(f'{prefix}: Initiated')
@@ -159,6 +217,100 @@ async def create_sense(db: AsyncSession, sense: schemas.SenseCreate) -> (models.
         logger.info(f'{prefix}: success')
         return db_sense
 
+def pack(obj) -> bytes:
+    return zlib.compress(json.dumps(obj, separators=(',', ':')).encode())
+
+def unpack(data: bytes):
+    return json.loads(zlib.decompress(data))
+
+async def create_transcript(db: AsyncSession, transcript: schemas.TranscriptCreate) -> (models.Transcripts | None):
+    prefix = f'Insert transcript of video [{transcript.url_id}]'
+    logger.info(f'{prefix}: Initiated')
+    try:
+        db_transcript = (await db.scalars(select(models.Transcripts).filter_by(url_id=transcript.url_id))).one_or_none()
+        if not db_transcript:
+            db_transcript = models.Transcripts(url_id=transcript.url_id)
+            db.add(db_transcript)
+        db_transcript.text = pack(transcript.text)
+        db_transcript.lines = pack(transcript.lines)
+        await db.commit()
+        await db.refresh(db_transcript)
+    except Exception as e:
+        logger.error(f'{prefix}: {e}')
+        return None
+    else:
+        logger.info(f'{prefix}: success')
+        return db_transcript
+
+async def get_transcript(db: AsyncSession, url_id: str) -> (schemas.Transcript | None):
+    prefix = f'Select transcript of video [{url_id}]'
+    logger.info(f'{prefix}: Initiated')
+    try:
+        db_transcript = (await db.scalars(select(models.Transcripts).filter_by(url_id=url_id))).one_or_none()
+        if not db_transcript:
+            logger.warn(f'{prefix}: Not found')
+            return None
+        transcript = schemas.Transcript(
+            id=db_transcript.id,
+            url_id=db_transcript.url_id,
+            text=unpack(db_transcript.text),
+            lines=unpack(db_transcript.lines)
+        )
+    except Exception as e:
+        logger.error(f'{prefix}: {e}')
+        return None
+    else:
+        logger.info(f'{prefix}: Found')
+        return transcript
+
+async def create_job_archives(db: AsyncSession, archives: list[schemas.JobArchiveCreate]) -> (list[models.JobArchives] | None):
+    prefix = f'Insert {len(archives)} job archives'
+    logger.info(f'{prefix}: Initiated')
+    try:
+        uids = [a.uid for a in archives]
+        existing = {a.uid: a for a in await db.scalars(select(models.JobArchives).filter(models.JobArchives.uid.in_(uids)))}
+        db_archives = []
+        for a in archives:
+            db_archive = existing.get(a.uid)
+            if not db_archive:
+                db_archive = models.JobArchives(uid=a.uid)
+                db.add(db_archive)
+            db_archive.status = a.status
+            db_archive.created_at = a.created_at
+            db_archive.finished_at = a.finished_at
+            db_archive.states = pack(a.states)
+            db_archives.append(db_archive)
+        await db.commit()
+    except Exception as e:
+        logger.error(f'{prefix}: {e}')
+        return None
+    else:
+        logger.info(f'{prefix}: success')
+        return db_archives
+
+async def get_job_archive(db: AsyncSession, uid: str) -> (schemas.JobArchive | None):
+    prefix = f'Select job archive [{uid}]'
+    logger.info(f'{prefix}: Initiated')
+    try:
+        db_archive = (await db.scalars(select(models.JobArchives).filter_by(uid=uid))).one_or_none()
+        if not db_archive:
+            logger.warn(f'{prefix}: Not found')
+            return None
+        archive = schemas.JobArchive(
+            id=db_archive.id,
+            uid=db_archive.uid,
+            status=db_archive.status,
+            created_at=db_archive.created_at,
+            finished_at=db_archive.finished_at,
+            states=unpack(db_archive.states)
+        )
+    except Exception as e:
+        logger.error(f'{prefix}: {e}')
+        return None
+    else:
+        logger.info(f'{prefix}: Found')
+        return archive
+
 async def get_lession_by_id(db: AsyncSession, id: int) -> (models.Lessions | None):
     prefix = f'Select lession [{id}]'
     logger.info(f'{prefix}: Initiated')
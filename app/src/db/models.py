@@ -97,6 +97,24 @@ class Subtitles(BaseModel):
     video: Mapped['Videos'] = relationship(back_populates="sub")
     lines: Mapped[list['Lines']] = relationship(back_populates='subtitle')
 
+class Transcripts(BaseModel):
+    __tablename__ = 'transcripts'
+
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    url_id: Mapped[str] = mapped_column(index=True, unique=True)
+    text: Mapped[bytes] # zlib compressed
+    lines: Mapped[bytes] # zlib compressed json
+
+class JobArchives(BaseModel):
+    __tablename__ = 'job_archives'
+
+    id: Mapped[int] = mapped_column(primary_key=True, index=True)
+    uid: Mapped[str] = mapped_column(index=True, unique=True)
+    status: Mapped[int]
+    created_at: Mapped[float]
+    finished_at: Mapped[float]
+    states: Mapped[bytes] # zlib compressed json, status and timing of each stage
+
 class Lines(BaseModel):
     __tablename__ = 'lines'
 
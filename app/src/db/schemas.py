@@ -27,6 +27,30 @@ class SubtitleLinesCreate(SubtitleLinesBase):
 class SubtitleLines(SubtitleLinesBase):
     id: int
 
+class TranscriptBase(BaseModel):
+    url_id: str
+    text: str
+    lines: list[dict]
+
+class TranscriptCreate(TranscriptBase):
+    pass
+
+class Transcript(TranscriptBase):
+    id: int
+
+class JobArchiveBase(BaseModel):
+    uid: str
+    status: int
+    created_at: float
+    finished_at: float
+    states: dict[str, dict]
+
+class JobArchiveCreate(JobArchiveBase):
+    pass
+
+class JobArchive(JobArchiveBase):
+    id: int
+
 class VideoBase(BaseModel):
     url_id: str
     video_title: str
@@ -124,6 +148,15 @@ class ResponseVocab(BaseModel):
 
 class RequestVideo(BaseModel):
     url: str =  Field(min_length=30, max_length=50, pattern=r'^https://www\.youtube\.com/watch\?v=.')
+    force: bool = Field(default=False, description='Process again even if the video is already in db')
+
+class RequestPlaylist(BaseModel):
+    url: str = Field(max_length=200, pattern=r'^https://www\.youtube\.com/(playlist\?list=|watch\?v=.+&list=).')
+    concurrency: int | None = Field(default=None, ge=1, le=32, description='Max videos processed at once')
+
+class RequestChannel(BaseModel):
+    url: str = Field(max_length=200, pattern=r'^https://www\.youtube\.com/(channel/|c/|user/|@).')
+    concurrency: int | None = Field(default=None, ge=1, le=32, description='Max videos processed at once')
 
 class ResponseVideo(BaseModel):
     clip_id: int = Field(default='', description='Video id')
@@ -0,0 +1,87 @@
+"""
+Import time budget of the api process, a fresh interpreter runs `import app.main` under `python -X importtime`
+
+    python -m benchmarks.import_time
+    python -m benchmarks.import_time --budget 0.5 --repeat 5 --top 15
+
+The fastest of --repeat runs is compared with --budget (seconds). The check fails (exit code 1) when it is over
+budget, or when one of the heavy nlp/scraping packages is imported with the app. They must be imported on first use
+or only in the cpu pool workers (see executors.warm_worker). The slowest top level packages are listed to find out
+what to defer next. tests/test_import_time.py runs the same check with pytest.
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# not needed to serve reads, loaded by ingest work
+HEAVY = ['spacy', 'nltk', 'numpy', 'scipy', 'networkx', 'yt_dlp', 'bs4', 'lxml', 'webvtt']
+
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)')
+
+def app_env(workdir, role=None) -> dict:
+    """
+    environment of a fresh interpreter importing the app, databases and caches in workdir, role sets APP_ROLE
+    """
+    env = {
+        **os.environ,
+        'DB_PATH': os.path.join(workdir, 'data.db'),
+        'DICT_CACHE_PATH': os.path.join(workdir, 'dictionary.db'),
+        'JOB_STORE_PATH': os.path.join(workdir, 'jobs.db'),
+        'LEXICON_PATH': os.path.join(workdir, 'lexicon.db'),
+    }
+    if role:
+        env['APP_ROLE'] = role
+    return env
+
+def import_app(workdir, role=None) -> list[tuple[int, int, int, str]]:
+    """
+    (self us, cumulative us, depth, module) of every module imported by app.main, in -X importtime order
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app.main'], cwd=ROOT, env=app_env(workdir, role), capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f'import app.main failed:\n{proc.stderr[-2000:]}')
+    res = []
+    for line in proc.stderr.splitlines():
+        m = LINE.match(line)
+        if m:
+            res.append((int(m.group(1)), int(m.group(2)), len(m.group(3)) // 2, m.group(4)))
+    return res
+
+def check(budget, repeat, top):
+    workdir = tempfile.mkdtemp(prefix='import-')
+    try:
+        runs = [import_app(workdir) for _ in range(repeat)]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    totals = [next(cum for _, cum, _, name in r if name == 'app.main') / 1e6 for r in runs]
+    best = runs[totals.index(min(totals))]
+
+    by_package = Counter()
+    for self_us, _, _, name in best:
+        by_package[name.split('.')[0]] += self_us
+    heavy = sorted({name.split('.')[0] for _, _, _, name in best} & set(HEAVY))
+
+    print(f'import app.main: {min(totals):.3f}s (min of {repeat}, budget {budget:.3f}s)')
+    print('slowest packages (self time):')
+    for name, us in by_package.most_common(top):
+        print(f'  {name:<24} {us / 1e3:8.1f}ms')
+    if heavy:
+        print(f'heavy packages imported with the app: {', '.join(heavy)}')
+    ok = min(totals) <= budget and not heavy
+    print('ok' if ok else 'FAILED')
+    return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the import time of the api against a budget')
+    parser.add_argument('--budget', type=float, default=0.8, help='seconds')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10, help='number of packages listed')
+    args = parser.parse_args()
+    sys.exit(0 if check(args.budget, args.repeat, args.top) else 1)
@@ -0,0 +1,77 @@
+"""
+Compare end-to-end latency of /video/create in stage mode (one llm request per stage) and fused mode (one request for all)
+
+    python -m benchmarks.llm_modes --videos 10
+    python -m benchmarks.llm_modes --videos 5 --latency 1.5 --jitter 0.5 --out llm_modes.json
+
+Same run as the e2e benchmark of benchmarks.run: videos are submitted to the app and polled until done, video info,
+subtitles, completions and dictionary pages are served by benchmarks.stub_server (--latency/--jitter delay every
+completion like the real API would). LLM_MODE is read when the app is imported, so every mode runs in its own
+interpreter with fresh databases and caches.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import traceback
+
+from .stub_server import start
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_mode(mode, base_url, videos):
+    """
+    bench_e2e in a child interpreter with LLM_MODE=mode
+    """
+    workdir = tempfile.mkdtemp(prefix=f'llm-{mode}-')
+    out = os.path.join(workdir, 'result.json')
+    try:
+        proc = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.llm_modes', '--child', out, '--base-url', base_url, '--videos', str(videos)],
+            cwd=ROOT, env={**os.environ, 'LLM_MODE': mode}, capture_output=True, text=True
+        )
+        if not os.path.exists(out):
+            return {'mode': mode, 'error': proc.stderr.strip().splitlines()[-1:]}
+        with open(out, encoding='utf-8') as f:
+            return {'mode': mode, **json.load(f)}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def child(args):
+    # settings are read at import time, the app is only imported after setup_env
+    from .run import setup_env, bench_e2e
+    workdir = os.path.dirname(args.child)
+    setup_env(args.base_url, workdir)
+    try:
+        res = bench_e2e(args, workdir)
+    except Exception as e:
+        traceback.print_exc()
+        res = {'error': repr(e)}
+    with open(args.child, 'w', encoding='utf-8') as f:
+        json.dump(res, f)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark stage vs fused llm mode end to end')
+    parser.add_argument('--videos', type=int, default=10, help='number of videos submitted per mode')
+    parser.add_argument('--modes', nargs='+', default=['stage', 'fused'], choices=['stage', 'fused'])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before the stub answers a completion')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--out', help='also write the results to this json file')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        sys.exit(0)
+
+    server, base_url = start(latency=args.latency, jitter=args.jitter)
+    results = [run_mode(m, base_url, args.videos) for m in args.modes]
+    server.shutdown()
+    print(json.dumps(results, indent=4))
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
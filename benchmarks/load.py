@@ -0,0 +1,219 @@
+"""
+Load driver: replay concurrent /video/create with read traffic, report jobs/min, p50/p99 per endpoint and event loop lag
+
+    python -m benchmarks.load --videos 50 --concurrency 10 --readers 4 --latency 1.0 --jitter 0.5 --error-rate 0.05
+
+By default a stub server (benchmarks.stub_server) and the app are started in this process, the app with uvicorn on
+its own thread and event loop so the loop lag can be probed from inside it. Databases and caches go to a temporary
+directory. With --url the load is sent to an app already running, started against a stub server
+(COMPLETION_URL, OXFORD_URL, YOUTUBE_INFO_URL), loop lag is not reported then.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from uuid import uuid4
+
+import httpx
+
+from .run import setup_env
+from .stub_server import start
+
+JOB_STATUS = {0: 'completed', 1: 'in_progress', 2: 'failed'}
+LAG_INTERVAL = 0.05 # seconds between two loop lag probes
+
+READS = [
+    ('video', '/nlp/api/video', lambda: {'id': random.randint(1, 50)}),
+    ('video_level', '/nlp/api/video/level', lambda: {'level': random.randint(0, 5)}),
+    ('video_topic', '/nlp/api/video/topic', lambda: {'topic': random.choice(['Travel', 'Culture', 'Work and business'])}),
+]
+
+class Recorder():
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.codes = defaultdict(Counter)
+
+    async def request(self, client: httpx.AsyncClient, name, method, url, **kwargs) -> httpx.Response | None:
+        t0 = time.perf_counter()
+        try:
+            res = await client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.codes[name][type(e).__name__] += 1
+            return None
+        self.latencies[name].append(time.perf_counter() - t0)
+        self.codes[name][res.status_code] += 1
+        return res
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else None
+
+def distribution(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 0.5),
+        'p99': percentile(values, 0.99),
+        'max': max(values, default=None),
+    }
+
+async def probe_lag(samples, interval=LAG_INTERVAL):
+    """
+    a sleep that wakes up late means the loop was busy with something else
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - t0 - interval))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def serve_app(port, lag_samples):
+    """
+    run the app with uvicorn on a thread with its own event loop, return (server, thread) once it accepts requests
+    """
+    import uvicorn
+    from app.main import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port, log_level='warning'))
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        probe = loop.create_task(probe_lag(lag_samples))
+        try:
+            loop.run_until_complete(server.serve())
+        finally:
+            probe.cancel()
+            loop.run_until_complete(asyncio.gather(probe, return_exceptions=True))
+            loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError('App failed to start')
+        time.sleep(0.05)
+    return server, thread
+
+async def ingest(client, rec: Recorder, vid, poll):
+    """
+    submit a video and poll its status until the job is finished, return the job status
+    """
+    res = await rec.request(client, 'create', 'POST', '/nlp/api/video/create', json={'url': f'https://www.youtube.com/watch?v={vid}'})
+    if res is None or res.status_code not in (200, 202):
+        return None
+    if res.status_code == 200:
+        return res.json()['status'] # already in db
+    while True:
+        await asyncio.sleep(poll)
+        res = await rec.request(client, 'status', 'GET', '/nlp/api/video/status', params={'uid': vid})
+        if res is not None and res.status_code == 200 and res.json()['status'] != 1:
+            return res.json()['status']
+
+async def reader(client, rec: Recorder, stop: asyncio.Event, interval):
+    while not stop.is_set():
+        name, path, params = random.choice(READS)
+        await rec.request(client, name, 'GET', path, params=params())
+        await asyncio.sleep(interval)
+
+async def drive(base_url, videos, concurrency, readers, read_interval, poll):
+    rec = Recorder()
+    semaphore = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+    # 11 characters like a youtube id, unique per run so videos of a previous run are not returned from db
+    prefix = uuid4().hex[:4]
+    vids = [f'{prefix}{n:07d}' for n in range(videos)]
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=600) as client:
+        async def one(vid):
+            async with semaphore:
+                return await ingest(client, rec, vid, poll)
+
+        t0 = time.perf_counter()
+        read_tasks = [asyncio.create_task(reader(client, rec, stop, read_interval)) for _ in range(readers)]
+        statuses = await asyncio.gather(*[one(v) for v in vids])
+        wall = time.perf_counter() - t0
+        stop.set()
+        await asyncio.gather(*read_tasks)
+    return vids, statuses, wall, rec
+
+def report(statuses, wall, rec: Recorder, lag_samples):
+    jobs = Counter(JOB_STATUS.get(s, 'rejected') for s in statuses)
+    return {
+        'videos': len(statuses),
+        'wall': wall,
+        'jobs': dict(jobs),
+        'jobs_per_min': jobs['completed'] / wall * 60 if wall else 0.0,
+        'endpoints': {
+            name: {**distribution(rec.latencies[name]), 'codes': {str(k): v for k, v in rec.codes[name].items()}}
+            for name in rec.codes
+        },
+        'loop_lag': distribution(lag_samples) if lag_samples is not None else None,
+    }
+
+def print_report(res):
+    print(f'{res['videos']} videos in {res['wall']:.1f}s, {res['jobs_per_min']:.1f} jobs/min, {res['jobs']}')
+    print(f'{'endpoint':<12} {'count':>7} {'p50':>9} {'p99':>9} {'max':>9}  codes')
+    rows = list(res['endpoints'].items())
+    if res['loop_lag'] is not None:
+        rows.append(('loop_lag', res['loop_lag']))
+    for name, d in rows:
+        cols = ' '.join(f'{d[k] * 1000:8.1f}ms' if d[k] is not None else f'{'-':>10}' for k in ('p50', 'p99', 'max'))
+        print(f'{name:<12} {d['count']:>7} {cols}  {d.get('codes', '')}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test video ingest against local stand-ins')
+    parser.add_argument('--url', help='base url of a running app, otherwise the app is started in this process')
+    parser.add_argument('--videos', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=5, help='videos being ingested at the same time')
+    parser.add_argument('--readers', type=int, default=2, help='concurrent clients sending read requests')
+    parser.add_argument('--read-interval', type=float, default=0.1)
+    parser.add_argument('--poll', type=float, default=0.5, help='seconds between two status requests of a video')
+    parser.add_argument('--latency', type=float, default=0.5, help='completion latency of the stub server')
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--stream', action='store_true', help='run the app with LLM_STREAM=1')
+    parser.add_argument('--out', help='write the report as json')
+    args = parser.parse_args()
+
+    lag_samples = None
+    server = workdir = None
+    if args.url:
+        base_url = args.url
+    else:
+        stub, stub_url = start(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+        workdir = tempfile.mkdtemp(prefix='load-')
+        setup_env(stub_url, workdir)
+        os.environ['LLM_STREAM'] = '1' if args.stream else '0'
+        lag_samples = []
+        port = free_port()
+        server, thread = serve_app(port, lag_samples)
+        base_url = f'http://127.0.0.1:{port}'
+
+    vids, statuses, wall, rec = asyncio.run(drive(base_url, args.videos, args.concurrency, args.readers, args.read_interval, args.poll))
+
+    if server is not None:
+        server.should_exit = True
+        thread.join()
+        stub.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+        for vid in vids:
+            shutil.rmtree(f'./app/temp/{vid}', ignore_errors=True)
+
+    res = report(statuses, wall, rec, lag_samples)
+    res['options'] = {k: v for k, v in vars(args).items() if k != 'out'}
+    print_report(res)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(res, f, indent=4)
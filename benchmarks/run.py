@@ -0,0 +1,286 @@
+"""
+Reproducible benchmark suite, runs offline against the saved corpus in benchmarks/corpus
+
+    python -m benchmarks.run --out results.json --repeat 5
+    python -m benchmarks.run --only vtt_parse doc_fit --baseline previous.json
+
+- vtt_parse: parse_vtt_from_text on a saved transcript
+- doc_fit: every phase of textrank Doc.fit (split, parse, graph, rank, score)
+- doc_batch: analyze_many over --videos copies of the transcript, one nlp.pipe stream and vectorized pagerank
+- vocabs_cold / vocabs_warm: process_list_vocabs with an empty and a filled dictionary cache
+- crud_insert: the insert paths of an ingest (video, subtitle lines, vocabs with senses, lessions with questions)
+- e2e: /video/create throughput, video info, subtitles, llm and dictionary are all served by the stub server
+
+Corpus files are served by benchmarks.stub_server, databases and caches are created in a temporary directory so
+nothing under app/data is touched. Results are written as json with the commit they were measured on, use
+--baseline to print the change of every median against a previous results file. For load under latency and
+errors see benchmarks.load, for the import time budget of the api benchmarks.import_time.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+from .stub_server import CORPUS, start
+
+VTT_PATH = os.path.join(CORPUS, 'vtt', 'silk_road.en.vtt')
+
+def read_corpus(*path):
+    with open(os.path.join(CORPUS, *path), encoding='utf-8') as f:
+        return f.read()
+
+def setup_env(base_url, workdir):
+    """
+    must run before the app is imported, settings are read at import time
+    """
+    os.environ.update({
+        'COMPLETION_URL': f'{base_url}/completion/',
+        'OXFORD_URL': f'{base_url}/definition/english/',
+        'YOUTUBE_INFO_URL': f'{base_url}/youtube/info/',
+        'DB_PATH': os.path.join(workdir, 'data.db'),
+        'DICT_CACHE_PATH': os.path.join(workdir, 'dictionary.db'),
+        'JOB_STORE_PATH': os.path.join(workdir, 'jobs.db'),
+        'LEXICON_PATH': os.path.join(workdir, 'lexicon.db'),
+        # measure parsing, not the politeness delay towards the real dictionary
+        'DICT_FETCH_RATE': '0',
+    })
+    os.environ.pop('TRACE_FILE', None)
+    os.environ.pop('TRACE_OTLP_ENDPOINT', None)
+
+def summarize(seconds):
+    return {
+        'repeat': len(seconds),
+        'min': min(seconds),
+        'median': statistics.median(seconds),
+        'mean': statistics.fmean(seconds),
+        'max': max(seconds),
+    }
+
+def measure(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    seconds = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - t0)
+    return summarize(seconds)
+
+def corpus_subs(vid):
+    from app.src.components.utils import parse_vtt_from_text
+    return [{
+        'video_id': vid,
+        'sub_id': 'en',
+        'auto': False,
+        'start': t['start'],
+        'end': t['end'],
+        'text': ' '.join(t['text'].replace('&nbsp;', ' ').strip(' ').split(' '))
+    } for t in parse_vtt_from_text(read_corpus('vtt', 'silk_road.en.vtt'))]
+
+def corpus_text():
+    return ' '.join(s['text'] for s in corpus_subs('bench'))
+
+def bench_vtt_parse(args, workdir):
+    from app.src.components.utils import parse_vtt_from_text
+    payload = read_corpus('vtt', 'silk_road.en.vtt')
+    return {'cues': len(parse_vtt_from_text(payload)), **measure(lambda: parse_vtt_from_text(payload), args.repeat)}
+
+def bench_doc_fit(args, workdir):
+    from app.src.components.textrankv3 import Doc
+    text = corpus_text()
+    phases = {}
+    def fit():
+        doc = Doc()
+        doc.fit(text)
+        for k, v in doc.phase_times.items():
+            phases.setdefault(k, []).append(v)
+    res = measure(fit, args.repeat)
+    # drop the warmup run, it includes loading the spacy model
+    res['phases'] = {k: summarize(v[1:]) for k, v in phases.items()}
+    return res
+
+def bench_doc_batch(args, workdir):
+    from app.src.components.textrankv3 import analyze_many
+    texts = [corpus_text()] * args.videos
+    res = measure(lambda: list(analyze_many(texts, window_size=4, epochs=15)), args.repeat)
+    res['texts'] = len(texts)
+    return res
+
+def parsed_vocabs():
+    from app.src.components.response_parser import parse_response
+    return parse_response('vocab', read_corpus('llm', 'vocab.txt'))['vocab_list']
+
+def bench_vocabs_cold(args, workdir):
+    from app.src.components import dictionary
+    from app.src.api.dependencies import process_list_vocabs
+    vocabs = parsed_vocabs()
+    def run():
+        path = os.path.join(workdir, f'dictionary-cold-{time.perf_counter_ns()}.db')
+        dictionary._cache = dictionary.DictionaryCache(path)
+        process_list_vocabs(vocabs)
+        dictionary._cache.conn.close()
+        dictionary._cache = None
+    return {'vocabs': len(vocabs), **measure(run, args.repeat, warmup=0)}
+
+def bench_vocabs_warm(args, workdir):
+    from app.src.api.dependencies import process_list_vocabs
+    vocabs = parsed_vocabs()
+    return {'vocabs': len(vocabs), **measure(lambda: process_list_vocabs(vocabs), args.repeat)}
+
+async def insert_video(db, url_id, subs, vocabs, questions):
+    """
+    same crud calls as the insert stages of start_video_insert_task, ids are read right away
+    since every crud call commits and expires the instances loaded before
+    """
+    from app.src.db import crud, schemas
+    video_id = (await crud.create_video(db, schemas.VideoCreate(
+        url_id=url_id, video_title='The Silk Road', length=1800,
+        thumbnail='', channel='', topic='history', summa='', level=3
+    ))).id
+    sub_id = (await crud.create_subtitle(db, schemas.SubtitlesCreate(video_id=video_id, auto=False))).id
+    await crud.create_sub_lines(db, [
+        schemas.SubtitleLinesCreate(sub_id=sub_id, start=s['start'], end=s['end'], text=s['text']) for s in subs
+    ])
+    for v in vocabs:
+        vocab_id = (await crud.create_vocab(db, schemas.VocabCreate(**v['vocab']))).id
+        await crud.create_sense(db, schemas.SenseCreate(vocab_id=vocab_id, video_id=video_id, **v['sense']))
+    for t in (0, 1):
+        lession_id = (await crud.create_lession(db, schemas.LessionCreate(video_id=video_id, type=t))).id
+        for q in questions:
+            question_id = (await crud.create_question(db, schemas.QuestionCreate(question=q['question'], type=0, lession_id=lession_id))).id
+            await crud.create_choices(db, [
+                schemas.ChoiceCreate(question_id=question_id, choice=c, correct=i == q['correct'], expl=q['explanation'])
+                for i, c in enumerate(q['choices'])
+            ])
+
+def bench_crud_insert(args, workdir):
+    from app.src.db import models # registers the tables on Base
+    from app.src.db.database import Base, SessionLocal, engine
+    from app.src.api.dependencies import format_cefr_key
+    from app.src.db.schemas import Level
+    vocabs = [{
+        'vocab': {'word': v['vocabulary'], 'ipa': v['ipa']},
+        'sense': {'sense': v['meaning'], 'pos': v['pos'], 'level': Level[format_cefr_key(v['level'])].value},
+    } for v in parsed_vocabs()]
+    subs = corpus_subs('bench')
+    questions = json.loads(read_corpus('llm', 'questions.txt'))['questions']
+
+    async def run():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        seconds = []
+        for n in range(args.repeat + 1):
+            async with SessionLocal() as db:
+                t0 = time.perf_counter()
+                await insert_video(db, f'bench{n:06d}', subs, vocabs, questions)
+                seconds.append(time.perf_counter() - t0)
+        await engine.dispose()
+        return seconds[1:]
+    return summarize(asyncio.run(run()))
+
+def bench_e2e(args, workdir):
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    vids = [f'e2e{n:08d}' for n in range(args.videos)]
+    create_seconds = []
+    submitted = {}
+    done_seconds = []
+    statuses = {}
+    with TestClient(app) as client:
+        t0 = time.perf_counter()
+        for vid in vids:
+            t1 = submitted[vid] = time.perf_counter()
+            res = client.post('/nlp/api/video/create', json={'url': f'https://www.youtube.com/watch?v={vid}'})
+            create_seconds.append(time.perf_counter() - t1)
+            res.raise_for_status()
+        pending = set(vids)
+        while pending:
+            for vid in list(pending):
+                status = client.get('/nlp/api/video/status', params={'uid': vid}).json()['status']
+                if status != 1:
+                    # submit to done, as seen by a client polling every 50ms
+                    done_seconds.append(time.perf_counter() - submitted[vid])
+                    statuses[vid] = status
+                    pending.discard(vid)
+            time.sleep(0.05)
+        wall = time.perf_counter() - t0
+    for vid in vids:
+        shutil.rmtree(f'./app/temp/{vid}', ignore_errors=True)
+    return {
+        'videos': len(vids),
+        'completed': sum(1 for s in statuses.values() if s == 0),
+        'wall': wall,
+        'jobs_per_min': len(vids) / wall * 60,
+        'create': summarize(create_seconds),
+        'done': summarize(done_seconds),
+    }
+
+BENCHMARKS = {
+    'vtt_parse': bench_vtt_parse,
+    'doc_fit': bench_doc_fit,
+    'doc_batch': bench_doc_batch,
+    'vocabs_cold': bench_vocabs_cold,
+    'vocabs_warm': bench_vocabs_warm,
+    'crud_insert': bench_crud_insert,
+    'e2e': bench_e2e,
+}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    for name, res in results.items():
+        old = baseline.get('results', {}).get(name) or {}
+        if 'median' in res and old.get('median'):
+            print(f'{name:<12} {old['median']:.4f}s -> {res['median']:.4f}s ({(res['median'] / old['median'] - 1) * 100:+.1f}%)')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the offline benchmark suite')
+    parser.add_argument('--out', default='benchmarks/results.json')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--videos', type=int, default=10, help='number of videos submitted in e2e, transcripts analyzed in doc_batch')
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--baseline', help='previous results file to compare medians with')
+    args = parser.parse_args()
+
+    server, base_url = start()
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    setup_env(base_url, workdir)
+
+    results = {}
+    for name in args.only:
+        try:
+            results[name] = BENCHMARKS[name](args, workdir)
+        except Exception as e:
+            # a benchmark that cannot run (e.g. missing spacy model) should not hide the others
+            results[name] = {'error': repr(e)}
+            traceback.print_exc()
+        print(f'{name}: {json.dumps(results[name])}', file=sys.stderr)
+    server.shutdown()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    out = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.out, 'w', encoding='utf-8') as f:
+        json.dump(out, f, indent=4)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            compare(results, json.load(f))
@@ -0,0 +1,171 @@
+"""
+Local stand-in for the completion API, YouTube and the Oxford dictionary, serving the benchmark corpus
+
+    python -m benchmarks.stub_server --port 8765 --latency 1.5 --jitter 0.5 --error-rate 0.05
+
+then point the app to it:
+
+    COMPLETION_URL=http://127.0.0.1:8765/completion/
+    OXFORD_URL=http://127.0.0.1:8765/definition/english/
+    YOUTUBE_INFO_URL=http://127.0.0.1:8765/youtube/info/
+
+- POST (any path): completion, the recorded response of the stage the prompt belongs to, streamed as
+  server-sent events when the request asks for it (`"stream": true`) unless --no-stream
+- GET /youtube/info/<id>: canned yt-dlp info dict of any 11 character video id, subtitles point to /youtube/vtt/<id>.en.vtt
+- GET /definition/english/<word>: saved dictionary page, 404 for words not in the corpus
+
+Latency and errors only apply to completions, the other routes answer right away
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus')
+
+# checked in order, the fused prompt contains the markers of every other stage
+STAGE_MARKERS = [
+    ('fused', 'JSON schema'),
+    ('topic_level', '{"topic"'),
+    ('vocab', 'vocab_list'),
+    ('questions', 'comprehension questions'),
+    ('summarize', 'summarize the text'),
+]
+
+def load_responses():
+    res = {}
+    for name in os.listdir(os.path.join(CORPUS, 'llm')):
+        with open(os.path.join(CORPUS, 'llm', name), encoding='utf-8') as f:
+            res[os.path.splitext(name)[0]] = f.read()
+    return res
+
+def load_info():
+    with open(os.path.join(CORPUS, 'youtube', 'info.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+def stage_of(prompt):
+    for stage, marker in STAGE_MARKERS:
+        if marker in prompt:
+            return stage
+    return None
+
+class StubHandler(BaseHTTPRequestHandler):
+    responses = load_responses()
+    info = load_info()
+    vtts = sorted(os.listdir(os.path.join(CORPUS, 'vtt')))
+
+    # completion behaviour, override with make_handler
+    latency = 0.0 # seconds before the response (or its first chunk)
+    jitter = 0.0 # uniform +/- seconds added to latency
+    error_rate = 0.0 # share of completions answered with an error
+    stream = True # honour "stream": true
+    chunk_chars = 40
+    chunk_delay = 0.01 # seconds between two streamed chunks
+
+    def send_body(self, status, body: bytes, content_type):
+        self.send_response(status)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, obj):
+        self.send_body(status, json.dumps(obj).encode(), 'application/json')
+
+    def send_stream(self, text):
+        # http/1.0, the end of the stream is the end of the connection
+        self.send_response(200)
+        self.send_header('content-type', 'text/event-stream')
+        self.end_headers()
+        for i in range(0, len(text), self.chunk_chars):
+            if i:
+                time.sleep(self.chunk_delay)
+            self.wfile.write(f'data: {json.dumps({'error': 0, 'data': text[i:i + self.chunk_chars]})}\n\n'.encode())
+            self.wfile.flush()
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get('content-length', 0))))
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            # both failure modes of the real API: http error and error code in the body
+            if random.random() < 0.5:
+                return self.send_body(503, b'Service Unavailable', 'text/plain')
+            return self.send_json(200, {'error': 1, 'data': None})
+
+        stage = stage_of(payload.get('prompt', ''))
+        if stage is None:
+            return self.send_json(200, {'error': 1, 'data': None})
+        if payload.get('stream') and self.stream:
+            return self.send_stream(self.responses[stage])
+        self.send_json(200, {'error': 0, 'data': self.responses[stage]})
+
+    def youtube_info(self, vid):
+        base = f'http://{self.headers.get('host')}'
+        info = {**self.info, 'id': vid, 'webpage_url': f'https://www.youtube.com/watch?v={vid}', 'thumbnail': f'https://i.ytimg.com/vi/{vid}/hqdefault.jpg'}
+        for k in ['subtitles', 'automatic_captions']:
+            info[k] = {
+                lang: [{**sub, 'url': f'{base}/youtube/vtt/{vid}.{lang}.{sub['ext']}'} for sub in subs]
+                for lang, subs in info[k].items()
+            }
+        return info
+
+    def do_GET(self):
+        prefix, _, name = self.path.rpartition('/')
+        if prefix == '/youtube/info' and len(name) == 11:
+            return self.send_json(200, self.youtube_info(name))
+        if prefix == '/youtube/vtt' and name.endswith('.en.vtt'):
+            # same video id, same transcript
+            path = os.path.join(CORPUS, 'vtt', self.vtts[zlib.crc32(name.encode()) % len(self.vtts)])
+            with open(path, 'rb') as f:
+                return self.send_body(200, f.read(), 'text/vtt; charset=utf-8')
+        if prefix == '/definition/english':
+            path = os.path.join(CORPUS, 'oxford', f'{os.path.basename(name)}.html')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return self.send_body(200, f.read(), 'text/html; charset=utf-8')
+        self.send_body(404, b'Not Found', 'text/plain')
+
+    def log_message(self, *args):
+        pass
+
+def make_handler(**options):
+    """
+    handler class with completion behaviour overridden, e.g. make_handler(latency=1.0, error_rate=0.1)
+    """
+    unknown = [k for k in options if not hasattr(StubHandler, k)]
+    if unknown:
+        raise TypeError(f'Unknown stub options {unknown}')
+    return type('ConfiguredStubHandler', (StubHandler,), options)
+
+def start(host='127.0.0.1', port=0, **options):
+    """
+    serve in a daemon thread, return (server, base url), port 0 picks a free port
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(**options))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://{host}:{server.server_address[1]}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve recorded llm responses, video info, subtitles and dictionary pages')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before a completion is answered')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--no-stream', action='store_true', help='answer plain json even when streaming is asked')
+    parser.add_argument('--chunk-chars', type=int, default=40)
+    parser.add_argument('--chunk-delay', type=float, default=0.01)
+    args = parser.parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(
+        latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, stream=not args.no_stream,
+        chunk_chars=args.chunk_chars, chunk_delay=args.chunk_delay
+    ))
+    server.daemon_threads = True
+    print(f'Serving on http://{args.host}:{args.port}')
+    server.serve_forever()
@@ -0,0 +1,39 @@
+"""
+Golden file test of the dictionary page parser, extract_all(parse_html(page)) of every saved page in
+benchmarks/corpus/oxford is compared with tests/golden/oxford/<word>.json
+
+After an intended parser change, regenerate the expected files and review the diff:
+
+    UPDATE_GOLDEN=1 python -m pytest tests/test_extractor.py
+"""
+import glob
+import json
+import os
+
+import pytest
+
+from app.src.components.extractor import parse_html, extract_all
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGES = sorted(glob.glob(os.path.join(ROOT, 'benchmarks', 'corpus', 'oxford', '*.html')))
+GOLDEN_DIR = os.path.join(ROOT, 'tests', 'golden', 'oxford')
+
+def golden_path(page):
+    return os.path.join(GOLDEN_DIR, os.path.splitext(os.path.basename(page))[0] + '.json')
+
+def test_corpus_not_empty():
+    assert PAGES
+
+@pytest.mark.parametrize('page', PAGES, ids=lambda p: os.path.splitext(os.path.basename(p))[0])
+def test_extract_all_golden(page):
+    with open(page, encoding='utf-8') as f:
+        # round trip through json, the golden files hold what the dictionary cache stores
+        res = json.loads(json.dumps(extract_all(parse_html(f.read()))))
+    path = golden_path(page)
+    if os.environ.get('UPDATE_GOLDEN'):
+        with open(path, 'w', encoding='utf-8', newline='\r\n') as f:
+            json.dump(res, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+    with open(path, encoding='utf-8') as f:
+        expected = json.load(f)
+    assert res == expected
@@ -0,0 +1,31 @@
+"""
+Import time budget of the api (see benchmarks/import_time.py), every check imports app.main in a fresh interpreter
+
+IMPORT_BUDGET (seconds) overrides the budget on slower machines
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmarks.import_time import ROOT, app_env, import_app
+
+IMPORT_BUDGET = float(os.environ.get('IMPORT_BUDGET', 0.8))
+REPEAT = 3
+
+# read replicas serve stored videos only, none of the ingest pipeline may be loaded
+READ_ROLE_ABSENT = ['spacy', 'nltk', 'networkx', 'bs4', 'yt_dlp']
+
+@pytest.mark.parametrize('role', ['all', 'api-read'])
+def test_import_budget(tmp_path, role):
+    # fastest of a few runs, a single one is noisy
+    seconds = min(next(cum for _, cum, _, name in import_app(tmp_path, role) if name == 'app.main') for _ in range(REPEAT)) / 1e6
+    assert seconds <= IMPORT_BUDGET, f'import app.main ({role}) took {seconds:.3f}s, budget {IMPORT_BUDGET:.3f}s'
+
+def test_read_role_skips_heavy_packages(tmp_path):
+    code = f'import json, sys; import app.main; print(json.dumps([m for m in {READ_ROLE_ABSENT!r} if m in sys.modules]))'
+    proc = subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=app_env(tmp_path, 'api-read'), capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr[-2000:]
+    assert json.loads(proc.stdout.splitlines()[-1]) == []
@@ -0,0 +1,72 @@
+"""
+Parsing of llm responses: json extraction from fenced, prefixed and truncated replies, partial lists of a stream
+and item salvaging
+"""
+import json
+
+import pytest
+
+from app.src.components.response_parser import ParseError, QuestionItem, VocabItem, extract_json, parse_partial, parse_response, salvage_list
+
+VOCABS = [
+    {'vocabulary': 'caravan', 'meaning': 'a group of travellers', 'pos': 'noun', 'ipa': '/ˈkærəvæn/', 'level': 'b2'},
+    {'vocabulary': 'merchant', 'meaning': 'a person who buys and sells goods', 'pos': 'noun', 'ipa': '/ˈmɜːtʃənt/', 'level': 'b1'},
+]
+COMPLETE = json.dumps({'vocab_list': VOCABS})
+# cut in the middle of a third item
+TRUNCATED = COMPLETE[:-2] + ', {"vocabulary": "legacy", "meaning": "something handed'
+
+def test_extract_json_plain():
+    assert extract_json(COMPLETE) == ({'vocab_list': VOCABS}, 'ok')
+
+@pytest.mark.parametrize('raw', [
+    f'```json\n{COMPLETE}\n```',
+    f'Sure! Here is the vocabulary: {COMPLETE} Hope it helps.',
+], ids=['fenced', 'prefixed'])
+def test_extract_json_fenced_or_prefixed(raw):
+    assert extract_json(raw) == ({'vocab_list': VOCABS}, 'repaired')
+
+@pytest.mark.parametrize('raw', [
+    TRUNCATED,
+    f'```json\n{TRUNCATED}',
+    f'Sure! Here is the vocabulary:\n{TRUNCATED}',
+], ids=['bare', 'fenced', 'prefixed'])
+def test_extract_json_truncated(raw):
+    data, outcome = extract_json(raw)
+    # closed after the last complete value, the unfinished item is left to salvage_list
+    assert outcome == 'salvaged'
+    assert data['vocab_list'][:2] == VOCABS
+    assert data['vocab_list'][2] == {'vocabulary': 'legacy'}
+
+def test_extract_json_without_json():
+    with pytest.raises(ParseError):
+        extract_json('Sorry, I can not help with that.')
+
+def test_parse_response_truncated_fenced():
+    assert parse_response('vocab', f'```json\n{TRUNCATED}') == {'vocab_list': VOCABS}
+
+@pytest.mark.parametrize('prefix', ['', '```json\n', 'Sure! '], ids=['bare', 'fenced', 'prefixed'])
+def test_parse_partial_keeps_complete_items(prefix):
+    assert parse_partial('vocab', prefix + TRUNCATED) == VOCABS
+
+@pytest.mark.parametrize('prefix', ['', '```json\n', 'Sure! '], ids=['bare', 'fenced', 'prefixed'])
+def test_parse_partial_skips_item_being_written(prefix):
+    # the second item is valid without its level, it must not be returned before the stream got to it
+    raw = prefix + COMPLETE[:COMPLETE.index('"level": "b1"')]
+    assert parse_partial('vocab', raw) == VOCABS[:1]
+
+def test_parse_partial_before_json():
+    assert parse_partial('vocab', '```js') == []
+
+def test_salvage_list_drops_invalid_items():
+    questions = [
+        {'question': 'Where is Samarkand?', 'choices': ['Uzbekistan', 'Peru'], 'correct': 0, 'explanation': None},
+        {'question': 'Out of range', 'choices': ['a', 'b'], 'correct': 2},
+        {'question': '', 'choices': ['a', 'b'], 'correct': 0},
+    ]
+    valid, dropped = salvage_list(QuestionItem, questions)
+    assert valid == [{'question': 'Where is Samarkand?', 'choices': ['Uzbekistan', 'Peru'], 'correct': 0, 'explanation': ''}]
+    assert dropped == 2
+
+def test_salvage_list_not_a_list():
+    assert salvage_list(VocabItem, {'vocabulary': 'caravan'}) == ([], 1)